@@ -1,11 +1,15 @@
 import copernicusmarine as cm
-from src.download.downloadOceanData import download_data
+from src.download.downloadOceanData import download_data, release_sites
 from src.preproc.interpolateOceanData import interpolate_data
-from src.plume import plume
+from src.plume import plume, restart_plume
 from src.render.plotPlume import plot
 from src.render.plotOceanData import plot_ocean
 from src.utils.output_db import create_exp_dir_and_log_namelist, merge_product_summary
-from src.utils.readNamelist import read_simulation_namelists
+from src.utils.checkpoint import CHECKPOINT_FILE
+from src.utils.readNamelist import read_simulation_namelists, read_namelist
+from src.sweep import read_sweep_namelist, run_sweep, sweep_design
+from src.monteCarlo import monte_carlo
+from src.screening import run_screening
 from src.utils.utils import print_ntime
 import shutil
 import os
@@ -16,12 +20,20 @@ DO_DOWNLOAD = False
 DO_PLUME = False
 DO_PLOT = False
 DO_MERGE = False
+DO_SWEEP = False
+DO_MONTECARLO = False
+DO_SCREENING = False
+DO_RESTART = False
 
 # De-comment what you want to run from the flag list below
 #DO_DOWNLOAD = True
 DO_PLUME = True
 DO_PLOT = True
 #DO_MERGE = True
+#DO_SWEEP = True
+#DO_MONTECARLO = True
+#DO_SCREENING = True
+#DO_RESTART = True
 
 
 if __name__ == '__main__':
@@ -40,7 +52,11 @@ if __name__ == '__main__':
     # Download the ocean data from Copernicus Marine Service, which will serve as boundary condition to the oil spill motion
     if DO_DOWNLOAD:
         print_ntime('Downloading data...')
-        download_data(ambient_namelist, static_paths)
+        # spill footprint of a sweep: union of the sites of its members
+        sites = None
+        if DO_SWEEP:
+            sites = release_sites(release_namelist, sweep_design(read_sweep_namelist(UWORM1_ROOT=UWORM1_ROOT)))
+        download_data(ambient_namelist, static_paths, release_namelist=release_namelist, sites=sites)
         print_ntime('Done downloading data.')
 
     # Interpolate and run the plume simulation
@@ -49,22 +65,63 @@ if __name__ == '__main__':
         exp_dir, runId = create_exp_dir_and_log_namelist(prod_path)
 
         # Interpolate the ocean data at the spill location, obtaining vertical profiles of u,v,T,S,rhoa
+        # (the stages hand the profile and the plume result over in memory, the files are written alongside)
         print_ntime('Interpolating...')
-        interpolate_data(exp_dir, ambient_namelist, release_namelist, static_paths)
+        profile = interpolate_data(exp_dir, ambient_namelist, release_namelist, static_paths)
         print_ntime('Done interpolating.')
 
         # Run the plume simulation, obtaining the time-evolution of the spill
         print_ntime('Running the plume simulation...')
-        plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, constants)
+        result = plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, constants,
+                       profile=profile)
         print_ntime('Plume simulation done.')
 
         # Visualize the plume variables and the ocean data
         if DO_PLOT:
             print_ntime('Plotting...')
-            plot(exp_dir, render_namelist, ambient_namelist)
-            plot_ocean(exp_dir, ambient_namelist)
+            plot(exp_dir, render_namelist, ambient_namelist, result=result)
+            plot_ocean(exp_dir, ambient_namelist, profile=profile)
             print_ntime('Done plotting.')
 
+    # Monte Carlo uncertainty analysis (namelist/MonteCarlo.yaml): nominal run plus percentile envelopes
+    if DO_MONTECARLO:
+        exp_dir, runId = create_exp_dir_and_log_namelist(prod_path)
+        print_ntime('Interpolating...')
+        profile = interpolate_data(exp_dir, ambient_namelist, release_namelist, static_paths)
+        print_ntime('Done interpolating.')
+
+        print_ntime('Running the Monte Carlo analysis...')
+        mc_namelist = read_namelist('MonteCarlo', template='MonteCarlo', UWORM1_ROOT=UWORM1_ROOT)
+        monte_carlo(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, constants, mc_namelist,
+                    profile=profile)
+        print_ntime('Done running the Monte Carlo analysis.')
+
+    # Screening of candidate release sites (namelist/Screening.yaml): similarity-theory trap height,
+    # rise time and dilution of every site, calibrated on full-model runs of a few of them
+    if DO_SCREENING:
+        exp_dir, runId = create_exp_dir_and_log_namelist(prod_path)
+        print_ntime('Screening the release sites...')
+        screening_namelist = read_namelist('Screening', template='Screening', UWORM1_ROOT=UWORM1_ROOT)
+        run_screening(exp_dir, screening_namelist, ambient_namelist, numerical_namelist, release_namelist, constants,
+                      static_paths)
+        print_ntime('Done screening the release sites.')
+
+    # Parameter sweep (namelist/Sweep.yaml): interpolate + plume for every member in a process pool
+    if DO_SWEEP:
+        print_ntime('Running the parameter sweep...')
+        sweep_namelist = read_sweep_namelist(UWORM1_ROOT=UWORM1_ROOT)
+        run_sweep(sweep_namelist, ambient_namelist, numerical_namelist, release_namelist, constants, static_paths)
+        print_ntime('Done running the parameter sweep.')
+
+    # Continue the interrupted runs of the product path from their last checkpoint (checkpoint_every > 0)
+    if DO_RESTART:
+        for run in sorted(os.listdir(prod_path)):
+            exp_dir = os.path.join(prod_path, run, '')
+            if 'run' in run and os.path.exists(os.path.join(exp_dir, CHECKPOINT_FILE)):
+                print_ntime(f'Restarting {run}...')
+                restart_plume(exp_dir, run[3:])
+                print_ntime(f'Done restarting {run}.')
+
     # merge all summary in one csv
     if DO_MERGE:
         print_ntime('Merging summary.json files...')
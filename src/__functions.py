@@ -14,6 +14,7 @@ from scipy import interpolate
 from scipy.interpolate import RegularGridInterpolator
 import gsw
 import os
+import math
 
 # # Calculation of reduced gravity
 def reduced_g(params):
@@ -158,3 +159,156 @@ def RK4(model,params,plume_state_b,dt):
     d_plume_state=1/6 * (k1 + 2*k2 + 2*k3 + k4)
     
     return d_plume_state
+
+
+
+# # # FAST PATH: typed parameters and scalar versions of the functions above # # #
+
+class PlumeParams:
+    '''
+    Compact container of the plume and ambient parameters used by the solver.
+    It replaces the string-keyed params dict in the time loop: attributes are stored
+    in __slots__, so reading them costs an attribute lookup instead of a dict hash.
+    Dict-style access (params['g1']) is kept, so the original functions also accept it.
+    '''
+    __slots__ = ('g', 'c_T', 'ca', 'total_entrain', 'a1', 'a2', 'a3',
+                 'h', 'u', 'v', 'c', 'b', 'bb', 'v_0', 'v_0b', 'ds',
+                 'v_phi', 'v_phib', 'v_theta', 'v_thetab',
+                 'Ta', 'Sa', 'rhoa', 'rhoa_0', 'ua', 'va',
+                 'rho_oil', 'rho_w', 'rho', 'g1', 'alpha')
+
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, 0.)
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def keys(self):
+        return self.__slots__
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, params):
+        return cls(**params)
+
+    def copy(self):
+        return PlumeParams(**self.as_dict())
+
+
+def reduced_g_fast(p):
+    ''' Same as reduced_g, for PlumeParams '''
+    return p.g * (p.rhoa - p.rho) / p.rhoa_0
+
+
+def proj_vel_fast(p):
+    ''' Same as proj_vel, as a scalar dot product (no temporary arrays) '''
+    return (p.u * p.ua + p.v * p.va) / p.v_0
+
+
+def vdif_fast(p):
+    ''' Same as vdif, for PlumeParams '''
+    return abs(p.v_0 - proj_vel_fast(p))
+
+
+def shear_entrain_yapa_fast(p):
+    ''' Same as shear_entrain_yapa, for PlumeParams '''
+    return 2 * math.pi * p.b * p.h * p.alpha * vdif_fast(p)
+
+
+def entrain_coeff_yapa_fast(p):
+    ''' Same as entrain_coeff_yapa, for PlumeParams '''
+    pv = proj_vel_fast(p)
+    vd = abs(p.v_0 - pv)
+    invF1_square = reduced_g_fast(p) * p.b*2 / vd**2
+    return (p.a1 + p.a2 * math.sin(p.v_phi) * invF1_square) / (1 + p.a3 * pv / vd)
+
+
+def forced_entrain_yapa_fast(p):
+    ''' Same as forced_entrain_yapa, for PlumeParams: trigonometric terms are computed once '''
+    b = p.b
+    cos_phi, cos_phib = math.cos(p.v_phi), math.cos(p.v_phib)
+    cos_theta, sin_theta = math.cos(p.v_theta), math.sin(p.v_theta)
+    cos_thetab, sin_thetab = math.cos(p.v_thetab), math.sin(p.v_thetab)
+    stretch = math.pi * b * (b - p.bb)
+    bend = 2 * b * p.ds
+    enlarge = math.pi * b**2 / 2
+
+    Qfx = abs(p.ua) * (stretch * abs(cos_theta*cos_phi) +
+                       bend * math.sqrt(1 - cos_theta**2 * cos_phi**2) +
+                       enlarge * abs(cos_theta*cos_phi - cos_thetab*cos_phib))
+    Qfy = abs(p.va) * (stretch * abs(sin_theta*cos_phi) +
+                       bend * math.sqrt(1 - sin_theta**2 * cos_phi**2) +
+                       enlarge * abs(sin_theta*cos_phi - sin_thetab*cos_phib))
+    return abs(Qfx) + abs(Qfy)
+
+
+def total_entrain_fast(p, Qs, Qf):
+    ''' Total entrainment flux: max(Qs,Qf) if total_entrain is 0, Qs+Qf otherwise '''
+    return max(Qs, Qf) if p.total_entrain == 0 else Qs + Qf
+
+
+def model_fast(plume_state, p):
+    ''' Same as model, for PlumeParams '''
+    Qe = total_entrain_fast(p, shear_entrain_yapa_fast(p), forced_entrain_yapa_fast(p))
+    return model_fused(plume_state, p, Qe)
+
+
+def model_fused(plume_state, p, Qe):
+    ''' Same as model_fast, with the entrainment flux Qe given '''
+    rQe = p.rhoa * Qe
+    m = plume_state[0]
+
+    return np.array([rQe, rQe * p.ua, rQe * p.va, m * p.g1, rQe * p.ca,
+                     plume_state[1]/m, plume_state[2]/m, plume_state[3]/m, rQe * p.Ta, rQe * p.Sa])
+
+
+def model_jacobian_fast(plume_state, p):
+    '''
+    Analytic Jacobian d(model_fast)/d(plume_state), 10x10. The params are frozen during a step,
+    so only the buoyancy term m*g1 and the velocities um/m, vm/m, wm/m depend on the state.
+    '''
+    jac = np.zeros((10, 10))
+    m = plume_state[0]
+    jac[3, 0] = p.g1
+    for i in range(1, 4):
+        jac[4 + i, 0] = -plume_state[i] / m**2
+        jac[4 + i, i] = 1 / m
+    return jac
+
+
+# # FUSED RUNGE-KUTTA IV
+RK4_MODES = ('fused', 'consistent')
+
+def RK4_fused(plume_state_b, p, dt, Qe, stage_params=None):
+    '''
+    RK4 step of model_fast with the entrainment flux computed once per step.
+    params are not updated between the stages, so model_fast gets the same Qe at all of them:
+    here Qe is given, e.g. the one of the diagnostics of the previous step (same params),
+    and the result is the same as RK4(model_fast, p, plume_state_b, dt).
+
+    "consistent" mode: stage_params(stage_state, c) returns the (params, Qe) of the state of the
+    stage at the fraction c of the step (None to keep p, Qe), so that the entrainment is evaluated
+    again at the stages 2-4.
+    '''
+    def rate(state, c):
+        if stage_params is not None:
+            stage = stage_params(state, c)
+            if stage is not None:
+                return model_fused(state, *stage)
+        return model_fused(state, p, Qe)
+
+    k1 = dt*model_fused(plume_state_b, p, Qe)
+    k2 = dt*rate(plume_state_b + k1/2, 1/2)
+    k3 = dt*rate(plume_state_b + k2/2, 1/2)
+    k4 = dt*rate(plume_state_b + k3, 1.)
+    d_plume_state = 1/6 * (k1 + 2*k2 + 2*k3 + k4)
+
+    return d_plume_state
@@ -1,29 +1,80 @@
 """
-This script runs a loop of motuclient command lines through a list of coordinates,
-time and depth ranges via an input file (csv/xlsx).
+Download of the ocean fields of the product datasets from Copernicus Marine Service.
+
+The datasets are downloaded concurrently in a bounded thread pool, and every
+download directory keeps a manifest of the files already on disk: a dataset
+covered by the manifest is skipped, otherwise only its missing variables or days
+are requested. The client is copernicusmarine by default; any object with the
+same subset() (e.g. LocalClient, which subsets local NetCDF files) can be passed.
+
+With DOWNLOAD_FOOTPRINT: spill the bbox and depth range are not the ones of the
+Ambient namelist but the smallest ones needed by interpolate_data: the bilinear
+stencil around the spill location (plus FOOTPRINT_CELLS grid cells), from the
+surface to FOOTPRINT_DEPTH_MARGIN below z0. With a list of sites (e.g. the
+members of a sweep) the footprint is the union of their footprints.
+
+With DATA_STORE: True the days are ingested in the rolling local store of the
+product (src/download/timeStore.py) instead of a new folder per start date.
 """
 import os
-import copernicusmarine as cm
 from datetime import datetime
-from src.utils.datasetInterface import get_data_interface
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from src.utils.datasetInterface import get_data_interface, get_grid_resolution
+from src.utils.utils import print_ntime
+from src.download.manifest import DataRequest, Manifest
+from src.download.timeStore import TimeSeriesStore
 
 
-def download_data(ambient_namelist, static_paths):
+FOOTPRINT_MODES = ('box', 'spill')
 
-    # Sea area data
-    sea_area = ambient_namelist['SEA_AREA']
 
-    # Products id
-    product_id = ambient_namelist['PRODUCT_ID']
+def download_footprint(ambient_namelist, sites):
+    """
+    Bbox (lon_min, lon_max, lat_min, lat_max) and depth range covering the interpolation
+    of the profiles at the sites, a list of (spill_lat, spill_lon, z0).
+    """
+    sites = np.atleast_2d(np.asarray(sites, dtype=np.float64))
+    dlon, dlat = get_grid_resolution(ambient_namelist['PRODUCT_ID'])
+    # the bilinear stencil is within one grid cell of the spill location
+    cells = 1 + int(ambient_namelist.get('FOOTPRINT_CELLS', 1))
+    bbox = (sites[:, 1].min() - cells * dlon, sites[:, 1].max() + cells * dlon,
+            sites[:, 0].min() - cells * dlat, sites[:, 0].max() + cells * dlat)
+    depth_max = -sites[:, 2].min() + float(ambient_namelist.get('FOOTPRINT_DEPTH_MARGIN', 50.))
+    return tuple(round(val, 4) for val in bbox), (0., round(depth_max, 2))
+
 
-    # Input files
-    input_files = static_paths['INPUT_FILES']
+def release_sites(release_namelist, members=()):
+    """
+    The (spill_lat, spill_lon, z0) of the release, or of every member {'release.<key>': value} of a sweep.
+    """
+    keys = ('spill_lat', 'spill_lon', 'z0')
+    if not members:
+        return [tuple(float(release_namelist[key]) for key in keys)]
+    return sorted({tuple(float(member.get(f'release.{key}', release_namelist[key])) for key in keys)
+                   for member in members})
 
-    # coordinates - northsea
-    lon_min = ambient_namelist['LON_MIN']
-    lon_max = ambient_namelist['LON_MAX']
-    lat_min = ambient_namelist['LAT_MIN']
-    lat_max = ambient_namelist['LAT_MAX']
+
+def download_requests(ambient_namelist, static_paths, sites=None):
+    """
+    The download directory and the DataRequest of every dataset of the product.
+    sites: list of (spill_lat, spill_lon, z0), needed by the spill footprint
+    """
+    # Sea area data
+    sea_area = ambient_namelist['SEA_AREA']
+
+    # coordinates and depth range
+    footprint = ambient_namelist.get('DOWNLOAD_FOOTPRINT', 'box')
+    if footprint not in FOOTPRINT_MODES:
+        raise ValueError(f'Unrecognized download footprint: {footprint}')
+    if footprint == 'spill':
+        if not sites:
+            raise ValueError('The spill download footprint needs the release sites.')
+        bbox, depth_range = download_footprint(ambient_namelist, sites)
+    else:
+        bbox = (ambient_namelist['LON_MIN'], ambient_namelist['LON_MAX'],
+                ambient_namelist['LAT_MIN'], ambient_namelist['LAT_MAX'])
+        depth_range = (ambient_namelist['DEPTH_MIN'], ambient_namelist['DEPTH_MAX'])
 
     # Boundary dates
     start_date = datetime(ambient_namelist['START_YEAR'], ambient_namelist['START_MONTH'],
@@ -31,39 +82,99 @@ def download_data(ambient_namelist, static_paths):
     end_date = datetime(ambient_namelist['END_YEAR'], ambient_namelist['END_MONTH'], ambient_namelist['END_DAY'],
                         ambient_namelist['END_HOUR'])
 
+    # Output directory
+    output_directory = os.path.join(static_paths['INPUT_FILES'], start_date.strftime("%Y%m%d"), sea_area)
+
+    # Product interface with the different datasets
+    data_interface = get_data_interface(ambient_namelist['PRODUCT_ID'])
+
+    requests = [DataRequest(dataset_id, variables, bbox, (start_date, end_date), depth_range)
+                for datasets in data_interface.values() for dataset_id, variables in datasets.items()]
+    return output_directory, requests
+
+
+def subset(client, request, output_directory):
+    # download one request with the copernicusmarine interface, returns the file name
+    filename = request.filename()
+    client.subset(
+        dataset_id=request.dataset_id,
+        variables=request.variables,
+        minimum_longitude=request.bbox[0],
+        maximum_longitude=request.bbox[1],
+        minimum_latitude=request.bbox[2],
+        maximum_latitude=request.bbox[3],
+        start_datetime=request.time_range[0].strftime("%Y-%m-%dT%H:%M:%S"),
+        end_datetime=request.time_range[1].strftime("%Y-%m-%dT%H:%M:%S"),
+        minimum_depth=request.depth_range[0],
+        maximum_depth=request.depth_range[1],
+        output_directory=output_directory,
+        output_filename=filename,
+        force_download="true",
+        overwrite_output_data="true"
+        )
+    return filename
+
+
+def download_data(ambient_namelist, static_paths, release_namelist=None, sites=None, client=None,
+                  max_workers=None):
+    """
+    Download the datasets of the product that the manifest of the download directory does not cover.
+
+    Parameters:
+        release_namelist: spill location and z0 of the spill footprint
+        sites:       list of (spill_lat, spill_lon, z0) of the spill footprint (union), instead of the release
+        client:      object with the copernicusmarine subset() interface (default: copernicusmarine)
+        max_workers: size of the thread pool (default: DOWNLOAD_WORKERS of the Ambient namelist)
+
+    Returns:
+        the download directory (the store directory with DATA_STORE)
+    """
+    if client is None:
+        import copernicusmarine as client
+    if max_workers is None:
+        max_workers = int(ambient_namelist.get('DOWNLOAD_WORKERS', 3))
+
+    if sites is None and release_namelist is not None:
+        sites = release_sites(release_namelist)
+    output_directory, requests = download_requests(ambient_namelist, static_paths, sites=sites)
+
+    # Rolling local store: only the missing days, the old ones are evicted
+    if ambient_namelist.get('DATA_STORE', False):
+        store = TimeSeriesStore.from_namelist(ambient_namelist, static_paths)
+        request = requests[0]
+        store.ingest(request.bbox, request.depth_range, *request.time_range,
+                     retention=ambient_namelist.get('STORE_RETENTION_DAYS'), client=client, max_workers=max_workers)
+        return store.directory
+
     # Create output directory if does not exist
-    output_directory = os.path.join(input_files, start_date.strftime("%Y%m%d"), sea_area)
+    os.makedirs(output_directory, exist_ok=True)
 
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
+    manifest = Manifest(output_directory)
+    todo = [missing for request in requests for missing in manifest.missing(request)]
+    if not todo:
+        print_ntime(f'All the datasets are already in {output_directory}.')
+        return output_directory
+
+    def download(request):
+        filename = subset(client, request, output_directory)
+        manifest.add(request, filename)
+        return filename
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as pool:
+        futures = {pool.submit(download, request): request for request in todo}
+        for future in as_completed(futures):
+            request = futures[future]
+            try:
+                print_ntime(f'Downloaded {future.result()}')
+            except Exception as e:
+                errors.append(request)
+                print_ntime(f'[ERROR] downloading {request.dataset_id} {request.variables}:\n{str(e)}')
+    if errors:
+        raise RuntimeError(f'{len(errors)} of {len(todo)} downloads failed.')
+
+    return output_directory
 
-    # depth range
-    depth_min = ambient_namelist['DEPTH_MIN']
-    depth_max = ambient_namelist['DEPTH_MAX']
 
-    # Product interface with the different datasets
-    data_interface = get_data_interface(product_id)
-
-    for product, datasets in data_interface.items():
-        for dataset_id, variables in datasets.items():
-            
-            # download data
-            cm.subset(
-                dataset_id=dataset_id,
-                #dataset_version="202012",
-                variables=variables,
-                minimum_longitude=lon_min,
-                maximum_longitude=lon_max,
-                minimum_latitude=lat_min,
-                maximum_latitude=lat_max,
-                start_datetime=start_date.strftime("%Y-%m-%dT%H:%M:%S"),
-                end_datetime=end_date.strftime("%Y-%m-%dT%H:%M:%S"),
-                minimum_depth=depth_min,
-                maximum_depth=depth_max,
-                output_directory=output_directory,
-                force_download="true",
-                overwrite_output_data="true"
-                )
-            
 if __name__ == '__main__':
-    download_data()
\ No newline at end of file
+    download_data()
@@ -0,0 +1,55 @@
+"""
+Local stand-in for the copernicusmarine client
+
+LocalClient.subset has the interface of copernicusmarine.subset and cuts the
+subset out of local NetCDF files of the datasets (e.g. a previous download),
+so that the download layer runs offline, in tests and for repeated scenarios.
+"""
+import os
+import threading
+from glob import glob
+import xarray as xr
+
+
+_HDF5_LOCK = threading.Lock()
+
+class LocalClient:
+    """
+    Parameters:
+        sources: dict {dataset_id: NetCDF file} or a directory with files named <dataset_id>*.nc
+
+    The calls to subset are recorded in self.calls (list of the keyword arguments).
+    """
+    def __init__(self, sources):
+        self.sources = sources
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def source(self, dataset_id):
+        if isinstance(self.sources, dict):
+            return self.sources[dataset_id]
+        files = sorted(glob(os.path.join(self.sources, f'{dataset_id}*.nc')))
+        if not files:
+            raise FileNotFoundError(f'No local file of the dataset {dataset_id} in {self.sources}')
+        return files[0]
+
+    def subset(self, dataset_id, variables, minimum_longitude, maximum_longitude, minimum_latitude,
+               maximum_latitude, start_datetime, end_datetime, minimum_depth, maximum_depth, output_directory,
+               output_filename, **kwargs):
+        with self._lock:
+            self.calls.append(dict(dataset_id=dataset_id, variables=list(variables),
+                                   minimum_longitude=minimum_longitude, maximum_longitude=maximum_longitude,
+                                   minimum_latitude=minimum_latitude, maximum_latitude=maximum_latitude,
+                                   start_datetime=start_datetime, end_datetime=end_datetime,
+                                   minimum_depth=minimum_depth, maximum_depth=maximum_depth,
+                                   output_directory=output_directory, output_filename=output_filename))
+        # the HDF5 library is not thread-safe: the subsets of the download pool are cut one at a time
+        path = os.path.join(output_directory, output_filename)
+        with _HDF5_LOCK, xr.open_dataset(self.source(dataset_id)) as ds:
+            sub = ds[list(variables)].sel(longitude=slice(minimum_longitude, maximum_longitude),
+                                          latitude=slice(minimum_latitude, maximum_latitude),
+                                          time=slice(start_datetime, end_datetime),
+                                          depth=slice(minimum_depth, maximum_depth))
+            sub.load().to_netcdf(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        return path
@@ -0,0 +1,194 @@
+"""
+Manifest of the ocean data already downloaded
+
+Every download directory keeps a manifest.json with one entry per downloaded
+file: dataset, variables, bbox, time and depth range, size, modification time
+and sha256 checksum. A request is skipped when the files of the manifest cover
+it, and only the missing variables or days are requested otherwise.
+Files modified or removed after the download are dropped from the manifest.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+
+MANIFEST_FILE = 'manifest.json'
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def file_checksum(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _coord(value, positive, negative):
+    return f'{abs(value):.2f}{positive if value >= 0 else negative}'
+
+
+def contains(outer, inner):
+    """
+    True if the range inner (min, max) lies in the range outer.
+    """
+    return outer[0] <= inner[0] and inner[1] <= outer[1]
+
+
+class DataRequest:
+    """
+    One subset of a dataset: variables, bbox (lon_min, lon_max, lat_min, lat_max),
+    time range (datetimes) and depth range.
+    """
+    def __init__(self, dataset_id, variables, bbox, time_range, depth_range):
+        self.dataset_id = dataset_id
+        self.variables = list(variables)
+        self.bbox = tuple(float(val) for val in bbox)
+        self.time_range = tuple(time_range)
+        self.depth_range = tuple(float(val) for val in depth_range)
+
+    def replace(self, **kwargs):
+        values = {'dataset_id': self.dataset_id, 'variables': self.variables, 'bbox': self.bbox,
+                  'time_range': self.time_range, 'depth_range': self.depth_range}
+        values.update(kwargs)
+        return DataRequest(**values)
+
+    def filename(self):
+        # copernicusmarine naming, with the variables joined by '-' (the file patterns of interpolate_data)
+        lon_min, lon_max, lat_min, lat_max = self.bbox
+        return (f'{self.dataset_id}_{"-".join(self.variables)}_'
+                f'{_coord(lon_min, "E", "W")}-{_coord(lon_max, "E", "W")}_'
+                f'{_coord(lat_min, "N", "S")}-{_coord(lat_max, "N", "S")}_'
+                f'{self.depth_range[0]:.2f}-{self.depth_range[1]:.2f}m_'
+                f'{self.time_range[0]:%Y-%m-%d}-{self.time_range[1]:%Y-%m-%d}.nc')
+
+    def to_dict(self):
+        return {'dataset_id': self.dataset_id, 'variables': self.variables, 'bbox': list(self.bbox),
+                'time_range': [t.strftime(TIME_FORMAT) for t in self.time_range],
+                'depth_range': list(self.depth_range)}
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry['dataset_id'], entry['variables'], entry['bbox'],
+                   [datetime.strptime(t, TIME_FORMAT) for t in entry['time_range']], entry['depth_range'])
+
+    def covered_by(self, other, variables=None):
+        # other covers the variables of this request (all of them by default) over the whole bbox, time and depth
+        lon_min, lon_max, lat_min, lat_max = self.bbox
+        return (other.dataset_id == self.dataset_id
+                and set(variables if variables is not None else self.variables) <= set(other.variables)
+                and contains(other.bbox[:2], (lon_min, lon_max)) and contains(other.bbox[2:], (lat_min, lat_max))
+                and contains(other.time_range, self.time_range) and contains(other.depth_range, self.depth_range))
+
+
+class Manifest:
+    """
+    The manifest.json of a download directory. Thread-safe: the downloads of a pool
+    add their entries concurrently, and the file is rewritten atomically after each one.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        self.entries = []
+        if os.path.exists(self.path):
+            with open(self.path) as fin:
+                self.entries = json.load(fin)
+        self._validate()
+
+    def _validate(self):
+        # drop the entries whose file is gone or changed since the download (checksum only on a size/mtime change)
+        valid = []
+        for entry in self.entries:
+            path = os.path.join(self.directory, entry['file'])
+            if not os.path.exists(path):
+                continue
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime) != (entry['size'], entry['mtime']):
+                if stat.st_size != entry['size'] or file_checksum(path) != entry['sha256']:
+                    continue
+                entry['mtime'] = stat.st_mtime
+            valid.append(entry)
+        if len(valid) != len(self.entries):
+            self.entries = valid
+            self._write()
+
+    def _write(self):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.manifest', suffix='.tmp')
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(self.entries, fout, indent=1)
+        os.replace(tmp, self.path)
+
+    def requests(self):
+        return [(DataRequest.from_dict(entry), entry['file']) for entry in self.entries]
+
+    def add(self, request, filename):
+        path = os.path.join(self.directory, filename)
+        stat = os.stat(path)
+        entry = request.to_dict()
+        entry.update({'file': filename, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_checksum(path),
+                      'downloaded': datetime.utcnow().strftime(TIME_FORMAT)})
+        with self._lock:
+            self.entries = [e for e in self.entries if e['file'] != filename] + [entry]
+            self._write()
+
+    def find(self, variable, lon=None, lat=None, time=None):
+        """
+        The file names of the entries with the variable, containing the point (lon, lat) and the time if given.
+        """
+        files = []
+        for request, filename in self.requests():
+            if variable not in request.variables:
+                continue
+            if lon is not None and not contains(request.bbox[:2], (lon, lon)):
+                continue
+            if lat is not None and not contains(request.bbox[2:], (lat, lat)):
+                continue
+            if time is not None and not contains(request.time_range, (time, time)):
+                continue
+            files.append(filename)
+        return files
+
+    def missing(self, request, step=timedelta(days=1)):
+        """
+        The requests still to download to cover `request`: none if the manifest covers it,
+        the missing variables, and for the variables covered in space and depth only the missing days
+        (before, between and after the downloaded time ranges).
+        """
+        covered = self.requests()
+        todo = [var for var in request.variables
+                if not any(request.covered_by(other, [var]) for other, _ in covered)]
+        if not todo:
+            return []
+
+        missing = []
+        for var in todo:
+            # a downloaded entry covering the space and depth of the request: extend it in time only
+            in_space = [other for other, _ in covered
+                        if request.replace(time_range=other.time_range).covered_by(other, [var])
+                        and other.time_range[0] <= request.time_range[1]
+                        and request.time_range[0] <= other.time_range[1]]
+            if not in_space:
+                missing.append(request.replace(variables=[var]))
+                continue
+            cursor = request.time_range[0]
+            for other in sorted(in_space, key=lambda other: other.time_range[0]):
+                if other.time_range[0] - step >= cursor:
+                    missing.append(request.replace(variables=[var], time_range=(cursor, other.time_range[0] - step)))
+                cursor = max(cursor, other.time_range[1] + step)
+            if cursor <= request.time_range[1]:
+                missing.append(request.replace(variables=[var], time_range=(cursor, request.time_range[1])))
+
+        # the variables with the same missing ranges are downloaded together
+        merged = {}
+        for req in missing:
+            key = (req.time_range, req.bbox, req.depth_range)
+            if key in merged:
+                merged[key].variables += req.variables
+            else:
+                merged[key] = req
+        return list(merged.values())
@@ -0,0 +1,206 @@
+"""
+Rolling-window local store of the ocean fields
+
+One store per product and sea area, STORE_PATH/<SEA_AREA>/<PRODUCT_ID>/, with the
+fields of every dataset split in daily NetCDF chunks along time:
+    <dataset_id>/<YYYYMMDD>.nc
+and a store.json with the footprint (bbox, depth range) of the chunks. An
+ingestion fetches only the days of START_*..END_* missing from the store (one
+request per run of consecutive days and dataset, in the download thread pool)
+and evicts the days older than STORE_RETENTION_DAYS before END_*. A change of
+footprint not covered by the store empties it. interpolate_data reads the chunks
+around the release time straight from the store.
+"""
+import os
+import json
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import xarray as xr
+
+from src.download.manifest import DataRequest, contains
+from src.utils.datasetInterface import get_data_interface
+from src.utils.utils import print_ntime
+
+
+STORE_FILE = 'store.json'
+
+DAY = timedelta(days=1)
+
+
+def _day(time):
+    return datetime(time.year, time.month, time.day)
+
+
+def _runs(days):
+    # runs of consecutive days, as (first, last)
+    runs = []
+    for day in sorted(days):
+        if runs and day - runs[-1][1] == DAY:
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return [tuple(run) for run in runs]
+
+
+class TimeSeriesStore:
+    """
+    Daily chunks of the datasets of one product in a sea area.
+
+    Usage example:
+
+        >>> store = TimeSeriesStore.from_namelist(ambient_namelist, static_paths)
+        >>> store.ingest(bbox, depth_range, start_date, end_date, retention=10)
+        >>> store.path('so', start_date)
+    """
+    def __init__(self, root, product_id, sea_area):
+        self.product_id = product_id
+        self.directory = os.path.join(root, sea_area, product_id)
+        self.datasets = {dataset_id: variables for datasets in get_data_interface(product_id).values()
+                         for dataset_id, variables in datasets.items()}
+        os.makedirs(self.directory, exist_ok=True)
+        self.info = {}
+        if os.path.exists(os.path.join(self.directory, STORE_FILE)):
+            with open(os.path.join(self.directory, STORE_FILE)) as fin:
+                self.info = json.load(fin)
+
+    @classmethod
+    def from_namelist(cls, ambient_namelist, static_paths):
+        root = static_paths.get('STORE_PATH') or os.path.join(static_paths['INPUT_FILES'], 'store')
+        return cls(root, ambient_namelist['PRODUCT_ID'], ambient_namelist['SEA_AREA'])
+
+    def _write_info(self):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.store', suffix='.tmp')
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(self.info, fout, indent=1)
+        os.replace(tmp, os.path.join(self.directory, STORE_FILE))
+
+    def dataset_of(self, variable):
+        for dataset_id, variables in self.datasets.items():
+            if variable in variables:
+                return dataset_id
+        raise KeyError(f'No dataset of {self.product_id} with the variable {variable}')
+
+    def days(self, dataset_id):
+        directory = os.path.join(self.directory, dataset_id)
+        if not os.path.isdir(directory):
+            return set()
+        return {datetime.strptime(fname[:8], '%Y%m%d') for fname in os.listdir(directory)
+                if fname.endswith('.nc') and fname[:8].isdigit()}
+
+    def path(self, variable, time):
+        """
+        The daily chunk with the variable at the day of time.
+        """
+        dataset_id = self.dataset_of(variable)
+        path = os.path.join(self.directory, dataset_id, f'{_day(time):%Y%m%d}.nc')
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'{time:%Y-%m-%d} of {dataset_id} is not in the store {self.directory}')
+        return path
+
+    def paths(self, variable, start, end):
+        """
+        The tuple of the daily chunks with the variable from the day of start to the day of end
+        (the days missing from the store are skipped, at least the one of start is needed).
+        """
+        first = self.path(variable, start)
+        dataset_id = self.dataset_of(variable)
+        paths = [first]
+        day = _day(start) + DAY
+        while day <= end:
+            path = os.path.join(self.directory, dataset_id, f'{day:%Y%m%d}.nc')
+            if os.path.exists(path):
+                paths.append(path)
+            day += DAY
+        return tuple(paths)
+
+    def covers(self, bbox, depth_range):
+        if 'bbox' not in self.info:
+            return False
+        return (contains(self.info['bbox'][:2], bbox[:2]) and contains(self.info['bbox'][2:], bbox[2:])
+                and contains(self.info['depth_range'], depth_range))
+
+    def clear(self):
+        for dataset_id in self.datasets:
+            shutil.rmtree(os.path.join(self.directory, dataset_id), ignore_errors=True)
+        self.info = {}
+
+    def evict(self, before):
+        """
+        Remove the daily chunks older than the day `before`.
+        """
+        removed = 0
+        for dataset_id in self.datasets:
+            for day in self.days(dataset_id):
+                if day < _day(before):
+                    os.remove(os.path.join(self.directory, dataset_id, f'{day:%Y%m%d}.nc'))
+                    removed += 1
+        return removed
+
+    def _split(self, dataset_id, path):
+        # daily chunks of a downloaded file, each written aside and renamed
+        directory = os.path.join(self.directory, dataset_id)
+        os.makedirs(directory, exist_ok=True)
+        with xr.open_dataset(path) as ds:
+            for k, time in enumerate(ds['time'].values.astype('datetime64[s]').tolist()):
+                chunk = os.path.join(directory, f'{_day(time):%Y%m%d}.nc')
+                ds.isel(time=[k]).load().to_netcdf(chunk + '.tmp', unlimited_dims=['time'])
+                os.replace(chunk + '.tmp', chunk)
+
+    def ingest(self, bbox, depth_range, start_date, end_date, retention=None, client=None, max_workers=3):
+        """
+        Fetch the days of start_date..end_date missing from the store and evict the days
+        older than `retention` days before end_date. Returns the number of requests made.
+        """
+        from src.download.downloadOceanData import subset
+        if client is None:
+            import copernicusmarine as client
+
+        bbox, depth_range = tuple(float(val) for val in bbox), tuple(float(val) for val in depth_range)
+        if self.info and not self.covers(bbox, depth_range):
+            print_ntime(f'[WARNING] The footprint changed, emptying the store {self.directory}')
+            self.clear()
+        if not self.info:
+            self.info = {'bbox': list(bbox), 'depth_range': list(depth_range)}
+            self._write_info()
+        else:
+            bbox, depth_range = tuple(self.info['bbox']), tuple(self.info['depth_range'])
+
+        if retention is not None:
+            first_kept = _day(end_date) - (int(retention) - 1) * DAY
+            if self.evict(first_kept):
+                print_ntime(f'Evicted the days before {first_kept:%Y-%m-%d} from {self.directory}')
+            start_date = max(start_date, first_kept)
+
+        wanted = set()
+        day = _day(start_date)
+        while day <= end_date:
+            wanted.add(day)
+            day += DAY
+
+        todo = [DataRequest(dataset_id, variables, bbox, run, depth_range)
+                for dataset_id, variables in self.datasets.items()
+                for run in _runs(wanted - self.days(dataset_id))]
+        if not todo:
+            print_ntime(f'All the days are already in the store {self.directory}.')
+            return 0
+
+        with tempfile.TemporaryDirectory(dir=self.directory) as tmp:
+            errors = []
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as pool:
+                futures = {pool.submit(subset, client, request, tmp): request for request in todo}
+                for future in as_completed(futures):
+                    request = futures[future]
+                    try:
+                        # the chunks are written in this thread, one file at a time
+                        self._split(request.dataset_id, os.path.join(tmp, future.result()))
+                        print_ntime(f'Stored {request.dataset_id} '
+                                    f'{request.time_range[0]:%Y-%m-%d}..{request.time_range[1]:%Y-%m-%d}')
+                    except Exception as e:
+                        errors.append(request)
+                        print_ntime(f'[ERROR] ingesting {request.dataset_id} {request.variables}:\n{str(e)}')
+            if errors:
+                raise RuntimeError(f'{len(errors)} of {len(todo)} ingestions failed.')
+        return len(todo)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo uncertainty analysis of the plume
+
+The release parameters (b0, w0, T0, rho_oil_0) and the ambient profiles
+(uo, vo, thetao, so) are perturbed with the distributions of
+namelist/MonteCarlo.yaml, and the members are integrated in batches by the
+vectorized ensemble solver. Every batch is interpolated on a common depth or
+time axis and folded into online statistics (Welford moments and histogram
+quantile sketches), so the memory doesn't grow with the number of members.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.plume import plume
+from src.preproc.ambientProfile import AmbientProfile
+from src.solver.ensemble import plume_ensemble, RELEASE_KEYS, AMBIENT_OFFSET_KEYS
+from src.solver.jitKernel import B
+from src.utils.logging import write_namelists
+from src.utils.onlineStats import RunningMoments, HistogramSketch
+from src.utils.output_db import compute_and_save_product_summary
+from src.utils.plumeOutput import write_table
+from src.utils.utils import print_ntime
+
+
+DISTRIBUTIONS = ('normal', 'uniform')
+
+# Release parameters that must stay positive: perturbed values are clipped at 1% of the namelist value
+POSITIVE_KEYS = ('b0', 'w0', 'rho_oil_0')
+
+# Quantities interpolated on the common axis
+AXIS_QUANTITIES = {'depth': ('x', 'y', 'Radius', 'Time [min]'),
+                   'time': ('x', 'y', 'z', 'Radius')}
+AXIS_NAMES = {'depth': 'z [m]', 'time': 'Time [min]'}
+
+# Events of every member
+EVENTS = ('neu_buoy', 't_neu_buoy', 'max_height', 't_max_height')
+
+
+def sample_perturbations(perturbations, n, rng):
+    """
+    Draw n offsets for every perturbed parameter.
+    perturbations: dict {parameter: 'none' or [distribution, a, b]} (normal: mean, std; uniform: low, high)
+    """
+    offsets = {}
+    for key, spec in perturbations.items():
+        if isinstance(spec, str) and spec == 'none':
+            continue
+        distribution, a, b = spec[0], float(spec[1]), float(spec[2])
+        if distribution == 'normal':
+            offsets[key] = rng.normal(a, b, n)
+        elif distribution == 'uniform':
+            offsets[key] = rng.uniform(a, b, n)
+        else:
+            raise ValueError(f'Unrecognized distribution for {key}: {distribution}')
+    return offsets
+
+
+class AxisSampler:
+    """
+    Linear interpolation of the member trajectories on the common axis nodes (a0 + k*step),
+    filled on the fly by the on_step callback of the ensemble solver.
+    """
+    def __init__(self, n, nodes, axis):
+        self.nodes = nodes
+        self.a0 = nodes[0]
+        self.step = nodes[1] - nodes[0]
+        self.axis = axis
+        self.values = np.full((n, len(nodes), len(AXIS_QUANTITIES[axis])), np.nan)
+        self.prev_a = np.full(n, np.nan)
+        self.prev_v = np.full((n, len(AXIS_QUANTITIES[axis])), np.nan)
+
+    def __call__(self, time, idx, state, P):
+        x, y, z, b = state[:, 5], state[:, 6], state[:, 7], P[B]
+        times = np.full(idx.size, time)
+        if self.axis == 'depth':
+            a, v = z, np.column_stack([x, y, b, times])
+        else:
+            a, v = times, np.column_stack([x, y, z, b])
+
+        a_prev, v_prev = self.prev_a[idx], self.prev_v[idx]
+        released = np.isnan(a_prev)
+        # members at their release: the node at the release point, if any
+        a_prev = np.where(released, a - 1e-9 * self.step, a_prev)
+        v_prev = np.where(released[:, None], v, v_prev)
+
+        k_first = np.floor((a_prev - self.a0) / self.step).astype(int) + 1
+        k_last = np.floor((a - self.a0) / self.step).astype(int)
+        for j in range(max(int(np.max(k_last - k_first)) + 1, 0)):
+            k = k_first + j
+            sel = (k <= k_last) & (k >= 0) & (k < len(self.nodes))
+            frac = ((self.nodes[k[sel]] - a_prev[sel]) / (a[sel] - a_prev[sel]))[:, None]
+            self.values[idx[sel], k[sel]] = v_prev[sel] + frac * (v[sel] - v_prev[sel])
+
+        self.prev_a[idx] = a
+        self.prev_v[idx] = v
+
+
+def monte_carlo(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, constants, mc_namelist,
+                profile=None):
+    """
+    Nominal plume() run plus the Monte Carlo statistics, written in exp_dir (in the output format) as:
+        monteCarloEnvelopes: count, mean, std and percentiles of the trajectory and radius on the common axis
+        monteCarloEvents:    count, mean, std and percentiles of neutral buoyancy and maximum height
+    The event statistics are added to summary.json by compute_metrics.
+    profile: the AmbientProfile returned by interpolate_data, read from exp_dir if None
+    """
+    write_namelists(exp_dir, {'MonteCarlo': mc_namelist})
+
+    # # Nominal run
+    if profile is None:
+        profile = AmbientProfile.from_run(exp_dir, sea_area=ambient_namelist['SEA_AREA'])
+    plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, constants, profile=profile)
+
+    rng = np.random.default_rng(mc_namelist.seed)
+    n_members, batch_size = mc_namelist.n_members, mc_namelist.batch_size
+    axis, step = mc_namelist.axis, float(mc_namelist.axis_step)
+    percentiles = np.atleast_1d(mc_namelist.percentiles).astype(float)
+    q = percentiles / 100.
+
+    if axis == 'depth':
+        nodes = np.arange(float(release_namelist.z0), 0., step)
+    elif axis == 'time':
+        nodes = np.arange(0., numerical_namelist.time_max + step / 2, step)
+    else:
+        raise ValueError(f'Unrecognized Monte Carlo axis: {axis}')
+    quantities = AXIS_QUANTITIES[axis]
+
+    moments = {name: RunningMoments(len(nodes)) for name in quantities}
+    sketches = {name: HistogramSketch(len(nodes), mc_namelist.sketch_bins) for name in quantities}
+    event_moments = {name: RunningMoments(1) for name in EVENTS}
+    event_sketches = {name: HistogramSketch(1, mc_namelist.sketch_bins) for name in EVENTS}
+
+    print_ntime(f'Monte Carlo: {n_members} members in batches of {batch_size}, {axis} axis with {len(nodes)} levels')
+    for first in range(0, n_members, batch_size):
+        n = min(batch_size, n_members - first)
+        offsets = sample_perturbations(mc_namelist.perturbations, n, rng)
+
+        members = {}
+        for key in set(offsets) & set(RELEASE_KEYS):
+            value = release_namelist[key] + offsets[key]
+            if key in POSITIVE_KEYS:
+                value = np.maximum(value, 0.01 * release_namelist[key])
+            members[key] = value
+        ambient_offsets = {key: offsets[key] for key in set(offsets) & set(AMBIENT_OFFSET_KEYS)}
+        if not members:
+            members = {'z0': np.full(n, float(release_namelist.z0))}
+
+        sampler = AxisSampler(n, nodes, axis)
+        result = plume_ensemble(profile, numerical_namelist, release_namelist, constants, members=members,
+                                ambient_offsets=ambient_offsets, on_step=sampler)
+
+        for k, name in enumerate(quantities):
+            moments[name].update(sampler.values[:, :, k])
+            sketches[name].update(sampler.values[:, :, k])
+        for name in EVENTS:
+            values = getattr(result, name)[:, None]
+            event_moments[name].update(values)
+            event_sketches[name].update(values)
+        print_ntime(f'Monte Carlo members {first + n}/{n_members} done.')
+
+    # # # PRINT OUTPUT
+
+    pcols = [f'p{p:g}' for p in percentiles]
+    envelopes = pd.DataFrame({AXIS_NAMES[axis]: nodes, 'count': moments[quantities[0]].count})
+    for name in quantities:
+        envelopes[f'{name} mean'] = moments[name].mean
+        envelopes[f'{name} std'] = moments[name].std
+        for pcol, values in zip(pcols, sketches[name].quantile(q)):
+            envelopes[f'{name} {pcol}'] = values
+    envelopes = envelopes[envelopes['count'] > 0]
+    write_table(envelopes, exp_dir, 'monteCarloEnvelopes', numerical_namelist.output_format)
+
+    events = pd.DataFrame(index=pd.Index(EVENTS, name='event'))
+    events['count'] = [event_moments[name].count[0] for name in EVENTS]
+    events['mean'] = [event_moments[name].mean[0] for name in EVENTS]
+    events['std'] = [event_moments[name].std[0] for name in EVENTS]
+    for k, pcol in enumerate(pcols):
+        events[pcol] = [event_sketches[name].quantile(q)[k, 0] for name in EVENTS]
+    write_table(events.reset_index(), exp_dir, 'monteCarloEvents', numerical_namelist.output_format)
+
+    compute_and_save_product_summary(exp_dir, runId, numerical_namelist, release_namelist, ambient_namelist)
+
+    return envelopes, events
@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from src.utils.output_db import compute_and_save_product_summary
+from src.utils.output_db import compute_and_save_product_summary, product_summary
+from src.utils.trajectoryRecorder import TrajectoryRecorder, PlumeResult, PLUME_STATE_COLUMNS, PARAMETERS_COLUMNS
 from src.utils.utils import print_ntime, tqdm_green
+from src.preproc.ambientProfile import AmbientProfile, TimeVaryingProfile, TIME_PROFILES_FILE, read_profiles
+from src.solver.jitKernel import select_backend, integrate_jit
+from src.solver.adaptive import dopri5_step, rosenbrock_step, fd_jacobian, error_norm, next_step, locate_event
+from src.solver.ensemble import plume_ensemble, MEMBER_COLUMN
+from src.utils.densityTable import DensityTable
+from src.utils.plumeOutput import write_table, check_output_format, ChunkedTableWriter
+from src.utils.outputDecimation import DecimatedOutput, check_output_mode
+from src.utils.checkpoint import Checkpointer, read_checkpoint, remove_checkpoint
 
 '''
 Created on Thu Jul 22 17:12:41 2021
@@ -22,33 +31,27 @@ Ocean input variables are currents, temperature and salinity (from Copernicus Se
 from src.__functions import *
 
 
-def plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, constants):
+def plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, constants, density_table=None,
+          restart=False, profile=None, write=True):
+    '''
+    Plume simulation of the run exp_dir. Returns the PlumeResult (tables, events and summary of the run).
+    profile: the AmbientProfile returned by interpolate_data, read from exp_dir if None
+    write:   write the output tables and summary.json in exp_dir (with False the run stays in memory,
+             without chunked output nor checkpoints)
+    '''
 
     # # # Read ocean data vertical profiles # # #
-    df = pd.read_csv('{}oceanProfilesInput.csv'.format(os.path.join(exp_dir + '/')))
-    depth=df['depth']
-    thetao=df['thetao']
-    so=df['so']
-    rhoa=df['rhoa']
-    
-
-    if ambient_namelist['SEA_AREA']=='NORTHSEA':
-         uo=df['uo']*np.cos(np.pi/2) - df['vo']*np.sin(np.pi/2)
-         vo=df['uo']*np.sin(np.pi/2) - df['vo']*np.cos(np.pi/2)
+    if profile is None:
+        # u, v, T, S, rhoa on the depth levels of the input file (or profile cache entry), linearly interpolated in depth
+        profile = AmbientProfile.from_run(exp_dir, sea_area=ambient_namelist['SEA_AREA'])
+        # profiles at the times of the ocean fields, following the plume time (TIME_VARYING)
+        time_profiles = read_profiles(exp_dir, TIME_PROFILES_FILE) if ambient_namelist.get('TIME_VARYING', False) else None
+        if time_profiles is not None:
+            profile = TimeVaryingProfile.from_dataframe(time_profiles, sea_area=ambient_namelist['SEA_AREA'],
+                                                        refresh=ambient_namelist.get('PROFILE_REFRESH', 1.))
     else:
-        uo=df['uo']
-        vo=df['vo']
-         
-
-    # Interpolation of temperature, salinity, density in depth
-
-    f_uo = interp1d(depth, uo)
-    f_vo = interp1d(depth, vo)
-    f_thetao = interp1d(depth, thetao)
-    f_so = interp1d(depth, so)
-    f_rhoa = interp1d(depth, rhoa)
-
-         
+        # the profile of a previous run (e.g. the realizations of a Monte Carlo) starts again from the release
+        profile.reset()
 
     # Natural constants
     
@@ -56,11 +59,11 @@ def plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist
     c_T=constants.c_T
     ca=constants.c_a
 
-    p = {'g': g, 'c_T': c_T, 'ca': ca}
+    p = PlumeParams(g=g, c_T=c_T, ca=ca)
 
-    p['total_entrain'] = numerical_namelist['entrain_params']['total_entrain']  # if 0 max(Qs,Qf); if 1 sum(Qs,Qf)
+    p.total_entrain = numerical_namelist['entrain_params']['total_entrain']  # if 0 max(Qs,Qf); if 1 sum(Qs,Qf)
     for a in ['a1', 'a2', 'a3']:
-        p[a] = numerical_namelist['entrain_params'][a]
+        setattr(p, a, numerical_namelist['entrain_params'][a])
 
     max_height = None
     neu_buoy = None
@@ -73,6 +76,50 @@ def plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist
     dt = numerical_namelist.dt  # or dt=10*p['b']/p['V']
     # total number of generated cylinders
     ncyl = numerical_namelist.ncyl
+    # solver backend: 'python' or 'numba' (JIT-compiled time loop)
+    backend = select_backend(numerical_namelist.backend)
+    # format of the output tables: 'csv', 'parquet' or 'netcdf'
+    check_output_format(numerical_namelist.output_format)
+    # rows per chunk written during the run (0: tables written at the end of the run)
+    chunk = numerical_namelist.output_chunk
+    # recorded rows: every k-th time-step ('steps'), 'interval' or 'depths' (the event rows are always kept)
+    decimate = check_output_mode(numerical_namelist)
+    # time integrator: 'rk4' (fixed dt), 'dopri5' or 'rosenbrock' (adaptive, python backend only)
+    integrator = numerical_namelist.integrator
+    if integrator not in ('rk4', 'dopri5', 'rosenbrock'):
+        raise ValueError(f'Unrecognized integrator: {integrator}')
+    if numerical_namelist.jacobian not in ('analytic', 'fd'):
+        raise ValueError(f'Unrecognized Jacobian: {numerical_namelist.jacobian}')
+    if integrator != 'rk4' and backend == 'numba':
+        if numerical_namelist.backend == 'numba':
+            print_ntime(f'[WARNING] the {integrator} integrator is not available with numba, using the python backend.')
+        backend = 'python'
+    # entrainment of the rk4 stages: 'fused' (once per step) or 'consistent' (evaluated at every stage)
+    rk4_mode = numerical_namelist.rk4_mode
+    if rk4_mode not in RK4_MODES:
+        raise ValueError(f'Unrecognized rk4 mode: {rk4_mode}')
+    if rk4_mode == 'consistent' and backend == 'numba':
+        if numerical_namelist.backend == 'numba':
+            print_ntime('[WARNING] the consistent rk4 mode is not available with numba, using the python backend.')
+        backend = 'python'
+    # checkpoints of the solver every checkpoint_every time-steps (0: none), the tables are then streamed to disk
+    checkpoint_every = numerical_namelist.checkpoint_every
+    if checkpoint_every and integrator != 'rk4':
+        print_ntime(f'[WARNING] checkpoints are not available with the {integrator} integrator.')
+        checkpoint_every = 0
+    if (chunk or checkpoint_every or restart) and not write:
+        print_ntime('[WARNING] chunked output, checkpoints and restarts need the output files (write=False).')
+        chunk, checkpoint_every, restart = 0, 0, False
+    if checkpoint_every and not chunk:
+        chunk = checkpoint_every
+    namelists = {'ambient': ambient_namelist, 'numerical': numerical_namelist, 'release': release_namelist,
+                 'constants': constants}
+    checkpoint = read_checkpoint(exp_dir) if restart else None
+    if restart:
+        if checkpoint is None:
+            print_ntime(f'[WARNING] no checkpoint in {exp_dir}, the run starts from the beginning.')
+        else:
+            print_ntime(f'Restart from the checkpoint at time-step {checkpoint["next_step"]}')
 
     # SET THE INITIAL CONDITIONS
 
@@ -95,7 +142,28 @@ def plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist
     rho_oil_0 = release_namelist.rho_oil_0
     T_oil_0 = release_namelist.T_oil_0
 
-
+    # Seawater density tabulated over the (S,T) envelope of the run (optional, always used by the numba backend)
+    if density_table is None:
+        if numerical_namelist.density_table:
+            density_table = DensityTable.for_run(profile, S0, T0, n=numerical_namelist.density_table_size,
+                                                 method=numerical_namelist.density_table_method)
+        elif backend == 'numba':
+            density_table = DensityTable.for_run(profile, S0, T0, n=201, method='bicubic')
+    print_ntime(f'Solver backend: {backend}, seawater density from '
+                + (f'a {density_table.n}x{density_table.n} {density_table.method} table' if density_table is not None
+                   else 'gsw'))
+
+    # Continuous release: one cylinder per time-step, the released cylinders are advanced together
+    if ncyl > 1:
+        if integrator != 'rk4' or backend == 'numba' or rk4_mode != 'fused':
+            print_ntime('[WARNING] continuous release (ncyl > 1) uses the vectorized rk4 solver (fused mode).')
+        result = continuous_release(exp_dir, profile, ncyl, numerical_namelist, release_namelist, constants,
+                                    density_table, chunk=chunk, checkpoint_every=checkpoint_every,
+                                    namelists=namelists, checkpoint=checkpoint, write=write)
+        return _finish_run(result, exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, write)
+
+
+    result = PlumeResult()
 
     # A cylinder is generated (just one for instantaneous release)
     for cyl in range (0, ncyl): #range(0,tmax)
@@ -104,170 +172,478 @@ def plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist
         tmax = int(time_max*60/dt)
 
         # Other plume parameters initialization
-        p['h'] = w0*dt
-        p['u'], p['v'] = u0, v0
-        p['b'], p['bb'] =  b0, b0
-        p['v_0'], p['v_0b'] = np.sqrt(u0**2 + v0**2 + w0**2), np.sqrt(u0**2 + v0**2 + w0**2)
-        p['ds'] = p['v_0'] *dt
-        p['v_phi'], p['v_phib'] = np.arcsin(w0/p['v_0']), np.arcsin(w0/p['v_0'])
-        p['v_theta'], p['v_thetab'] = np.arctan2(v0,u0), np.arctan2(v0,u0)
+        p.h = w0*dt
+        p.u, p.v = u0, v0
+        p.b, p.bb =  b0, b0
+        p.v_0, p.v_0b = np.sqrt(u0**2 + v0**2 + w0**2), np.sqrt(u0**2 + v0**2 + w0**2)
+        p.ds = p.v_0 *dt
+        p.v_phi, p.v_phib = np.arcsin(w0/p.v_0), np.arcsin(w0/p.v_0)
+        p.v_theta, p.v_thetab = np.arctan2(v0,u0), np.arctan2(v0,u0)
 
         # Ambient parameters initialization : temperature, salinity, density, zonal and meridional currents
-        p['Ta'], p['Sa'], p['rhoa'], p['rhoa_0'] = float(f_thetao(z0)), float(f_so(z0)), float(f_rhoa(z0)), float(f_rhoa(z0))
-        p['ua'], p['va'] = float(f_uo(z0)), float(f_vo(z0))
+        p.ua, p.va, p.Ta, p.Sa, p.rhoa = profile.sample(z0)
+        p.rhoa_0 = p.rhoa
 
         # Oil and plume density, reduced gravity
-        p['rho_oil'] = rho_oil_0 * (1 - p['c_T'] * (T0 - T_oil_0 ))
-        p['rho_w'] = gsw.density.rho(S0,T0,1)
-        p['rho'] = p['rho_oil'] * p['rho_w'] / (p['rho_w'] * c0 + p['rho_oil'] * (1 - c0))
-        p['g1'] = reduced_g(p)
+        p.rho_oil = rho_oil_0 * (1 - p.c_T * (T0 - T_oil_0 ))
+        p.rho_w = density_table.rho(S0,T0) if density_table is not None else gsw.density.rho(S0,T0,1)
+        p.rho = p.rho_oil * p.rho_w / (p.rho_w * c0 + p.rho_oil * (1 - c0))
+        p.g1 = reduced_g_fast(p)
 
         # Entrainment first computation
-        p['alpha'] = entrain_coeff_yapa(p)
-        Qs = shear_entrain_yapa(p)
-        Qf = forced_entrain_yapa(p)
-        if p['total_entrain'] == 0:
-                    Qe = max(Qs,Qf)
-        elif p['total_entrain'] == 1:
-                    Qe = Qs + Qf
+        p.alpha = entrain_coeff_yapa_fast(p)
+        Qs = shear_entrain_yapa_fast(p)
+        Qf = forced_entrain_yapa_fast(p)
+        Qe = total_entrain_fast(p, Qs, Qf)
         
         
 
         # Cylinder mass initialization
-        m0 = p['rho_oil']* np.pi * p['b']**2 * p['h']
-        oil_volume0 = m0/p['rho_oil']
+        m0 = p.rho_oil* np.pi * p.b**2 * p.h
+        oil_volume0 = m0/p.rho_oil
         oil_volume=round(oil_volume0*(tmax))
 
         # Plume 'before' state initialization
         plume_state_b = np.array([m0, u0*m0, v0*m0, w0*m0, c0*m0, x0, y0, z0, T0*m0, S0*m0])
 
-        Flag1 = True
-        Flag2 = True
+        Fd2=p.v_0**2/(2*p.g1*p.b)
 
-        Fd2=p['v_0']**2/(2*p['g1']*p['b'])
 
-
-        outdata = np.array([0., m0, u0, p['v_0'], c0, p['rho'],p['rhoa_0'], p['h'], p['b'], x0, y0, z0])
-        paramdata = np.array([0., p['alpha'], proj_vel(p), p['v_0'], p['rhoa_0'], Qs, Qf, Qe, p['v_phi'], p['g1'],Fd2 ])
+        # Output buffers, grown by doubling instead of stacking at every time-step,
+        # or streamed to disk chunk by chunk (from the checkpoint offsets on a restart)
+        if chunk:
+            offsets = checkpoint['offsets'] if checkpoint is not None else (None, None)
+            outdata = ChunkedTableWriter(exp_dir, 'plumeState', PLUME_STATE_COLUMNS,
+                                         numerical_namelist.output_format, chunk, resume=offsets[0])
+            paramdata = ChunkedTableWriter(exp_dir, 'parameters', PARAMETERS_COLUMNS,
+                                           numerical_namelist.output_format, chunk, resume=offsets[1])
+        else:
+            outdata = TrajectoryRecorder(PLUME_STATE_COLUMNS)
+            paramdata = TrajectoryRecorder(PARAMETERS_COLUMNS)
+        output = None
+        if decimate:
+            output = DecimatedOutput.from_namelist(numerical_namelist, outdata, paramdata)
+            recorders = output.outdata, output.paramdata
+        else:
+            recorders = outdata, paramdata
+
+        checkpointer = None
+        if checkpoint_every:
+            checkpointer = Checkpointer(exp_dir, checkpoint_every, namelists, (outdata, paramdata), output)
+
+        # Restart: solver state and output selection of the checkpoint
+        start, resume = cyl, None
+        if checkpoint is not None:
+            resume = checkpoint['solver']
+            start, p, plume_state_b = checkpoint['next_step'], resume['p'], resume['state']
+            if output is not None:
+                output.set_state(checkpoint['output'])
+        else:
+            recorders[0].append([0., m0, u0, p.v_0, c0, p.rho,p.rhoa_0, p.h, p.b, x0, y0, z0])
+            recorders[1].append([0., p.alpha, proj_vel_fast(p), p.v_0, p.rhoa_0, Qs, Qf, Qe, p.v_phi, p.g1,Fd2 ])
 
 
         # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
         # # TIME-EVOLUTION STARTS
 
-        for t in tqdm_green(range(0,tmax)):
-
-            if t < cyl:
-            # the cylinder is not yet released
-                outdata1=np.array([(t+1)*dt/60., m0, u0, p['v_0'], c0, p['rho'],p['rhoa_0'], p['h'], p['b'], x0, y0, z0])
-
-            else:
-            # the cylinder is released
-
-                # UPDATE PLUME : NEW STATE = BEFORE STATE + STATE VARIATION
-
-                plume_state_n = plume_state_b + RK4(model,p,plume_state_b,dt)
-
-                # Retrieve plume state variables
-
-                m = plume_state_n[0]
-                u,v,w = plume_state_n[1]/plume_state_n[0], plume_state_n[2]/plume_state_n[0], plume_state_n[3]/plume_state_n[0]
-                c = plume_state_n[4]/plume_state_n[0]
-                x,y,z = plume_state_n[5], plume_state_n[6], plume_state_n[7]
-                T,S = plume_state_n[8]/plume_state_n[0], plume_state_n[9]/plume_state_n[0]
-
-
-                # Update ambient ocean data at the cylinder depth 
-
-                if z < 0 :
-                    p['Ta'],p['Sa'] = float(f_thetao(z)), float(f_so(z))
-                    p['rhoa']=  float(f_rhoa(z))
-                    p['ua']=float(f_uo(z))
-                    p['va']=float(f_vo(z))
-                else :
-                    break
-
-
-                # Update all remaining parameters
-
-                p['c'] = c
-                p['rho_oil'] = rho_oil_0 * (1 - p['c_T'] * (T - T_oil_0))
-                p['rho_w'] = gsw.density.rho(S,T,1)
-                p['rho'] =  p['rho_oil']* p['rho_w'] / (p['rho_oil']*(1-c) + p['rho_w']*c)
-                p['g1']= reduced_g(p)
+        if integrator in ('dopri5', 'rosenbrock'):
+            z, nb, mh = integrate_adaptive(p, plume_state_b, cyl, tmax, dt, profile, density_table,
+                                           rho_oil_0, T_oil_0, *recorders,
+                                           numerical_namelist.rtol, numerical_namelist.atol, numerical_namelist.dt_max,
+                                           method=integrator, jacobian=numerical_namelist.jacobian)
+        elif backend == 'numba':
+            z, nb, mh = integrate_jit(p, plume_state_b, start, tmax, dt, profile, density_table,
+                                      rho_oil_0, T_oil_0, *recorders, window=chunk or None,
+                                      checkpoint=checkpointer, resume=resume)
+        else:
+            z, nb, mh = integrate_python(p, plume_state_b, start, tmax, dt, profile, density_table,
+                                         rho_oil_0, T_oil_0, *recorders, checkpoint=checkpointer, resume=resume,
+                                         rk4_mode=rk4_mode)
 
-                p['u']= u
-                p['v']= v
-                p['alpha']=entrain_coeff_yapa(p)
+        if nb is not None:
+            neu_buoy = nb
+        if mh is not None:
+            max_height = mh
+        result.final_z, result.neu_buoy, result.max_height = z, neu_buoy, max_height
 
-                p['v_0b']=p['v_0']
-                p['v_0'] = np.sqrt(u**2 + v**2 + w**2)
+        if z < -1:
+            surfacing = False
+            final_state = 'subsurface'
+        else:
+            final_state = 'surface'
 
-                p['ds'] = np.sqrt((x-plume_state_b[5])**2 +(y-plume_state_b[6])**2+(z-plume_state_b[7])**2)
-                p['h']= np.abs(p['v_0']/p['v_0b'] * p['h'])
 
-                p['bb']=p['b']
-                p['b']=np.sqrt(m/(p['rho']*np.pi*p['h']))
 
-                p['v_thetab']=p['v_theta']
-                p['v_theta']=np.arctan2(v,u)
-                p['v_phib']=p['v_phi']
-                p['v_phi']=np.arcsin(w/p['v_0'])
+        # # # PRINT OUTPUT
 
-                Fd2=p['v_0']**2/(2*p['g1']*p['b'])
+        if output is not None:
+            output.close()
 
-                Qs = shear_entrain_yapa(p)
-                Qf = forced_entrain_yapa(p)
+        if chunk:
+            outdata.close()
+            paramdata.close()
+            continue
 
-                if p['total_entrain'] == 0:
-                    Qe = max(Qs,Qf)
-                elif p['total_entrain'] == 1:
-                    Qe = Qs + Qf
+        outdata.trim()
+        paramdata.trim()
 
+        # the tables stay in memory for the render and metrics stages, the files are an optional sink
+        result.tables['plumeState'] = plume_data = outdata.to_dataframe()
+        result.tables['parameters'] = parameters = paramdata.to_dataframe()
+        if write:
+            write_table(plume_data, exp_dir, 'plumeState', numerical_namelist.output_format)
+            write_table(parameters, exp_dir, 'parameters', numerical_namelist.output_format)
 
-                # Update the 'before' state
 
-                plume_state_b = plume_state_n
+    return _finish_run(result, exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, write)
 
-                # When density is equal to ocean density, find neutral buoyancy
-                if p['g1'] <= 0. and Flag1 :   #0.215 for max
-                    Flag1=False
-                    neu_buoy=z
-                    print('Neutral buoyancy at depth {} m and time {} mins.'.format(z,(t+1)*dt/60 ))
 
-                # When velocity intensity lowers below a threshold, find maximum height
-                if (p['alpha'] < -5. or w<0.001) and Flag2 :
-                    Flag2 = False
-                    max_height=z
-                    print('Maximum height at depth {} m and time {} mins.'.format(z,(t+1)*dt/60 ))
-                    break   
+def _finish_run(result, exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, write):
+    # summary of the run (summary.json with write), checkpoint of the finished run removed
+    if write:
+        result.summary = compute_and_save_product_summary(exp_dir, runId, numerical_namelist, release_namelist,
+                                                          ambient_namelist, result=result)
+        remove_checkpoint(exp_dir)
+    else:
+        result.summary = product_summary(exp_dir, runId, numerical_namelist, release_namelist, ambient_namelist,
+                                         result=result)
+    return result
+
+
+def restart_plume(exp_dir, runId):
+    '''
+    Continue the plume run of exp_dir from its last checkpoint, with the namelists saved in it.
+    '''
+    checkpoint = read_checkpoint(exp_dir)
+    if checkpoint is None:
+        raise FileNotFoundError(f'No checkpoint in {exp_dir}')
+    namelists = checkpoint['namelists']
+    return plume(exp_dir, runId, namelists['ambient'], namelists['numerical'], namelists['release'],
+                 namelists['constants'], restart=True)
+
+
+def continuous_release(exp_dir, profile, ncyl, numerical_namelist, release_namelist, constants, density_table,
+                       chunk=0, checkpoint_every=0, namelists=None, checkpoint=None, write=True):
+    '''
+    Continuous release of ncyl cylinders, cylinder k released at time-step k.
+    All the released cylinders are advanced together by the vectorized ensemble solver;
+    plumeState and parameters hold the history of every cylinder, keyed by the
+    last column 'Cylinder', in the order of the time-steps (the active cylinders by release
+    at every time-step; with a decimated output, the last rows of the cylinders come at the end),
+    written at the end of the run or streamed to disk during it with chunk > 0.
+    Readers of one cylinder select its rows by 'Cylinder' (and sort them by time).
+    With checkpoint_every, the solver state is saved every checkpoint_every time-steps
+    (chunk must be > 0); checkpoint is the checkpoint dict to restart from.
+    Returns the PlumeResult, with the events of every cylinder; the tables are written with write.
+    '''
+    print_ntime(f'Continuous release of {ncyl} cylinders')
+    fmt = numerical_namelist.output_format
+    if chunk:
+        offsets = checkpoint['offsets'] if checkpoint is not None else (None, None)
+        sinks = (ChunkedTableWriter(exp_dir, 'plumeState', PLUME_STATE_COLUMNS + ['Cylinder'], fmt, chunk,
+                                    resume=offsets[0]),
+                 ChunkedTableWriter(exp_dir, 'parameters', PARAMETERS_COLUMNS + ['Cylinder'], fmt, chunk,
+                                    resume=offsets[1]))
+    else:
+        sinks = (TrajectoryRecorder(PLUME_STATE_COLUMNS + [MEMBER_COLUMN], capacity=max(ncyl, 1024)),
+                 TrajectoryRecorder(PARAMETERS_COLUMNS + [MEMBER_COLUMN], capacity=max(ncyl, 1024)))
+    output = None
+    if check_output_mode(numerical_namelist):
+        output = DecimatedOutput.from_namelist(numerical_namelist, *sinks, member=True)
+        if checkpoint is not None:
+            output.set_state(checkpoint['output'])
+    checkpointer = None
+    if checkpoint_every:
+        checkpointer = Checkpointer(exp_dir, checkpoint_every, namelists, sinks, output)
+    result = plume_ensemble(profile, numerical_namelist, release_namelist, constants,
+                            density_table=density_table, record=True, release_step=np.arange(ncyl),
+                            recorders=sinks if output is None else (output.outdata, output.paramdata),
+                            checkpoint=checkpointer, resume=checkpoint['solver'] if checkpoint is not None else None)
+
+    for event, depth, time in (('Neutral buoyancy', result.neu_buoy, result.t_neu_buoy),
+                               ('Maximum height', result.max_height, result.t_max_height)):
+        reached = ~np.isnan(depth)
+        if np.any(reached):
+            print('{} reached by {}/{} cylinders, at depth {} to {} m and time {} to {} mins.'.format(
+                event, reached.sum(), ncyl, np.min(depth[reached]), np.max(depth[reached]),
+                np.min(time[reached]), np.max(time[reached])))
+
+    # # # PRINT OUTPUT
+
+    if output is not None:
+        output.close()
+
+    plume_result = PlumeResult(final_z=result.final_z, neu_buoy=result.neu_buoy, max_height=result.max_height)
+    if chunk:
+        for writer in sinks:
+            writer.close()
+        return plume_result
+
+    for recorder, name in zip(sinks, ('plumeState', 'parameters')):
+        recorder.trim()
+        data = recorder.to_dataframe()
+        data['Cylinder'] = data.pop(MEMBER_COLUMN).astype(int)
+        plume_result.tables[name] = data
+        if write:
+            write_table(data, exp_dir, name, fmt)
+
+    return plume_result
+
+
+def update_params(p, plume_state_n, xb, yb, zb, profile, density_table, rho_oil_0, T_oil_0):
+    '''
+    Update the ambient and diagnostic parameters p from the new plume state.
+    (xb, yb, zb) is the position at the 'before' state.
+    Returns the tuple (m, u, w, c, x, y, z, Qs, Qf, Qe, Fd2) of output values,
+    or None if the cylinder has reached the surface.
+    '''
+    # Retrieve plume state variables
+
+    m, um, vm, wm, cm, x, y, z, Tm, Sm = plume_state_n.tolist()
+    u,v,w = um/m, vm/m, wm/m
+    c = cm/m
+    T,S = Tm/m, Sm/m
+
+
+    # Update ambient ocean data at the cylinder depth 
+
+    if z < 0 :
+        p.ua, p.va, p.Ta, p.Sa, p.rhoa = profile.sample(z)
+    else :
+        return None
+
+
+    # Update all remaining parameters
+
+    p.c = c
+    p.rho_oil = rho_oil_0 * (1 - p.c_T * (T - T_oil_0))
+    p.rho_w = density_table.rho(S,T) if density_table is not None else float(gsw.density.rho(S,T,1))
+    p.rho =  p.rho_oil* p.rho_w / (p.rho_oil*(1-c) + p.rho_w*c)
+    p.g1= reduced_g_fast(p)
+
+    p.u= u
+    p.v= v
+    p.alpha=entrain_coeff_yapa_fast(p)
+
+    p.v_0b=p.v_0
+    p.v_0 = math.sqrt(u**2 + v**2 + w**2)
+
+    p.ds = math.sqrt((x-xb)**2 +(y-yb)**2+(z-zb)**2)
+    p.h= abs(p.v_0/p.v_0b * p.h)
+
+    p.bb=p.b
+    p.b=math.sqrt(m/(p.rho*math.pi*p.h))
+
+    p.v_thetab=p.v_theta
+    p.v_theta=math.atan2(v,u)
+    p.v_phib=p.v_phi
+    p.v_phi=math.asin(w/p.v_0)
+
+    Fd2=p.v_0**2/(2*p.g1*p.b)
+
+    Qs = shear_entrain_yapa_fast(p)
+    Qf = forced_entrain_yapa_fast(p)
+    Qe = total_entrain_fast(p, Qs, Qf)
+
+    return m, u, w, c, x, y, z, Qs, Qf, Qe, Fd2
+
+
+def rescale_step(p, ratio):
+    '''
+    Multiply the per-step differences of the forced entrainment (ds, b-bb, orientation change)
+    by ratio, e.g. dt/h from a step of size h to the reference step dt. Returns the new Qf.
+    '''
+    p.ds = p.ds * ratio
+    p.bb = p.b - (p.b - p.bb) * ratio
+    p.v_phib = p.v_phi - (p.v_phi - p.v_phib) * ratio
+    p.v_thetab = p.v_theta - ((p.v_theta - p.v_thetab + math.pi) % (2*math.pi) - math.pi) * ratio
+    return forced_entrain_yapa_fast(p)
 
-                # Update parameters file
-                
-                paramdata1=np.array([(t+1)*dt/60, p['alpha'], proj_vel(p), p['v_0'], p['rhoa'], Qs, Qf, Qe, p['v_phi'],p['g1'], Fd2])
-                paramdata=np.vstack([paramdata,paramdata1])
 
-                # Update output plume file
-                outdata1=np.array([((t+1))*dt/60, m, u, w, c, p['rho'],p['rhoa'], p['h'], p['b'], x,y,z])
-                outdata = np.vstack([outdata, outdata1])
+def integrate_python(p, plume_state_b, cyl, tmax, dt, profile, density_table, rho_oil_0, T_oil_0, outdata, paramdata,
+                     checkpoint=None, resume=None, rk4_mode='fused'):
+    '''
+    Time-evolution of one cylinder with the pure-Python RK4 solver.
+    The cylinder is released at step `cyl`; rows are appended to the outdata, paramdata recorders.
+    Seawater density is read from density_table if given, otherwise computed with gsw.
+    checkpoint: optional Checkpointer, resume: the solver state of a checkpoint (cyl is then its step).
+    rk4_mode: 'fused', the entrainment flux of the diagnostics is reused by all the stages of the next step,
+    or 'consistent', the entrainment is evaluated again from the state of every stage.
+    Returns the last depth reached, the neutral buoyancy depth and the maximum height (None if not reached).
+    '''
+    z = plume_state_b[7]
 
+    neu_buoy = None
+    max_height = None
+    Flag1 = True
+    Flag2 = True
+    t_nb = -1
+    if resume is not None:
+        Flag1, Flag2, neu_buoy, t_nb = resume['Flag1'], resume['Flag2'], resume['neu_buoy'], resume['t_nb']
+
+    # entrainment flux of the current params, then the one of the diagnostics of every step
+    Qe = total_entrain_fast(p, shear_entrain_yapa_fast(p), forced_entrain_yapa_fast(p))
+
+    def stage_params(plume_state_s, c):
+        # params and entrainment flux of an RK4 stage state (consistent mode), None above the surface;
+        # the per-step differences of the forced entrainment cover the fraction c of the step
+        q = p.copy()
+        out = update_params(q, plume_state_s, plume_state_b[5], plume_state_b[6], plume_state_b[7],
+                            profile, density_table, rho_oil_0, T_oil_0)
+        if out is None:
+            return None
+        return q, total_entrain_fast(q, out[7], rescale_step(q, 1/c))
+
+    for t in tqdm_green(range(cyl,tmax)):
+
+        if checkpoint is not None and t > cyl and checkpoint.due(t):
+            checkpoint(t, {'state': plume_state_b, 'p': p, 'Flag1': Flag1, 'Flag2': Flag2,
+                           'neu_buoy': neu_buoy, 't_nb': t_nb})
+
+        # ambient profiles at the time of the step (time-varying profile)
+        profile.set_time(t*dt/60)
+
+        # UPDATE PLUME : NEW STATE = BEFORE STATE + STATE VARIATION
+
+        plume_state_n = plume_state_b + RK4_fused(plume_state_b, p, dt, Qe,
+                                                  stage_params if rk4_mode == 'consistent' else None)
+
+        out = update_params(p, plume_state_n, plume_state_b[5], plume_state_b[6], plume_state_b[7],
+                            profile, density_table, rho_oil_0, T_oil_0)
+        if out is None:
+            z = plume_state_n[7]
+            break
+        m, u, w, c, x, y, z, Qs, Qf, Qe, Fd2 = out
+
+
+        # Update the 'before' state
+
+        plume_state_b = plume_state_n
+
+        # When density is equal to ocean density, find neutral buoyancy
+        if p.g1 <= 0. and Flag1 :   #0.215 for max
+            Flag1=False
+            neu_buoy=z
+            t_nb = t
+            print('Neutral buoyancy at depth {} m and time {} mins.'.format(z,(t+1)*dt/60 ))
+
+        # When velocity intensity lowers below a threshold, find maximum height
+        if (p.alpha < -5. or w<0.001) and Flag2 :
+            Flag2 = False
+            max_height=z
+            print('Maximum height at depth {} m and time {} mins.'.format(z,(t+1)*dt/60 ))
+            break   
+
+        # Update parameters file
         
+        paramdata.append([(t+1)*dt/60, p.alpha, proj_vel_fast(p), p.v_0, p.rhoa, Qs, Qf, Qe, p.v_phi,p.g1, Fd2])
+
+        # Update output plume file
+        outdata.append([((t+1))*dt/60, m, u, w, c, p.rho,p.rhoa, p.h, p.b, x,y,z])
+
+    return z, neu_buoy, max_height
+
+
+def integrate_adaptive(p, plume_state_b, cyl, tmax, dt, profile, density_table, rho_oil_0, T_oil_0,
+                       outdata, paramdata, rtol, atol, dt_max, method='dopri5', jacobian='analytic'):
+    '''
+    Time-evolution of one cylinder with an adaptive integrator, the Dormand-Prince 5(4) (method 'dopri5')
+    or the linearly implicit Rosenbrock 2(3) (method 'rosenbrock', with the 'analytic' or 'fd'
+    finite-difference Jacobian of model_fast); same interface as integrate_python plus the tolerances
+    and the maximum step.
+    dt is the first trial step and the reference step of the forced entrainment: its per-step
+    differences (ds, b-bb, orientation change) are rescaled from the actual step to dt,
+    so that Qf doesn't depend on the step size.
+    Neutral buoyancy and maximum height are located inside the step by root-finding.
+    '''
+    t = cyl*dt
+    t_end = tmax*dt
+    h = dt
+    z = plume_state_b[7]
 
-        if z < -1:
-            surfacing = False
-            final_state = 'subsurface'
-        else:
-            final_state = 'surface'
-
-
-
-        # # # PRINT OUTPUT
-
-        plume_data=pd.DataFrame(data=outdata, columns=['Time [min]', 'Mass', 'U', 'W', 'C', 'Density', 'A_Density', 'Tkness', 'Radius', 'x', 'y', 'z' ])
-        plume_data.to_csv(rf'{exp_dir}/plumeState.csv', index=False, header=True, float_format='%.8f', sep='\t', mode='w')
-
-        parameters=pd.DataFrame(data=paramdata, columns=['Time [min]', 'alpha', 'va proj', 'v_0', 'rhoa', 'Qs', 'Qf', 'Qe', 'v_phi', 'g1', 'Fd2'])
-        parameters.to_csv(rf'{exp_dir}/parameters.csv', index=False, header=True, float_format='%.8f', sep='\t', mode='w')
-
-
-    compute_and_save_product_summary(exp_dir, runId, numerical_namelist, release_namelist, ambient_namelist)
+    neu_buoy = None
+    max_height = None
+    Flag1 = True
+    Flag2 = True
+
+    def buoyancy(state):
+        # reduced gravity g1 of a plume state, as computed in update_params
+        m = state[0]
+        c, T, S = state[4]/m, state[8]/m, state[9]/m
+        rhoa = profile.sample(min(state[7], profile.z_max))[4]
+        rho_oil = rho_oil_0 * (1 - p.c_T * (T - T_oil_0))
+        rho_w = density_table.rho(S,T) if density_table is not None else float(gsw.density.rho(S,T,1))
+        rho = rho_oil * rho_w / (rho_oil*(1-c) + rho_w*c)
+        return p.g * (rhoa - rho) / p.rhoa_0
+
+    def vertical_velocity(state):
+        return state[3]/state[0] - 0.001
+
+    if method == 'rosenbrock':
+        order = 3
+        def step(state, h):
+            jac = model_jacobian_fast(state, p) if jacobian == 'analytic' else fd_jacobian(model_fast, p, state)
+            return rosenbrock_step(model_fast, p, state, h, jac)
+    else:
+        order = 5
+        def step(state, h):
+            return dopri5_step(model_fast, p, state, h)
+
+    while t_end - t > 1e-9 * t_end:
+        profile.set_time(t/60)
+        h = min(h, dt_max, t_end - t)
+        plume_state_n, err, f0, f1 = step(plume_state_b, h)
+        en = error_norm(err, plume_state_b, plume_state_n, rtol, atol)
+        if en > 1.:
+            h = next_step(h, en, order)
+            continue
+        h_next = next_step(h, en, order)
+
+        # Events inside the step
+        if Flag1:
+            event = locate_event(buoyancy, plume_state_b, plume_state_n, f0, f1, h)
+            if event is not None:
+                Flag1 = False
+                neu_buoy = event[1][7]
+                print('Neutral buoyancy at depth {} m and time {} mins.'.format(neu_buoy, (t + event[0]*h)/60))
+
+        if Flag2:
+            event = locate_event(vertical_velocity, plume_state_b, plume_state_n, f0, f1, h)
+            if event is not None:
+                Flag2 = False
+                max_height = z = event[1][7]
+                print('Maximum height at depth {} m and time {} mins.'.format(max_height, (t + event[0]*h)/60))
+                break
+
+        out = update_params(p, plume_state_n, plume_state_b[5], plume_state_b[6], plume_state_b[7],
+                            profile, density_table, rho_oil_0, T_oil_0)
+        if out is None:
+            z = plume_state_n[7]
+            break
+        m, u, w, c, x, y, z, Qs, Qf, Qe, Fd2 = out
+
+        # Rescale the per-step differences of the forced entrainment to the reference step dt
+        Qf = rescale_step(p, dt / h)
+        Qe = total_entrain_fast(p, Qs, Qf)
+
+        t += h
+        plume_state_b = plume_state_n
+        h = h_next
+
+        # Same per-step checks as the fixed-step solver (the alpha criterion has no event function)
+        if p.g1 <= 0. and Flag1:
+            Flag1 = False
+            neu_buoy = z
+            print('Neutral buoyancy at depth {} m and time {} mins.'.format(z, t/60))
+
+        if (p.alpha < -5. or w<0.001) and Flag2:
+            Flag2 = False
+            max_height = z
+            print('Maximum height at depth {} m and time {} mins.'.format(z, t/60))
+            break
+
+        paramdata.append([t/60, p.alpha, proj_vel_fast(p), p.v_0, p.rhoa, Qs, Qf, Qe, p.v_phi, p.g1, Fd2])
+        outdata.append([t/60, m, u, w, c, p.rho, p.rhoa, p.h, p.b, x, y, z])
+
+    return z, neu_buoy, max_height
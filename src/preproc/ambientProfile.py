@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vertical profiles of the ambient ocean variables at the spill location.
+
+All the variables are stored in one contiguous (ndepth, nvar) array on the
+oceanProfilesInput.csv depth levels, and are linearly interpolated in depth
+with a single bracket search per lookup.
+
+TimeVaryingProfile holds the profiles at several times (oceanProfilesTime.csv)
+and the solvers move it along with the plume time (set_time).
+
+The profiles of a run are either CSV files in its folder or an entry of the
+profile cache referenced by it (PROFILE_CACHE of the Ambient namelist).
+"""
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from src.preproc.profileCache import CACHE_FILE, load_entry, read_reference
+
+
+# Profiles at the release time
+PROFILES_FILE = 'oceanProfilesInput.csv'
+
+# Profiles at the times of the ocean fields during the run (TIME_VARYING of the Ambient namelist)
+TIME_PROFILES_FILE = 'oceanProfilesTime.csv'
+
+
+def read_profiles(exp_dir, name=PROFILES_FILE):
+    """
+    Dataframe of the profiles `name` of the run folder: the CSV file, or the table of the
+    profile cache entry the run references. None if the run has neither.
+    """
+    path = os.path.join(exp_dir, name)
+    if os.path.exists(path):
+        return pd.read_csv(path)
+    reference = read_reference(exp_dir)
+    if reference is None:
+        return None
+    return load_entry(reference['entry']).get(os.path.splitext(name)[0])
+
+
+def copy_profiles(src_dir, dst_dir):
+    """
+    Copy the profiles of a run folder (CSV files or the profile cache reference) to another one.
+    """
+    for name in (PROFILES_FILE, TIME_PROFILES_FILE, CACHE_FILE):
+        if os.path.exists(os.path.join(src_dir, name)):
+            shutil.copyfile(os.path.join(src_dir, name), os.path.join(dst_dir, name))
+
+
+class AmbientProfile:
+    """
+    Ambient profiles of (uo, vo, thetao, so, rhoa) as a function of depth (z < 0).
+
+    sample(z) returns the five variables at one depth, remembering the last depth bracket
+    (the plume moves monotonically, so the next bracket is the same or a neighbouring one);
+    sample_many(z) interpolates an array of depths at once.
+    Depths outside of the profile range raise a ValueError, as scipy interp1d does.
+    """
+    VARIABLES = ('uo', 'vo', 'thetao', 'so', 'rhoa')
+
+    # profiles of the run folder read by from_run
+    FILE = PROFILES_FILE
+
+    # the table does not change during the run: set_time is a no-op
+    time_varying = False
+
+    def __init__(self, depth, uo, vo, thetao, so, rhoa):
+        depth = np.asarray(depth, dtype=np.float64)
+        order = np.argsort(depth)
+        self.depth = np.ascontiguousarray(depth[order])
+        self.table = np.ascontiguousarray(
+            np.column_stack([np.asarray(var, dtype=np.float64) for var in (uo, vo, thetao, so, rhoa)])[order])
+        self._k = 0
+
+    @classmethod
+    def from_dataframe(cls, df, sea_area=None):
+        """
+        Build the profile from a dataframe with the oceanProfilesInput.csv columns.
+        For the NORTHSEA the currents are rotated by 90 degrees, as in the original setup.
+        """
+        uo, vo = df['uo'], df['vo']
+        if sea_area == 'NORTHSEA':
+            uo = df['uo']*np.cos(np.pi/2) - df['vo']*np.sin(np.pi/2)
+            vo = df['uo']*np.sin(np.pi/2) - df['vo']*np.cos(np.pi/2)
+        return cls(df['depth'], uo, vo, df['thetao'], df['so'], df['rhoa'])
+
+    @classmethod
+    def from_csv(cls, path, sea_area=None):
+        return cls.from_dataframe(pd.read_csv(path), sea_area=sea_area)
+
+    @classmethod
+    def from_run(cls, exp_dir, **kwargs):
+        """
+        Build the profile from the run folder: its CSV file or the profile cache entry it references.
+        """
+        df = read_profiles(exp_dir, cls.FILE)
+        if df is None:
+            raise FileNotFoundError(f'No {cls.FILE} in {exp_dir}, nor a profile cache entry with it')
+        return cls.from_dataframe(df, **kwargs)
+
+    def __len__(self):
+        return self.depth.shape[0]
+
+    @property
+    def z_min(self):
+        return self.depth[0]
+
+    @property
+    def z_max(self):
+        return self.depth[-1]
+
+    def column(self, var):
+        return self.table[:, self.VARIABLES.index(var)]
+
+    def envelope_table(self):
+        # all the (depth, variable) rows the profile can take during the run
+        return self.table
+
+    def set_time(self, minutes):
+        pass
+
+    def reset(self):
+        pass
+
+    def _check_range(self, z_min, z_max):
+        if z_min < self.depth[0]:
+            raise ValueError('A value in x_new is below the interpolation range.')
+        if z_max > self.depth[-1]:
+            raise ValueError('A value in x_new is above the interpolation range.')
+
+    def sample(self, z):
+        """
+        Returns the tuple (uo, vo, thetao, so, rhoa) at depth z.
+        """
+        depth = self.depth
+        self._check_range(z, z)
+        k = self._k
+        while k > 0 and z <= depth[k]:
+            k -= 1
+        while k < len(depth) - 2 and z > depth[k + 1]:
+            k += 1
+        self._k = k
+
+        z_lo, z_hi = depth[k], depth[k + 1]
+        lo, hi = self.table[k], self.table[k + 1]
+        dz = z - z_lo
+        return tuple(((hi - lo) / (z_hi - z_lo) * dz + lo).tolist())
+
+    def sample_many(self, z):
+        """
+        Returns the (len(z), 5) array of (uo, vo, thetao, so, rhoa) at the depths in z.
+        """
+        z = np.atleast_1d(np.asarray(z, dtype=np.float64))
+        self._check_range(z.min(), z.max())
+        hi = np.clip(np.searchsorted(self.depth, z, side='left'), 1, len(self.depth) - 1)
+        lo = hi - 1
+        slope = (self.table[hi] - self.table[lo]) / (self.depth[hi] - self.depth[lo])[:, None]
+        return slope * (z - self.depth[lo])[:, None] + self.table[lo]
+
+
+class TimeVaryingProfile(AmbientProfile):
+    """
+    Ambient profiles at the times (minutes since the release) of the ocean fields, on common depth levels.
+
+    set_time(t) sets the table to the linear interpolation of the two profiles bracketing t
+    (the first or last profile outside of the time range). The table is updated in place, and only
+    when the time moved by `refresh` minutes since the last update: the fields are daily, the
+    plume phase lasts minutes to hours.
+    """
+    time_varying = True
+
+    FILE = TIME_PROFILES_FILE
+
+    def __init__(self, times, depth, tables, refresh=1.):
+        tables = np.asarray(tables, dtype=np.float64)
+        order = np.argsort(np.asarray(depth, dtype=np.float64))
+        super().__init__(depth, *tables[0].T)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.tables = np.ascontiguousarray(tables[:, order])
+        self.refresh = float(refresh)
+        self.reset()
+
+    @classmethod
+    def from_dataframe(cls, df, sea_area=None, refresh=1.):
+        """
+        Build the profiles from a dataframe with the oceanProfilesTime.csv columns (time [min] and the
+        oceanProfilesInput.csv ones), the same depth levels at every time.
+        """
+        profiles = [AmbientProfile.from_dataframe(group, sea_area=sea_area) for _, group in df.groupby('time')]
+        return cls(sorted(df['time'].unique()), profiles[0].depth, [profile.table for profile in profiles],
+                   refresh=refresh)
+
+    @classmethod
+    def from_csv(cls, path, sea_area=None, refresh=1.):
+        return cls.from_dataframe(pd.read_csv(path), sea_area=sea_area, refresh=refresh)
+
+    def envelope_table(self):
+        return self.tables.reshape(-1, self.tables.shape[-1])
+
+    def reset(self):
+        # back to the release profile, whatever the time of the last update (a profile shared by successive runs)
+        self._time = None
+        self.set_time(0.)
+
+    def set_time(self, minutes):
+        if self._time is not None and abs(minutes - self._time) < self.refresh:
+            return
+        self._time = minutes
+        k = int(np.clip(np.searchsorted(self.times, minutes, side='right') - 1, 0, len(self.times) - 1))
+        if k == len(self.times) - 1 or minutes <= self.times[0]:
+            self.table[:] = self.tables[k]
+            return
+        frac = (minutes - self.times[k]) / (self.times[k + 1] - self.times[k])
+        self.table[:] = self.tables[k] + frac * (self.tables[k + 1] - self.tables[k])
@@ -0,0 +1,163 @@
+"""
+Process-level pool of the open ocean datasets and cached horizontal interpolation
+
+The NetCDF files of the products are opened once per process and kept in a
+pool with an LRU limit (DATASET_POOL); a file modified on disk is reopened. The
+last two time slabs (depth, latitude, longitude) read of every variable stay in
+memory with the handle (the two bracketing the time of the profiles), so stepping
+through time reads every slab once, and the bilinear stencils (indices and weights of the four grid
+points around a site) are cached for every (grid, lat, lon). Extracting a
+profile is then a fancy-indexing gather of the stencil columns and a weighted
+sum, the same values as xarray interp(latitude, longitude) on the grid.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+
+
+# Time slabs kept in memory per variable of a dataset (the two bracketing a time)
+MAX_SLABS = 2
+
+
+def _mtime(path):
+    return max(os.stat(file).st_mtime for file in (path if isinstance(path, tuple) else (path,)))
+
+
+class _PooledDataset:
+    # one file, or a tuple of files concatenated along time (daily chunks of the rolling store, or downloads
+    # of successive days); on the grid common to the files, each time once and in order
+    def __init__(self, path):
+        self.path = path
+        self.mtime = _mtime(path)
+        if isinstance(path, tuple):
+            self._parts = [xr.open_dataset(file) for file in path]
+            self.ds = xr.concat(self._parts, dim='time', join='inner') if len(self._parts) > 1 else self._parts[0]
+            times = self.ds['time'].values
+            if len(times) > 1 and not (np.diff(times) > np.timedelta64(0)).all():
+                self.ds = self.ds.isel(time=np.unique(times, return_index=True)[1])
+        else:
+            self._parts = []
+            self.ds = xr.open_dataset(path)
+        self.slabs = {}
+
+    def slab(self, var, itime):
+        # (depth, latitude * longitude) values of var at the time index, the last MAX_SLABS ones of var in memory
+        slabs = self.slabs.setdefault(var, OrderedDict())
+        if itime not in slabs:
+            values = self.ds[var].isel(time=itime).transpose('depth', 'latitude', 'longitude').values
+            slabs[itime] = np.ascontiguousarray(values.reshape(values.shape[0], -1), dtype=np.float64)
+            while len(slabs) > MAX_SLABS:
+                slabs.popitem(last=False)
+        slabs.move_to_end(itime)
+        return slabs[itime]
+
+    def close(self):
+        self.slabs.clear()
+        self.ds.close()
+        for part in self._parts:
+            part.close()
+
+
+class DatasetPool:
+    """
+    Open datasets by path (or tuple of paths concatenated along time), at most max_open at once
+    (the least recently used one is closed).
+
+    Usage example:
+
+        >>> dataset = DATASET_POOL.get(path)
+        >>> slab = dataset.slab('so', 0)
+    """
+    def __init__(self, max_open=8):
+        self.max_open = max_open
+        self._datasets = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, path):
+        path = tuple(os.path.abspath(file) for file in path) if isinstance(path, (tuple, list)) \
+            else os.path.abspath(path)
+        with self._lock:
+            dataset = self._datasets.get(path)
+            if dataset is not None and dataset.mtime != _mtime(path):
+                dataset.close()
+                dataset = None
+            if dataset is None:
+                dataset = _PooledDataset(path)
+            self._datasets[path] = dataset
+            self._datasets.move_to_end(path)
+            while len(self._datasets) > self.max_open:
+                self._datasets.popitem(last=False)[1].close()
+            return dataset
+
+    def clear(self):
+        with self._lock:
+            for dataset in self._datasets.values():
+                dataset.close()
+            self._datasets.clear()
+
+    def __len__(self):
+        return len(self._datasets)
+
+
+DATASET_POOL = DatasetPool()
+
+
+def bracket(grid, x):
+    """
+    Lower index and fraction of every x in the ascending grid (nan outside of the grid).
+    """
+    i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    frac = (x - grid[i]) / (grid[i + 1] - grid[i])
+    return i, np.where((x >= grid[0]) & (x <= grid[-1]), frac, np.nan)
+
+
+def bilinear_stencil(lat_grid, lon_grid, lats, lons):
+    """
+    Indices of the four grid points around every site in the flattened (latitude, longitude) grid
+    and their bilinear weights, two (nsites, 4) arrays (nan weights outside of the grid).
+    """
+    i, fy = bracket(lat_grid, lats)
+    j, fx = bracket(lon_grid, lons)
+    nlon = len(lon_grid)
+    index = np.stack([i * nlon + j, i * nlon + j + 1, (i + 1) * nlon + j, (i + 1) * nlon + j + 1], axis=1)
+    weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=1)
+    return index, weights
+
+
+class StencilCache:
+    """
+    Bilinear stencils by (grid, lat, lon), at most max_size sites (least recently used first out).
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._stencils = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, lat_grid, lon_grid, lats, lons):
+        grid = (lat_grid.shape[0], hash(lat_grid.tobytes()), lon_grid.shape[0], hash(lon_grid.tobytes()))
+        with self._lock:
+            cached = [self._stencils.get((grid, lat, lon)) for lat, lon in zip(lats.tolist(), lons.tolist())]
+            missing = [k for k, stencil in enumerate(cached) if stencil is None]
+            if missing:
+                index, weights = bilinear_stencil(lat_grid, lon_grid, lats[missing], lons[missing])
+                for n, k in enumerate(missing):
+                    cached[k] = (index[n], weights[n])
+                    self._stencils[(grid, float(lats[k]), float(lons[k]))] = cached[k]
+            for lat, lon in zip(lats.tolist(), lons.tolist()):
+                self._stencils.move_to_end((grid, lat, lon))
+            while len(self._stencils) > self.max_size:
+                self._stencils.popitem(last=False)
+        return np.stack([stencil[0] for stencil in cached]), np.stack([stencil[1] for stencil in cached])
+
+
+STENCILS = StencilCache()
+
+
+def gather(slab, index, weights):
+    """
+    (nsites, depth) profiles: weighted sum of the stencil columns of the (depth, latitude * longitude) slab.
+    """
+    return np.einsum('dsk,sk->sd', slab[:, index], weights)
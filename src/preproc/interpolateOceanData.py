@@ -9,73 +9,279 @@ from glob import glob
 import xarray as xr
 import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import gsw
 import os
+from src.download.manifest import Manifest, MANIFEST_FILE
+from src.download.timeStore import TimeSeriesStore
+from src.preproc.datasetPool import DATASET_POOL, STENCILS, gather, bracket
+from src.preproc.ambientProfile import AmbientProfile, TimeVaryingProfile, PROFILES_FILE, TIME_PROFILES_FILE
+from src.preproc.profileCache import ProfileCache, profile_key
+from src.utils.utils import print_ntime
 
 cur_mag=1
 
-def interp_oceanvar(ds, var, lat_fix, lon_fix):
-    time_fix = ds['time'][0]
-    offset = 1.0
+# Variables of the ambient profiles and the file pattern of their dataset
+PROFILE_FILES = {'uo': 'uo-vo', 'vo': 'uo-vo', 'thetao': 'thetao', 'so': 'so'}
+PROFILE_COLUMNS = ('uo', 'vo', 'thetao', 'so', 'rhoa')
 
-    crop_var = ds[var].sel(time=time_fix).sel(latitude=slice(lat_fix - offset, lat_fix + offset), longitude=slice(lon_fix - offset, lon_fix + offset))
-    var_depth = crop_var.interp(latitude=lat_fix, longitude=lon_fix).values
+def _clip_times(time_grid, times, warned):
+    # times moved into the time range of the fields, with a warning for every requested time moved
+    first, last = time_grid[0], time_grid[-1]
+    clipped = np.minimum(np.maximum(times, first), last)
+    for requested in np.unique(times[clipped != times]):
+        used = min(max(requested, first), last)
+        message = (f'[WARNING] {requested.astype("datetime64[m]")} is outside of the ocean fields '
+                   f'({first.astype("datetime64[m]")} to {last.astype("datetime64[m]")}), '
+                   f'the profiles are taken at {used.astype("datetime64[m]")}.')
+        if message not in warned:
+            warned.add(message)
+            print_ntime(message)
+    return clipped
 
-    return var_depth
+def _time_stencil(time_grid, times):
+    # lower time index and weight of the upper one for every site (nan outside of the time range)
+    grid = time_grid.astype('datetime64[ns]').astype(np.float64)
+    times = times.astype('datetime64[ns]').astype(np.float64)
+    if len(grid) == 1:
+        return np.zeros(len(times), dtype=int), np.where(times == grid[0], 0., np.nan)
+    return bracket(grid, times)
 
-def interpolate_data(exp_dir, ambient_namelist, release_namelist, static_paths):
-    # Read downloaded ocean data
-    date = datetime(ambient_namelist["START_YEAR"], ambient_namelist["START_MONTH"], ambient_namelist["START_DAY"], ambient_namelist["START_HOUR"]).strftime("%Y%m%d")
-        
-    # List of variables
-    var_list = ['uo-vo', 'thetao', 'so']
+def release_time(ambient_namelist, release_namelist):
+    """
+    Release datetime: release_datetime of the Release namelist ('YYYY-MM-DDTHH:MM'),
+    the start of the download window (START_*) if none.
+    """
+    value = release_namelist.get('release_datetime', 'none')
+    if value is None or str(value) == 'none':
+        return datetime(ambient_namelist["START_YEAR"], ambient_namelist["START_MONTH"], ambient_namelist["START_DAY"], ambient_namelist["START_HOUR"])
+    if not isinstance(value, str):
+        raise ValueError(f"release_datetime must be written as 'YYYY-MM-DDTHH:MM' (read {value})")
+    return datetime.fromisoformat(value)
 
-    # Read depths from so data
-    file0 = glob(os.path.join(static_paths['INPUT_FILES'], date, ambient_namelist['SEA_AREA'], '*so*.nc'))
-    ds = xr.open_dataset(file0[0])
-    depth = ds['depth'].values
-    df = pd.DataFrame({'depth': -depth})
+def end_time(ambient_namelist):
+    return datetime(ambient_namelist['END_YEAR'], ambient_namelist['END_MONTH'], ambient_namelist['END_DAY'], ambient_namelist['END_HOUR'])
 
-    # Retrieve spill location
-    lat_fix = release_namelist['spill_lat']
-    lon_fix = release_namelist['spill_lon']
-    # print('release coords', lat_fix, lon_fix)
-
-    # Iterate through the list of variables
-    for var in var_list:
-        file = glob(os.path.join(static_paths['INPUT_FILES'], date, ambient_namelist['SEA_AREA'], '*' + var + '*.nc'))
-        print(file[0])
-        ds = xr.open_dataset(file[0])
-
-        if var == 'uo-vo':
-            var_depth_uo = interp_oceanvar(ds, 'uo', lat_fix, lon_fix)
-            df['uo'] = var_depth_uo * cur_mag
-            var_depth_vo = interp_oceanvar(ds, 'vo', lat_fix, lon_fix)
-            df['vo'] = var_depth_vo * cur_mag
+def extract_profiles(files, lats, lons, times=None, clip=False):
+    """
+    Vertical profiles of many sites in one pass.
+
+    Parameters:
+        files: dict {NetCDF file (or tuple of daily chunks): [variables]}, the datasets come from the
+               process pool (DATASET_POOL), which keeps the two time slabs bracketing the last time in memory
+        lats, lons: site coordinates (arrays of length nsites)
+        times: optional times of the sites (linear interpolation in time), otherwise the first time of the files
+        clip: times outside of the time range of the files take the first or last time, with a warning
+              (nan otherwise)
+
+    Returns:
+        depth (positive, of the first file), the (nsites, ndepth, nvar) array of the profiles and the variable names
+    """
+    lats, lons = np.atleast_1d(np.asarray(lats, dtype=np.float64)), np.atleast_1d(np.asarray(lons, dtype=np.float64))
+
+    depth, blocks, names, warned = None, [], [], set()
+    for file, variables in files.items():
+        print(file)
+        dataset = DATASET_POOL.get(file)
+        ds = dataset.ds
+        if depth is None:
+            depth = ds['depth'].values
+        # bilinear stencils of the sites on the grid of the file, cached by (grid, lat, lon)
+        index, weights = STENCILS(ds['latitude'].values.astype(np.float64), ds['longitude'].values.astype(np.float64),
+                                  lats, lons)
+        if times is None:
+            itime, ftime = np.zeros(len(lats), dtype=int), np.zeros(len(lats))
         else:
-            var_depth = interp_oceanvar(ds, var, lat_fix, lon_fix)
-            df[var] = var_depth
+            site_times = np.broadcast_to(np.asarray(times, dtype='datetime64[ns]'), lats.shape)
+            if clip:
+                site_times = _clip_times(ds['time'].values.astype('datetime64[ns]'), site_times, warned)
+            itime, ftime = _time_stencil(ds['time'].values, site_times)
+        for var in variables:
+            profiles = np.full((len(lats), ds.sizes['depth']), np.nan)
+            valid = ~np.isnan(ftime)
+            for i in np.unique(itime[valid]):
+                sites = np.flatnonzero(valid & (itime == i))
+                profiles[sites] = (1 - ftime[sites, None]) * gather(dataset.slab(var, int(i)), index[sites],
+                                                                    weights[sites])
+                upper = sites[ftime[sites] > 0]
+                if upper.size:
+                    profiles[upper] += ftime[upper, None] * gather(dataset.slab(var, int(i) + 1), index[upper],
+                                                                  weights[upper])
+            blocks.append(profiles)
+            names.append(var)
+    return depth, np.stack(blocks, axis=-1), names
+
+def find_files(directory, var, lat, lon, first, last):
+    # downloaded files of the variable covering the sites (manifest) from first to last, in time order
+    # (a tuple when the days are in separate files, e.g. a later extension), or the first matching one
+    if os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        manifest = Manifest(directory)
+        variable = var.split('-')[0]
+        corners = [(np.min(lat), np.min(lon)), (np.max(lat), np.max(lon))]
+        inside = set.intersection(*[set(manifest.find(variable, lon=lon_c, lat=lat_c)) for lat_c, lon_c in corners])
+        # the files of the window and the one of the day before first (the fields bracketing it), the latest
+        # download first among the files of the same time range
+        overlapping = [(request.time_range, filename) for request, filename in reversed(manifest.requests())
+                       if filename in inside and request.time_range[0] <= last
+                       and first - timedelta(days=1) < request.time_range[1]]
+        files, covered = [], None
+        for (start, end), filename in sorted(overlapping, key=lambda item: (item[0][0], -item[0][1].timestamp())):
+            if covered is None or end > covered:
+                files.append(os.path.join(directory, filename))
+                covered = end
+        if files:
+            return files[0] if len(files) == 1 else tuple(files)
+    return glob(os.path.join(directory, '*' + var + '*.nc'))[0]
+
+def locate_files(ambient_namelist, static_paths, lats, lons, times=None):
+    """
+    The {file: [variables]} of the profile variables covering the sites and times: the files downloaded
+    for the start date (a tuple of files along time when the times span several downloads), or the daily
+    chunks of the rolling local store.
+    """
+    start_date = datetime(ambient_namelist["START_YEAR"], ambient_namelist["START_MONTH"], ambient_namelist["START_DAY"], ambient_namelist["START_HOUR"])
+    date = start_date.strftime("%Y%m%d")
+    directory = os.path.join(static_paths['INPUT_FILES'], date, ambient_namelist['SEA_AREA'])
+    if times is None:
+        first, last = start_date, start_date
+    else:
+        times = np.atleast_1d(np.asarray(times, dtype='datetime64[s]')).tolist()
+        first, last = min(times), max(times)
+
+    # Daily chunks of the rolling local store, or the files downloaded for the start date
+    if ambient_namelist.get('DATA_STORE', False):
+        store = TimeSeriesStore.from_namelist(ambient_namelist, static_paths)
+        locate = lambda var: store.paths(var.split('-')[0], first, last + timedelta(days=1))
+    else:
+        locate = lambda var: find_files(directory, var, lats, lons, first, last)
+
+    # one file per dataset, the depths are the ones of the so file
+    files = {}
+    for var in ('so', 'thetao', 'uo', 'vo'):
+        files.setdefault(locate(PROFILE_FILES[var]), []).append(var)
+    return files
+
+def interpolate_sites(ambient_namelist, static_paths, lats, lons, times=None, density_table=None, clip=False,
+                      files=None):
+    """
+    Ambient profiles of many sites from the downloaded ocean data (or the rolling local store),
+    every dataset read once, linearly interpolated in time at the times of the sites if given.
+    files: the {file: [variables]} to read, the ones of locate_files for the sites if None
 
-    # Calculate density using the seawater library
-    df['rhoa'] = gsw.density.rho(df['so'], df['thetao'],1)
+    Returns:
+        depth (z < 0) and the (nsites, ndepth, 5) array of the PROFILE_COLUMNS
+    """
+    if files is None:
+        files = locate_files(ambient_namelist, static_paths, lats, lons, times)
+    depth, values, names = extract_profiles(files, lats, lons, times=times, clip=clip)
+    values = values[:, :, [names.index(var) for var in PROFILE_COLUMNS[:4]]]
+    values[:, :, :2] *= cur_mag
 
+    # Calculate density using the seawater library (or a precomputed DensityTable covering the profiles)
+    if density_table is not None:
+        rhoa = density_table(values[:, :, 3], values[:, :, 2])
+    else:
+        rhoa = gsw.density.rho(values[:, :, 3], values[:, :, 2], 1)
 
-    # Drop NaN values and save to CSV
-    first_nan_idx = df[df.isna().any(axis=1)].index[0]
-    last_valid_row = df.iloc[first_nan_idx - 1].copy()
-    df.iloc[first_nan_idx, 1:] = last_valid_row[1:]
-    oceanfile = df.iloc[:first_nan_idx + 1]
-    oceanfile.to_csv(os.path.join(exp_dir, 'oceanProfilesInput.csv'), index=False, header=True, float_format='%.8f', mode='w')
+    return -depth, np.concatenate([values, np.asarray(rhoa)[:, :, None]], axis=-1)
 
+def profile_dataframe(depth, profile):
+    """
+    oceanProfilesInput dataframe of one (ndepth, 5) profile: the first level below the sea bottom
+    (NaN) takes the values of the level above, the deeper ones are dropped.
+    """
+    df = pd.DataFrame(profile, columns=PROFILE_COLUMNS)
+    df.insert(0, 'depth', depth)
 
-    oceanfile=pd.DataFrame(df.dropna())
-    oceanfile.to_csv('{}oceanProfilesInput.csv'.format((os.path.join(exp_dir + '/'))), index=False, header=True, float_format='%.8f', mode='w')
+    # Drop NaN values
+    nan_rows = df.index[df.isna().any(axis=1)]
+    if len(nan_rows) and nan_rows[0] > 0:
+        df.iloc[nan_rows[0], 1:] = df.iloc[nan_rows[0] - 1, 1:]
+    return pd.DataFrame(df.dropna())
 
+def write_profile(exp_dir, df, name=PROFILES_FILE):
+    df.to_csv(os.path.join(exp_dir, name), index=False, header=True, float_format='%.8f', mode='w')
 
+def cache_options(ambient_namelist, density_table=None, time_varying=False):
+    # options of the interpolation besides the fields, site and time that change the profiles (profile cache key)
+    density = 'gsw' if density_table is None else [density_table.method, density_table.n, density_table.S_min,
+                                                   density_table.S_max, density_table.T_min, density_table.T_max,
+                                                   density_table.pressure]
+    return {'density': density, 'cur_mag': cur_mag,
+            'until': end_time(ambient_namelist).isoformat() if time_varying else None}
 
+def profile_tables(ambient_namelist, static_paths, lat_fix, lon_fix, t_release, files, density_table=None,
+                   time_varying=False):
+    """
+    The {file name: dataframe} of the profiles of a run: the profiles at the release time (PROFILES_FILE)
+    and with time_varying the ones at the times of the fields until END_* (TIME_PROFILES_FILE).
+    """
+    depth, profiles = interpolate_sites(ambient_namelist, static_paths, lat_fix, lon_fix, times=t_release,
+                                        density_table=density_table, clip=True, files=files)
+    df = profile_dataframe(depth, profiles[0])
+    tables = {PROFILES_FILE: df}
+
+    # Time-varying profiles: the release one, then the ones at the times of the fields until END_*
+    if time_varying:
+        end_date = np.datetime64(end_time(ambient_namelist), 'ns')
+        field_times = DATASET_POOL.get(next(iter(files))).ds['time'].values.astype('datetime64[ns]')
+        frames = [df.assign(time=0.)]
+        for t in field_times[(field_times > t_release) & (field_times <= end_date)]:
+            depth, profiles = interpolate_sites(ambient_namelist, static_paths, lat_fix, lon_fix, times=t,
+                                                density_table=density_table, files=files)
+            # same depth levels as the release profile
+            frames.append(profile_dataframe(depth, profiles[0]).iloc[:len(df)].assign(
+                time=(t - t_release) / np.timedelta64(1, 'm')))
+        time_df = pd.concat(frames)
+        time_df.insert(0, 'time', time_df.pop('time'))
+        tables[TIME_PROFILES_FILE] = time_df
+        print(f'{len(frames)} ambient profiles until {end_date}')
+    return tables
+
+def run_profile(tables, ambient_namelist):
+    """
+    The AmbientProfile of the {file name: dataframe} of profile_tables (TimeVaryingProfile with TIME_VARYING).
+    """
+    if ambient_namelist.get('TIME_VARYING', False) and TIME_PROFILES_FILE in tables:
+        return TimeVaryingProfile.from_dataframe(tables[TIME_PROFILES_FILE], sea_area=ambient_namelist['SEA_AREA'],
+                                                 refresh=ambient_namelist.get('PROFILE_REFRESH', 1.))
+    return AmbientProfile.from_dataframe(tables[PROFILES_FILE], sea_area=ambient_namelist['SEA_AREA'])
+
+def interpolate_data(exp_dir, ambient_namelist, release_namelist, static_paths, density_table=None):
+    # Interpolate the ocean data at the spill location and release time and return the AmbientProfile
+    # (passed on to plume); the profiles are saved to CSV in exp_dir (or referenced in the profile cache,
+    # PROFILE_CACHE), nothing is written in a run folder if exp_dir is None
+    lat_fix = release_namelist['spill_lat']
+    lon_fix = release_namelist['spill_lon']
+    t_release = np.datetime64(release_time(ambient_namelist, release_namelist), 'ns')
+    time_varying = ambient_namelist.get('TIME_VARYING', False)
+
+    times = [t_release, np.datetime64(end_time(ambient_namelist), 'ns')] if time_varying else t_release
+    files = locate_files(ambient_namelist, static_paths, lat_fix, lon_fix, times)
+
+    if ambient_namelist.get('PROFILE_CACHE', False):
+        # Content-addressed profile cache: a hit skips the interpolation
+        cache = ProfileCache.from_namelist(static_paths)
+        key, inputs = profile_key(ambient_namelist['PRODUCT_ID'], files, t_release, lat_fix, lon_fix,
+                                  **cache_options(ambient_namelist, density_table, time_varying))
+        if key in cache:
+            print_ntime(f'Ambient profiles found in the profile cache ({key[:12]})')
+            tables = {name + '.csv': df for name, df in cache.get(key).items()}
+        else:
+            tables = profile_tables(ambient_namelist, static_paths, lat_fix, lon_fix, t_release, files,
+                                    density_table=density_table, time_varying=time_varying)
+            cache.put(key, {os.path.splitext(name)[0]: df for name, df in tables.items()}, inputs)
+        if exp_dir is not None:
+            cache.link(key, exp_dir, inputs)
+        return run_profile(tables, ambient_namelist)
+
+    tables = profile_tables(ambient_namelist, static_paths, lat_fix, lon_fix, t_release, files,
+                            density_table=density_table, time_varying=time_varying)
+    if exp_dir is not None:
+        for name, df in tables.items():
+            write_profile(exp_dir, df, name)
+    return run_profile(tables, ambient_namelist)
 
 
 if __name__ == '__main__':
     interpolate_data()
-
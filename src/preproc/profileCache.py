@@ -0,0 +1,137 @@
+"""
+Content-addressed cache of the interpolated ambient profiles
+
+The profiles of a run depend only on the ocean fields and on where and when
+they are interpolated. ProfileCache keeps them once, CACHE_PATH/<key>.npz, under
+the sha256 of the product id, the version (source, creation date) and sha256
+checksum of every file read, the release time, the spill latitude and longitude,
+the depth range of the fields and the options of the interpolation: a repeated
+scenario finds its entry and skips the interpolation. The run folders keep a
+reference to their entry (profileCache.json) in place of a copy of the profiles.
+"""
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from src.download.manifest import Manifest, MANIFEST_FILE, file_checksum
+
+
+# Reference of a run folder to its cache entry
+CACHE_FILE = 'profileCache.json'
+
+# Bumped when the interpolation changes, so that the old entries are not used
+CACHE_VERSION = 1
+
+# Global attributes of the NetCDF files identifying the version of their dataset
+VERSION_ATTRS = ('product', 'source', 'creation_date')
+
+_FILES = {}
+
+
+def _file_info(path):
+    # name, checksum, version and depth range of a file, once per (size, mtime); the checksum of a
+    # downloaded file comes from the manifest of its directory
+    stat = os.stat(path)
+    memo = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if memo not in _FILES:
+        directory, fname = os.path.split(memo[0])
+        sha256 = None
+        if os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+            sha256 = next((entry['sha256'] for entry in Manifest(directory).entries if entry['file'] == fname), None)
+        with xr.open_dataset(path) as ds:
+            version = {attr: str(ds.attrs[attr]) for attr in VERSION_ATTRS if attr in ds.attrs}
+            depth = ds['depth'].values
+        _FILES[memo] = {'file': fname, 'sha256': sha256 or file_checksum(path), 'version': version,
+                        'depth_range': [float(depth.min()), float(depth.max())]}
+    return _FILES[memo]
+
+
+def profile_key(product_id, files, time, lat, lon, **options):
+    """
+    Cache key of the profiles at (time, lat, lon) interpolated from files (the {file or tuple of files:
+    variables} of locate_files), and the dict of its inputs.
+    """
+    infos = sorted((_file_info(path) for paths in files for path in (paths if isinstance(paths, tuple) else (paths,))),
+                   key=lambda info: info['file'])
+    inputs = {'cache_version': CACHE_VERSION, 'product_id': product_id, 'files': infos,
+              'time': str(np.datetime64(time, 's')), 'lat': float(lat), 'lon': float(lon),
+              'depth_range': [min(info['depth_range'][0] for info in infos),
+                              max(info['depth_range'][1] for info in infos)],
+              'options': options}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest(), inputs
+
+
+def load_entry(path):
+    """
+    The {table name: dataframe} of a cache entry.
+    """
+    with np.load(path) as npz:
+        return {name: pd.DataFrame(npz[name], columns=npz[name + '.columns'].tolist())
+                for name in npz.files if not name.endswith('.columns') and name != 'inputs'}
+
+
+def read_reference(exp_dir):
+    """
+    The profile cache reference of a run folder ({'entry', 'key', 'inputs'}), None if it has none.
+    """
+    path = os.path.join(exp_dir, CACHE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        return json.load(fin)
+
+
+class ProfileCache:
+    """
+    Profile tables (dataframes by name) stored by key, one .npz file per entry.
+
+    Usage example:
+
+        >>> cache = ProfileCache.from_namelist(static_paths)
+        >>> key, inputs = profile_key(product_id, files, time, lat, lon)
+        >>> if key not in cache:
+        >>>     cache.put(key, {'oceanProfilesInput': df}, inputs)
+        >>> cache.link(key, exp_dir, inputs)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_namelist(cls, static_paths):
+        return cls(static_paths.get('CACHE_PATH') or os.path.join(static_paths['INPUT_FILES'], 'profiles'))
+
+    def path(self, key):
+        return os.path.abspath(os.path.join(self.directory, key + '.npz'))
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def __len__(self):
+        return len([fname for fname in os.listdir(self.directory) if fname.endswith('.npz')])
+
+    def get(self, key):
+        return load_entry(self.path(key)) if key in self else None
+
+    def put(self, key, tables, inputs):
+        # written aside and renamed: the workers of a sweep may store the same entry at once
+        arrays = {'inputs': np.array(json.dumps(inputs))}
+        for name, df in tables.items():
+            arrays[name] = df.to_numpy(dtype=np.float64)
+            arrays[name + '.columns'] = np.array(df.columns.tolist())
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.' + key, suffix='.npz')
+        with os.fdopen(fd, 'wb') as fout:
+            np.savez_compressed(fout, **arrays)
+        os.replace(tmp, self.path(key))
+
+    def link(self, key, exp_dir, inputs):
+        """
+        Reference the entry from the run folder exp_dir.
+        """
+        with open(os.path.join(exp_dir, CACHE_FILE), 'w') as fout:
+            json.dump({'entry': self.path(key), 'key': key, 'inputs': inputs}, fout, indent=1)
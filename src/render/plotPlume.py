@@ -9,7 +9,17 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 
-def plot(exp_dir, render_namelist, ambient_namelist):
+from src.utils.plumeOutput import read_table
+from src.utils.trajectoryRecorder import PLUME_STATE_COLUMNS
+
+def _last_cylinder(df):
+    # continuous release: the tables hold every cylinder (last column 'Cylinder'), the last one is plotted
+    if 'Cylinder' not in df:
+        return df
+    rows = df[df['Cylinder'] == df['Cylinder'].max()]
+    return rows.iloc[np.argsort(rows[PLUME_STATE_COLUMNS[0]].values, kind='stable')].drop(columns='Cylinder')
+
+def plot(exp_dir, render_namelist, ambient_namelist, result=None):
 
     # Default plots :
         #   trajectory and envelope in z-x, z-y planes
@@ -30,8 +40,13 @@ def plot(exp_dir, render_namelist, ambient_namelist):
     if ambient_namelist['SEA_AREA']=='NORTHSEA':
         ns_flag = True
 
-    modelf = np.loadtxt(rf'{exp_dir}/plumeState.csv', comments='#', delimiter='\t',skiprows=1)
-    paramf = np.loadtxt(rf'{exp_dir}/parameters.csv', comments='#', delimiter='\t',skiprows=1)
+    # plumeState and parameters tables: in memory (PlumeResult of plume()) or read back (csv, parquet or netcdf)
+    if result is not None and 'plumeState' in result:
+        modelf = _last_cylinder(result.table('plumeState')).to_numpy()
+        paramf = _last_cylinder(result.table('parameters')).to_numpy()
+    else:
+        modelf = _last_cylinder(read_table(exp_dir, 'plumeState')).to_numpy()
+        paramf = _last_cylinder(read_table(exp_dir, 'parameters')).to_numpy()
 
     if ns_flag == True:
         dataf = np.loadtxt('./examples/NORTHSEA/envFields/northsea_obs.txt', comments='#')
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Screening of candidate release sites
+
+The ambient profiles of all the sites of namelist/Screening.yaml are extracted
+in one batched pass, a few of them are run with the full model to calibrate
+the similarity-theory screening (src/solver/similarity.py), and the trap
+height, rise time and dilution of every site are written in the table
+'screening' of the run folder.
+"""
+import numpy as np
+
+from src.preproc.ambientProfile import AmbientProfile
+from src.preproc.interpolateOceanData import interpolate_sites, profile_dataframe, release_time
+from src.solver.similarity import screening, calibrate
+from src.utils.logging import write_namelists
+from src.utils.plumeOutput import write_table
+from src.utils.utils import print_ntime
+
+
+def run_screening(exp_dir, screening_namelist, ambient_namelist, numerical_namelist, release_namelist, constants,
+                  static_paths):
+    """
+    Screen the sites of the Screening namelist, returns the table (one row per site, lat/lon and
+    SCREENING_COLUMNS) written as 'screening' in exp_dir.
+    """
+    write_namelists(exp_dir, {'Screening': screening_namelist})
+    lats = np.atleast_1d(np.asarray(screening_namelist.lats, dtype=np.float64))
+    lons = np.atleast_1d(np.asarray(screening_namelist.lons, dtype=np.float64))
+    if lats.shape != lons.shape:
+        raise ValueError(f'The Screening namelist has {len(lats)} lats and {len(lons)} lons.')
+    z0 = screening_namelist.z0
+    z0 = np.broadcast_to(np.asarray(release_namelist.z0 if str(z0) == 'none' else z0, dtype=np.float64),
+                         lats.shape)
+
+    # Ambient profiles of all the sites (the sites on land or out of the fields are left out)
+    t_release = np.datetime64(release_time(ambient_namelist, release_namelist), 'ns')
+    depth, values = interpolate_sites(ambient_namelist, static_paths, lats, lons, times=t_release, clip=True)
+    valid = ~np.isnan(values[:, 0, :]).any(axis=1)
+    if not np.all(valid):
+        print_ntime(f'[WARNING] {np.sum(~valid)} screening site(s) without ocean data left out.')
+    lats, lons, z0 = lats[valid], lons[valid], z0[valid]
+    profiles = [AmbientProfile.from_dataframe(profile_dataframe(depth, profile), sea_area=ambient_namelist['SEA_AREA'])
+                for profile in values[valid]]
+
+    # Calibration against full-model runs of a few sites, spread over the list
+    calibration = None
+    n_calibration = min(int(screening_namelist.n_calibration), len(profiles))
+    if n_calibration:
+        chosen = np.unique(np.linspace(0, len(profiles) - 1, n_calibration).round().astype(int))
+        calibration = calibrate([profiles[k] for k in chosen], numerical_namelist, release_namelist, constants,
+                                sites={'z0': z0[chosen]})
+
+    table = screening(profiles, release_namelist, constants, sites={'z0': z0}, calibration=calibration)
+    table.insert(0, 'lat', lats)
+    table.insert(1, 'lon', lons)
+    table.insert(2, 'z0', z0)
+    write_table(table, exp_dir, 'screening', numerical_namelist.output_format)
+    print_ntime(f'Screening of {len(table)} site(s): trap depth {table["trap_depth"].min():.1f} to '
+                f'{table["trap_depth"].max():.1f} m, {int(table["surfacing"].sum())} surfacing')
+    return table
@@ -0,0 +1,120 @@
+"""
+Adaptive integrators: explicit Dormand-Prince 5(4) and linearly implicit Rosenbrock 2(3)
+
+The step size follows the local error estimate of the embedded solution, and
+events (neutral buoyancy, maximum height) are located by root-finding on the
+cubic Hermite interpolant of the accepted step.
+The Rosenbrock method (the ode23s scheme of Shampine & Reichelt, 1997) solves
+one linear system with the Jacobian of the right-hand side per stage, so its
+step size is limited by accuracy and not by stability.
+As in RK4, the plume parameters are frozen during a step.
+"""
+import numpy as np
+from scipy.linalg import lu_factor, lu_solve
+from scipy.optimize import brentq
+
+
+# Dormand-Prince 5(4) tableau
+C = np.array([0., 1/5, 3/10, 4/5, 8/9, 1., 1.])
+A = [
+    [],
+    [1/5],
+    [3/40, 9/40],
+    [44/45, -56/15, 32/9],
+    [19372/6561, -25360/2187, 64448/6561, -212/729],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+    [35/384, 0., 500/1113, 125/192, -2187/6784, 11/84],
+]
+# 5th order weights (same as the last stage, FSAL) and error weights (5th - 4th order)
+B5 = np.array([35/384, 0., 500/1113, 125/192, -2187/6784, 11/84, 0.])
+E = np.array([71/57600, 0., -71/16695, 71/1920, -17253/339200, 22/525, -1/40])
+
+# Rosenbrock 2(3) coefficients
+ROS_D = 1 / (2 + np.sqrt(2))
+ROS_E32 = 6 + np.sqrt(2)
+
+# Step-size controller
+SAFETY = 0.9
+MIN_FACTOR = 0.2
+MAX_FACTOR = 5.
+
+
+def dopri5_step(model, params, y, h):
+    '''
+    One Dormand-Prince step of size h from state y.
+    Returns the 5th order solution, the error estimate and the derivatives at both ends of the step.
+    '''
+    k = np.empty((7, y.shape[0]))
+    k[0] = model(y, params)
+    for s in range(1, 7):
+        k[s] = model(y + h * np.dot(A[s], k[:s]), params)
+    y_new = y + h * np.dot(B5, k)
+    err = h * np.dot(E, k)
+    return y_new, err, k[0], k[6]
+
+
+def fd_jacobian(model, params, y, f0=None):
+    '''
+    Forward-difference Jacobian of model(y, params), one column per state component.
+    '''
+    f0 = model(y, params) if f0 is None else f0
+    jac = np.empty((f0.shape[0], y.shape[0]))
+    for j in range(y.shape[0]):
+        dy = np.sqrt(np.finfo(float).eps) * max(abs(y[j]), 1e-6)
+        y_j = y.copy()
+        y_j[j] += dy
+        jac[:, j] = (model(y_j, params) - f0) / dy
+    return jac
+
+
+def rosenbrock_step(model, params, y, h, jac):
+    '''
+    One linearly implicit Rosenbrock 2(3) step of size h from state y, jac is the Jacobian of model at y.
+    Returns the 2nd order solution, the (3rd order) error estimate and the derivatives at both ends of the step.
+    '''
+    lu = lu_factor(np.eye(y.shape[0]) - h * ROS_D * jac)
+    f0 = model(y, params)
+    k1 = lu_solve(lu, f0)
+    f1 = model(y + 0.5 * h * k1, params)
+    k2 = lu_solve(lu, f1 - k1) + k1
+    y_new = y + h * k2
+    f2 = model(y_new, params)
+    k3 = lu_solve(lu, f2 - ROS_E32 * (k2 - f1) - 2 * (k1 - f0))
+    err = h / 6 * (k1 - 2 * k2 + k3)
+    return y_new, err, f0, f2
+
+
+def error_norm(err, y, y_new, rtol, atol):
+    scale = atol + rtol * np.maximum(np.abs(y), np.abs(y_new))
+    return float(np.sqrt(np.mean((err / scale)**2)))
+
+
+def next_step(h, err_norm, order=5):
+    '''
+    New step size from the error norm of the last attempt,
+    order of the error estimate + 1 (5 for Dormand-Prince, 3 for Rosenbrock).
+    '''
+    if err_norm == 0.:
+        return h * MAX_FACTOR
+    return h * min(MAX_FACTOR, max(MIN_FACTOR, SAFETY * err_norm**(-1/order)))
+
+
+def hermite(theta, y0, y1, f0, f1, h):
+    '''
+    Cubic Hermite interpolant of the step at theta in [0,1] (dense output).
+    '''
+    return ((1 - theta) * y0 + theta * y1 +
+            theta * (theta - 1) * ((1 - 2 * theta) * (y1 - y0) + (theta - 1) * h * f0 + theta * h * f1))
+
+
+def locate_event(event, y0, y1, f0, f1, h, xtol=1e-10):
+    '''
+    Find the first zero crossing of event(state) inside the step, from positive to non-positive.
+    Returns theta in (0,1] and the interpolated state, or None if the event doesn't occur.
+    '''
+    e0 = event(y0)
+    e1 = event(y1)
+    if not (e0 > 0. and e1 <= 0.):
+        return None
+    theta = brentq(lambda th: event(hermite(th, y0, y1, f0, f1, h)), 0., 1., xtol=xtol)
+    return theta, hermite(theta, y0, y1, f0, f1, h)
@@ -0,0 +1,393 @@
+"""
+Vectorized ensemble solver: N plumes integrated at once
+
+The plume states are held as an (N, 10) array and the parameters as an
+(nparam, N) array with the named offsets of the compiled kernel
+(PlumeParams.__slots__ order), so that model, RK4 and the Yapa closures
+run as NumPy array operations over the members. Members that surface or
+reach the maximum height are dropped from the active set; the others share
+the ambient profile lookups. Members can also be released at different
+time-steps, which gives the continuous release of plume() (ncyl > 1).
+"""
+import numpy as np
+import gsw
+
+from src.__functions import PlumeParams
+from src.solver.jitKernel import (G, C_T, CA, TOTAL_ENTRAIN, A1, A2, A3, H, U, V, C, B, BB, V_0, V_0B, DS,
+                                  V_PHI, V_PHIB, V_THETA, V_THETAB, TA, SA, RHOA, RHOA_0, UA, VA,
+                                  RHO_OIL, RHO_W, RHO, G1, ALPHA)
+from src.utils.trajectoryRecorder import TrajectoryRecorder, PLUME_STATE_COLUMNS, PARAMETERS_COLUMNS
+
+
+# Release and entrainment parameters that can vary across the members
+RELEASE_KEYS = ('z0', 'x0', 'y0', 'c0', 'T0', 'S0', 'u0', 'v0', 'w0', 'b0', 'rho_oil_0', 'T_oil_0')
+ENTRAIN_KEYS = ('a1', 'a2', 'a3')
+
+# Final status of the members
+RUNNING, SURFACE, MAX_HEIGHT, OUT_OF_PROFILE, TIME_MAX = 0, 1, 2, 3, 4
+STATUS_NAMES = {RUNNING: 'running', SURFACE: 'surface', MAX_HEIGHT: 'max_height',
+                OUT_OF_PROFILE: 'out_of_profile', TIME_MAX: 'time_max'}
+
+# Ambient variables that can be perturbed with per-member offsets
+AMBIENT_OFFSET_KEYS = ('uo', 'vo', 'thetao', 'so')
+
+# Member index column of the recorded trajectories
+MEMBER_COLUMN = 'Member'
+
+# Per-member outcome arrays of EnsembleResult (saved in the checkpoints)
+RESULT_ARRAYS = ('status', 'final_z', 'neu_buoy', 't_neu_buoy', 'max_height', 't_max_height')
+
+
+# # # Vectorized closures (P is the (nparam, N) parameters array) # # #
+
+def reduced_g_vec(P):
+    return P[G] * (P[RHOA] - P[RHO]) / P[RHOA_0]
+
+
+def proj_vel_vec(P):
+    return (P[U] * P[UA] + P[V] * P[VA]) / P[V_0]
+
+
+def entrain_coeff_yapa_vec(P):
+    pv = proj_vel_vec(P)
+    vd = np.abs(P[V_0] - pv)
+    invF1_square = reduced_g_vec(P) * P[B] * 2 / vd**2
+    return (P[A1] + P[A2] * np.sin(P[V_PHI]) * invF1_square) / (1 + P[A3] * pv / vd)
+
+
+def shear_entrain_yapa_vec(P):
+    return 2 * np.pi * P[B] * P[H] * P[ALPHA] * np.abs(P[V_0] - proj_vel_vec(P))
+
+
+def forced_entrain_yapa_vec(P):
+    b = P[B]
+    cos_phi, cos_phib = np.cos(P[V_PHI]), np.cos(P[V_PHIB])
+    cos_theta, sin_theta = np.cos(P[V_THETA]), np.sin(P[V_THETA])
+    cos_thetab, sin_thetab = np.cos(P[V_THETAB]), np.sin(P[V_THETAB])
+    stretch = np.pi * b * (b - P[BB])
+    bend = 2 * b * P[DS]
+    enlarge = np.pi * b**2 / 2
+
+    Qfx = np.abs(P[UA]) * (stretch * np.abs(cos_theta * cos_phi) +
+                           bend * np.sqrt(1 - cos_theta**2 * cos_phi**2) +
+                           enlarge * np.abs(cos_theta * cos_phi - cos_thetab * cos_phib))
+    Qfy = np.abs(P[VA]) * (stretch * np.abs(sin_theta * cos_phi) +
+                           bend * np.sqrt(1 - sin_theta**2 * cos_phi**2) +
+                           enlarge * np.abs(sin_theta * cos_phi - sin_thetab * cos_phib))
+    return np.abs(Qfx) + np.abs(Qfy)
+
+
+def total_entrain_vec(P, Qs, Qf):
+    return np.where(P[TOTAL_ENTRAIN] == 0, np.maximum(Qs, Qf), Qs + Qf)
+
+
+def model_vec(state, P, Qe):
+    '''
+    Right-hand side of the governing equations for the (N, 10) states, given the entrainment flux Qe.
+    '''
+    rQe = P[RHOA] * Qe
+    m = state[:, 0]
+    return np.column_stack([rQe, rQe * P[UA], rQe * P[VA], m * P[G1], rQe * P[CA],
+                            state[:, 1] / m, state[:, 2] / m, state[:, 3] / m, rQe * P[TA], rQe * P[SA]])
+
+
+def RK4_vec(state, P, dt):
+    # params are frozen during the step, so the entrainment flux is the same at all stages
+    Qe = total_entrain_vec(P, shear_entrain_yapa_vec(P), forced_entrain_yapa_vec(P))
+    k1 = dt * model_vec(state, P, Qe)
+    k2 = dt * model_vec(state + k1/2, P, Qe)
+    k3 = dt * model_vec(state + k2/2, P, Qe)
+    k4 = dt * model_vec(state + k3, P, Qe)
+    return 1/6 * (k1 + 2*k2 + 2*k3 + k4)
+
+
+class EnsembleResult:
+    '''
+    Outcome of plume_ensemble, one entry per member:
+        members:     dict of the member parameters (arrays of length N)
+        status:      final status code (see STATUS_NAMES)
+        final_z:     last depth reached [m]
+        neu_buoy:    neutral buoyancy depth [m] (nan if not reached)
+        t_neu_buoy:  neutral buoyancy time [min] (nan if not reached)
+        max_height:  maximum height [m] (nan if not reached)
+        t_max_height: maximum height time [min] (nan if not reached)
+        outdata, paramdata: recorders in long format (last column: member index), if recorded
+    '''
+    def __init__(self, members, n):
+        self.members = members
+        self.status = np.full(n, RUNNING)
+        self.final_z = np.full(n, np.nan)
+        self.neu_buoy = np.full(n, np.nan)
+        self.t_neu_buoy = np.full(n, np.nan)
+        self.max_height = np.full(n, np.nan)
+        self.t_max_height = np.full(n, np.nan)
+        self.outdata = None
+        self.paramdata = None
+
+    def __len__(self):
+        return self.status.shape[0]
+
+    def status_names(self):
+        return [STATUS_NAMES[s] for s in self.status]
+
+
+def member_parameters(release_namelist, numerical_namelist, members, n=1):
+    '''
+    Broadcast the member overrides against the namelist values (at least n members).
+    Returns (dict of float arrays of length N, N).
+    '''
+    members = {key: np.atleast_1d(np.asarray(val, dtype=np.float64)) for key, val in (members or {}).items()}
+    unknown = set(members) - set(RELEASE_KEYS) - set(ENTRAIN_KEYS)
+    if unknown:
+        raise ValueError(f'Unrecognized ensemble parameters: {sorted(unknown)}')
+    n = max([len(val) for val in members.values()] + [n])
+
+    values = {}
+    for key in RELEASE_KEYS:
+        values[key] = members.get(key, release_namelist[key])
+    for key in ENTRAIN_KEYS:
+        values[key] = members.get(key, numerical_namelist['entrain_params'][key])
+    return {key: np.broadcast_to(np.asarray(val, dtype=np.float64), (n,)).copy() for key, val in values.items()}, n
+
+
+def initial_conditions(mp, idx, ambient, density, constants, total_entrain, dt):
+    '''
+    Initial (len(idx), 10) states and (nparam, len(idx)) parameters of the members idx, as in plume().
+    ambient(z, idx) returns the (5, len(idx)) ambient variables of the members idx at depths z.
+    Returns (state, P, m0).
+    '''
+    P = np.zeros((len(PlumeParams.__slots__), len(idx)))
+    P[G], P[C_T], P[CA] = constants.g, constants.c_T, constants.c_a
+    P[TOTAL_ENTRAIN] = total_entrain
+    P[A1], P[A2], P[A3] = mp['a1'][idx], mp['a2'][idx], mp['a3'][idx]
+
+    u0, v0, w0, b0, c0, T0, S0 = (mp[key][idx] for key in ('u0', 'v0', 'w0', 'b0', 'c0', 'T0', 'S0'))
+    P[H] = w0*dt
+    P[U], P[V] = u0, v0
+    P[B], P[BB] = b0, b0
+    P[V_0] = P[V_0B] = np.sqrt(u0**2 + v0**2 + w0**2)
+    P[DS] = P[V_0]*dt
+    P[V_PHI] = P[V_PHIB] = np.arcsin(w0/P[V_0])
+    P[V_THETA] = P[V_THETAB] = np.arctan2(v0, u0)
+
+    P[UA], P[VA], P[TA], P[SA], P[RHOA] = ambient(mp['z0'][idx], idx)
+    P[RHOA_0] = P[RHOA]
+
+    P[RHO_OIL] = mp['rho_oil_0'][idx] * (1 - P[C_T] * (T0 - mp['T_oil_0'][idx]))
+    P[RHO_W] = density(S0, T0)
+    P[RHO] = P[RHO_OIL] * P[RHO_W] / (P[RHO_W] * c0 + P[RHO_OIL] * (1 - c0))
+    P[G1] = reduced_g_vec(P)
+    P[ALPHA] = entrain_coeff_yapa_vec(P)
+
+    m0 = P[RHO_OIL] * np.pi * P[B]**2 * P[H]
+    state = np.column_stack([m0, u0*m0, v0*m0, w0*m0, c0*m0, mp['x0'][idx], mp['y0'][idx], mp['z0'][idx],
+                             T0*m0, S0*m0])
+    return state, P, m0
+
+
+def _record(result, idx, times, P, m, u, w, c, x, y, z, rhoa):
+    Qs, Qf = shear_entrain_yapa_vec(P), forced_entrain_yapa_vec(P)
+    Fd2 = P[V_0]**2 / (2 * P[G1] * P[B])
+    result.paramdata.extend(np.column_stack([times, P[ALPHA], proj_vel_vec(P), P[V_0], rhoa,
+                                             Qs, Qf, total_entrain_vec(P, Qs, Qf), P[V_PHI], P[G1], Fd2, idx]))
+    result.outdata.extend(np.column_stack([times, m, u, w, c, P[RHO], rhoa, P[H], P[B], x, y, z, idx]))
+
+
+def plume_ensemble(profile, numerical_namelist, release_namelist, constants, members=None,
+                   density_table=None, record=False, release_step=None, ambient_offsets=None, on_step=None,
+                   recorders=None, checkpoint=None, resume=None):
+    '''
+    Integrate N plumes at once with the fixed-step RK4 scheme of plume().
+
+    Parameters:
+        profile:      AmbientProfile shared by all the members
+        members:      dict {parameter: array of length N} overriding the Release namelist values
+                      (z0, x0, y0, c0, T0, S0, u0, v0, w0, b0, rho_oil_0, T_oil_0)
+                      or the entrainment coefficients (a1, a2, a3)
+        density_table: optional DensityTable, otherwise gsw is used (vectorized)
+        record:       if True, keep the trajectories of all the members in long format
+        recorders:    optional (outdata, paramdata) sinks of the recorded rows (e.g. chunked table writers),
+                      used instead of the in-memory recorders; in both the rows come in the order of the
+                      time-steps, the active members by index at every time-step
+        checkpoint:   optional Checkpointer, called with the state of the active members
+        resume:       the solver state of a checkpoint, to continue the integration from it
+        release_step: optional array of the time-steps at which the members are released (default 0):
+                      the members join the active population at their release step (continuous release)
+        ambient_offsets: optional dict {variable: array of length N} of offsets added to the ambient
+                      profiles of every member (uo, vo, thetao, so); with thetao or so offsets the
+                      ambient density changes by the density difference of the perturbed temperature
+                      and salinity
+        on_step:      optional callable on_step(time, idx, state, P), called with the members idx
+                      at their release and after every recorded step (same rows as record)
+
+    Returns:
+        EnsembleResult
+    '''
+    release_step = np.zeros(1, dtype=int) if release_step is None else np.atleast_1d(release_step).astype(int)
+    mp, n = member_parameters(release_namelist, numerical_namelist, members, n=len(release_step))
+    release_step = np.broadcast_to(release_step, (n,))
+    result = EnsembleResult(mp, n)
+
+    dt = numerical_namelist.dt
+    tmax = int(numerical_namelist.time_max*60/dt)
+    total_entrain = numerical_namelist['entrain_params']['total_entrain']
+
+    def density(S, T):
+        return density_table(S, T) if density_table is not None else gsw.density.rho(S, T, 1)
+
+    offsets = np.zeros((n, 4))
+    for k, var in enumerate(AMBIENT_OFFSET_KEYS):
+        if ambient_offsets is not None and var in ambient_offsets:
+            offsets[:, k] = ambient_offsets[var]
+    unknown = set(ambient_offsets or {}) - set(AMBIENT_OFFSET_KEYS)
+    if unknown:
+        raise ValueError(f'Unrecognized ambient offsets: {sorted(unknown)}')
+    perturbed = np.any(offsets != 0., axis=0)
+
+    def ambient(z, idx):
+        amb = profile.sample_many(z)
+        if np.any(perturbed):
+            if perturbed[2] or perturbed[3]:
+                # density change of the perturbed temperature and salinity, added to the profile rhoa
+                Ta, Sa = amb[:, 2], amb[:, 3]
+                amb[:, 4] += density(Sa + offsets[idx, 3], Ta + offsets[idx, 2]) - density(Sa, Ta)
+            amb[:, :4] += offsets[idx]
+        return amb.T
+
+    # members sorted by release step: the ones released at step t are pending[start[t]:start[t+1]]
+    pending = np.argsort(release_step, kind='stable')
+    start = np.searchsorted(release_step[pending], np.arange(tmax + 1), side='left')
+
+    state = np.empty((0, 10))
+    P = np.empty((len(PlumeParams.__slots__), 0))
+    members_idx = np.empty(0, dtype=int)
+    nb_found = np.zeros(n, dtype=bool)
+
+    if record and recorders is not None:
+        result.outdata, result.paramdata = recorders
+    elif record:
+        capacity = max(n, 1024)
+        result.outdata = TrajectoryRecorder(PLUME_STATE_COLUMNS + [MEMBER_COLUMN], capacity=capacity)
+        result.paramdata = TrajectoryRecorder(PARAMETERS_COLUMNS + [MEMBER_COLUMN], capacity=capacity)
+
+    def finish(mask, status, z):
+        # store the outcome (status code, or array of codes) of the members in mask and drop them from the active set
+        nonlocal state, P, members_idx
+        done = members_idx[mask]
+        result.status[done] = status[mask] if np.ndim(status) else status
+        result.final_z[done] = z[mask]
+        keep = ~mask
+        state, P, members_idx = state[keep], P[:, keep], members_idx[keep]
+        return keep
+
+    t_start = 0
+    if resume is not None:
+        t_start = resume['step']
+        state, P, members_idx, nb_found = resume['state'], resume['P'], resume['members_idx'], resume['nb_found']
+        for name in RESULT_ARRAYS:
+            setattr(result, name, resume['result'][name])
+
+    # # TIME-EVOLUTION
+    for t in range(t_start, tmax):
+        if checkpoint is not None and t > t_start and checkpoint.due(t):
+            checkpoint(t, {'state': state, 'P': P, 'members_idx': members_idx, 'nb_found': nb_found,
+                           'result': {name: getattr(result, name) for name in RESULT_ARRAYS}})
+
+        # ambient profiles at the time of the step (time-varying profile)
+        profile.set_time(t*dt/60)
+
+        # release the members of this step
+        new = pending[start[t]:start[t+1]]
+        if new.size:
+            state_r, P_r, m0 = initial_conditions(mp, new, ambient, density, constants, total_entrain, dt)
+            if record:
+                _record(result, new, np.full(new.size, t*dt/60), P_r, m0, mp['u0'][new], P_r[V_0], mp['c0'][new],
+                        mp['x0'][new], mp['y0'][new], mp['z0'][new], P_r[RHOA_0])
+            if on_step is not None:
+                on_step(t*dt/60, new, state_r, P_r)
+            state = np.concatenate([state, state_r])
+            P = np.concatenate([P, P_r], axis=1)
+            members_idx = np.concatenate([members_idx, new])
+
+        if members_idx.size == 0:
+            if start[t+1] == n:
+                break
+            continue
+        time = (t+1)*dt/60
+
+        state_n = state + RK4_vec(state, P, dt)
+        x_b, y_b, z_b = state[:, 5], state[:, 6], state[:, 7]
+
+        # members at the surface or outside of the ambient profile stop before the update
+        z = state_n[:, 7]
+        surface = z >= 0
+        stop = surface | (z < profile.z_min) | (z > profile.z_max)
+        if np.any(stop):
+            keep = finish(stop, np.where(surface, SURFACE, OUT_OF_PROFILE), z)
+            state_n, x_b, y_b, z_b, z = state_n[keep], x_b[keep], y_b[keep], z_b[keep], z[keep]
+            if members_idx.size == 0:
+                continue
+
+        m = state_n[:, 0]
+        u, v, w = state_n[:, 1]/m, state_n[:, 2]/m, state_n[:, 3]/m
+        c = state_n[:, 4]/m
+        x, y = state_n[:, 5], state_n[:, 6]
+        T, S = state_n[:, 8]/m, state_n[:, 9]/m
+
+        P[UA], P[VA], P[TA], P[SA], P[RHOA] = ambient(z, members_idx)
+
+        P[C] = c
+        P[RHO_OIL] = mp['rho_oil_0'][members_idx] * (1 - P[C_T] * (T - mp['T_oil_0'][members_idx]))
+        P[RHO_W] = density(S, T)
+        P[RHO] = P[RHO_OIL] * P[RHO_W] / (P[RHO_OIL]*(1-c) + P[RHO_W]*c)
+        P[G1] = reduced_g_vec(P)
+
+        P[U] = u
+        P[V] = v
+        P[ALPHA] = entrain_coeff_yapa_vec(P)
+
+        P[V_0B] = P[V_0]
+        P[V_0] = np.sqrt(u**2 + v**2 + w**2)
+
+        P[DS] = np.sqrt((x-x_b)**2 + (y-y_b)**2 + (z-z_b)**2)
+        P[H] = np.abs(P[V_0]/P[V_0B] * P[H])
+
+        P[BB] = P[B]
+        P[B] = np.sqrt(m/(P[RHO]*np.pi*P[H]))
+
+        P[V_THETAB] = P[V_THETA]
+        P[V_THETA] = np.arctan2(v, u)
+        P[V_PHIB] = P[V_PHI]
+        P[V_PHI] = np.arcsin(w/P[V_0])
+
+        state = state_n
+
+        # Neutral buoyancy
+        nb = (P[G1] <= 0.) & ~nb_found[members_idx]
+        if np.any(nb):
+            nb_found[members_idx[nb]] = True
+            result.neu_buoy[members_idx[nb]] = z[nb]
+            result.t_neu_buoy[members_idx[nb]] = time
+
+        # Maximum height: the members stop without recording the step, as in plume()
+        mh = (P[ALPHA] < -5.) | (w < 0.001)
+        if np.any(mh):
+            result.max_height[members_idx[mh]] = z[mh]
+            result.t_max_height[members_idx[mh]] = time
+            keep = finish(mh, MAX_HEIGHT, z)
+            m, u, w, c, x, y, z = m[keep], u[keep], w[keep], c[keep], x[keep], y[keep], z[keep]
+
+        if record and members_idx.size:
+            _record(result, members_idx, np.full(members_idx.size, time), P, m, u, w, c, x, y, z, P[RHOA])
+        if on_step is not None and members_idx.size:
+            on_step(time, members_idx, state, P)
+
+    # members still running at time_max (or never released)
+    result.status[members_idx] = TIME_MAX
+    result.final_z[members_idx] = state[:, 7]
+
+    if record:
+        result.outdata.trim()
+        result.paramdata.trim()
+
+    return result
@@ -0,0 +1,412 @@
+"""
+JIT-compiled (Numba) backend of the plume solver
+
+The whole time loop of one cylinder (RK4 step, Yapa entrainment closures,
+ambient-profile lookup, diagnostic update and event detection) runs as one
+native call. Parameters live in a float64 vector whose layout follows
+PlumeParams.__slots__; seawater density is read from a DensityTable
+(src/utils/densityTable.py), since gsw can't be called from compiled code.
+
+Numba is optional: without it select_backend falls back to 'python'.
+
+Run as a script to check the numba backend against the pure-Python one
+on the MEDSEA example:
+
+    python -m src.solver.jitKernel
+"""
+import math
+import numpy as np
+
+from src.__functions import PlumeParams
+from src.utils.utils import print_ntime
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+# Offsets of the parameters vector (same order as PlumeParams.__slots__)
+(G, C_T, CA, TOTAL_ENTRAIN, A1, A2, A3,
+ H, U, V, C, B, BB, V_0, V_0B, DS,
+ V_PHI, V_PHIB, V_THETA, V_THETAB,
+ TA, SA, RHOA, RHOA_0, UA, VA,
+ RHO_OIL, RHO_W, RHO, G1, ALPHA) = range(len(PlumeParams.__slots__))
+
+def select_backend(backend='python'):
+    """
+    Returns the solver backend to be used: 'numba' or 'python' (the default).
+    'auto' selects numba when it is installed.
+    """
+    if backend in ('', None):
+        return 'python'
+    if backend == 'auto':
+        return 'numba' if NUMBA_AVAILABLE else 'python'
+    if backend == 'numba' and not NUMBA_AVAILABLE:
+        print_ntime('[WARNING] numba is not installed, falling back to the python backend.')
+        return 'python'
+    if backend not in ('numba', 'python'):
+        raise ValueError(f'Unrecognized solver backend: {backend}')
+    return backend
+
+
+def params_to_vector(p):
+    return np.array([float(getattr(p, key)) for key in PlumeParams.__slots__])
+
+
+def vector_to_params(pvec, p):
+    for i, key in enumerate(PlumeParams.__slots__):
+        setattr(p, key, float(pvec[i]))
+
+
+# # # Compiled functions # # #
+
+@njit(cache=True)
+def _cubic_weights(t, w):
+    # Catmull-Rom cubic convolution weights of the 4 nodes around t in [0,1]
+    t2 = t * t
+    t3 = t2 * t
+    w[0] = (-t3 + 2 * t2 - t) / 2
+    w[1] = (3 * t3 - 5 * t2 + 2) / 2
+    w[2] = (-3 * t3 + 4 * t2 + t) / 2
+    w[3] = (t3 - t2) / 2
+
+
+@njit(cache=True)
+def _density_lookup(S, T, S_first, dS, T_first, dT, table, cubic):
+    # same interpolation as DensityTable; values outside of the table are extrapolated from the border cells
+    nS, nT = table.shape
+    fs = (S - S_first) / dS
+    ft = (T - T_first) / dT
+    if not cubic:
+        i = min(max(int(math.floor(fs)), 0), nS - 2)
+        j = min(max(int(math.floor(ft)), 0), nT - 2)
+        ws, wt = fs - i, ft - j
+        return ((1 - ws) * ((1 - wt) * table[i, j] + wt * table[i, j + 1]) +
+                ws * ((1 - wt) * table[i + 1, j] + wt * table[i + 1, j + 1]))
+
+    i = min(max(int(math.floor(fs)), 1), nS - 3)
+    j = min(max(int(math.floor(ft)), 1), nT - 3)
+    ws, wt = np.empty(4), np.empty(4)
+    _cubic_weights(fs - i, ws)
+    _cubic_weights(ft - j, wt)
+    rho = 0.
+    for a in range(4):
+        row = 0.
+        for b in range(4):
+            row += wt[b] * table[i - 1 + a, j - 1 + b]
+        rho += ws[a] * row
+    return rho
+
+
+@njit(cache=True)
+def _ambient_lookup(z, depth, table, k, out):
+    # depth is increasing; k is the bracket of the previous call, the plume moves monotonically
+    n = depth.shape[0]
+    if z < depth[0] or z > depth[n - 1]:
+        raise ValueError('Depth outside of the ambient profile range')
+    while k > 0 and z <= depth[k]:
+        k -= 1
+    while k < n - 2 and z > depth[k + 1]:
+        k += 1
+    for j in range(table.shape[1]):
+        slope = (table[k + 1, j] - table[k, j]) / (depth[k + 1] - depth[k])
+        out[j] = slope * (z - depth[k]) + table[k, j]
+    return k
+
+
+@njit(cache=True)
+def _reduced_g(p):
+    return p[G] * (p[RHOA] - p[RHO]) / p[RHOA_0]
+
+
+@njit(cache=True)
+def _proj_vel(p):
+    return (p[U] * p[UA] + p[V] * p[VA]) / p[V_0]
+
+
+@njit(cache=True)
+def _entrain_coeff(p):
+    pv = _proj_vel(p)
+    vd = abs(p[V_0] - pv)
+    invF1_square = _reduced_g(p) * p[B] * 2 / vd**2
+    return (p[A1] + p[A2] * math.sin(p[V_PHI]) * invF1_square) / (1 + p[A3] * pv / vd)
+
+
+@njit(cache=True)
+def _shear_entrain(p):
+    return 2 * math.pi * p[B] * p[H] * p[ALPHA] * abs(p[V_0] - _proj_vel(p))
+
+
+@njit(cache=True)
+def _forced_entrain(p):
+    b = p[B]
+    cos_phi, cos_phib = math.cos(p[V_PHI]), math.cos(p[V_PHIB])
+    cos_theta, sin_theta = math.cos(p[V_THETA]), math.sin(p[V_THETA])
+    cos_thetab, sin_thetab = math.cos(p[V_THETAB]), math.sin(p[V_THETAB])
+    stretch = math.pi * b * (b - p[BB])
+    bend = 2 * b * p[DS]
+    enlarge = math.pi * b**2 / 2
+
+    Qfx = abs(p[UA]) * (stretch * abs(cos_theta * cos_phi) +
+                        bend * math.sqrt(1 - cos_theta**2 * cos_phi**2) +
+                        enlarge * abs(cos_theta * cos_phi - cos_thetab * cos_phib))
+    Qfy = abs(p[VA]) * (stretch * abs(sin_theta * cos_phi) +
+                        bend * math.sqrt(1 - sin_theta**2 * cos_phi**2) +
+                        enlarge * abs(sin_theta * cos_phi - sin_thetab * cos_phib))
+    return abs(Qfx) + abs(Qfy)
+
+
+@njit(cache=True)
+def _total_entrain(p, Qs, Qf):
+    if p[TOTAL_ENTRAIN] == 0:
+        return max(Qs, Qf)
+    return Qs + Qf
+
+
+@njit(cache=True)
+def _model(state, p, Qe, out):
+    rQe = p[RHOA] * Qe
+    m = state[0]
+    out[0] = rQe
+    out[1] = rQe * p[UA]
+    out[2] = rQe * p[VA]
+    out[3] = m * p[G1]
+    out[4] = rQe * p[CA]
+    out[5] = state[1] / m
+    out[6] = state[2] / m
+    out[7] = state[3] / m
+    out[8] = rQe * p[TA]
+    out[9] = rQe * p[SA]
+
+
+@njit(cache=True)
+def _rk4(state, p, dt, Qe):
+    # params are frozen during the step, so the entrainment flux Qe is the same at all stages
+    n = state.shape[0]
+    k1, k2, k3, k4 = np.empty(n), np.empty(n), np.empty(n), np.empty(n)
+    tmp, f = np.empty(n), np.empty(n)
+
+    _model(state, p, Qe, f)
+    for i in range(n):
+        k1[i] = dt * f[i]
+        tmp[i] = state[i] + k1[i] / 2
+    _model(tmp, p, Qe, f)
+    for i in range(n):
+        k2[i] = dt * f[i]
+        tmp[i] = state[i] + k2[i] / 2
+    _model(tmp, p, Qe, f)
+    for i in range(n):
+        k3[i] = dt * f[i]
+        tmp[i] = state[i] + k3[i]
+    _model(tmp, p, Qe, f)
+    d_state = np.empty(n)
+    for i in range(n):
+        k4[i] = dt * f[i]
+        d_state[i] = 1 / 6 * (k1[i] + 2 * k2[i] + 2 * k3[i] + k4[i])
+    return d_state
+
+
+@njit(cache=True)
+def integrate_kernel(state0, p0, t_start, tmax, dt, depth, ambient, S_first, dS, T_first, dT, rho_table, cubic,
+                     rho_oil_0, T_oil_0, t_nb0=-1):
+    '''
+    Compiled twin of plume.integrate_python. Returns the recorded rows, the last depth
+    and the step index/depth of neutral buoyancy and maximum height (-1/nan if not reached).
+    The time loop can be run in windows [t_start, tmax): the next window starts from the
+    returned parameters and state, with t_nb0 the neutral buoyancy step of the previous ones.
+    Fewer rows than steps means the cylinder stopped (surface or maximum height).
+    '''
+    p = p0.copy()
+    state_b = state0.copy()
+    nsteps = max(tmax - t_start, 0)
+    out = np.empty((nsteps, 12))
+    par = np.empty((nsteps, 11))
+    amb = np.empty(ambient.shape[1])
+
+    x, y, z = state_b[5], state_b[6], state_b[7]
+    xb, yb, zb = x, y, z
+    k = 0
+    n = 0
+    t_nb, t_mh = t_nb0, -1
+    z_nb, z_mh = np.nan, np.nan
+    # entrainment flux of the current params, then the one of the diagnostics of every step
+    Qe = _total_entrain(p, _shear_entrain(p), _forced_entrain(p))
+
+    for t in range(t_start, tmax):
+        state_n = state_b + _rk4(state_b, p, dt, Qe)
+
+        m = state_n[0]
+        u, v, w = state_n[1] / m, state_n[2] / m, state_n[3] / m
+        c = state_n[4] / m
+        x, y, z = state_n[5], state_n[6], state_n[7]
+        T, S = state_n[8] / m, state_n[9] / m
+
+        if z < 0:
+            k = _ambient_lookup(z, depth, ambient, k, amb)
+            p[UA], p[VA], p[TA], p[SA], p[RHOA] = amb[0], amb[1], amb[2], amb[3], amb[4]
+        else:
+            break
+
+        p[C] = c
+        p[RHO_OIL] = rho_oil_0 * (1 - p[C_T] * (T - T_oil_0))
+        p[RHO_W] = _density_lookup(S, T, S_first, dS, T_first, dT, rho_table, cubic)
+        p[RHO] = p[RHO_OIL] * p[RHO_W] / (p[RHO_OIL] * (1 - c) + p[RHO_W] * c)
+        p[G1] = _reduced_g(p)
+
+        p[U] = u
+        p[V] = v
+        p[ALPHA] = _entrain_coeff(p)
+
+        p[V_0B] = p[V_0]
+        p[V_0] = math.sqrt(u**2 + v**2 + w**2)
+
+        p[DS] = math.sqrt((x - xb)**2 + (y - yb)**2 + (z - zb)**2)
+        p[H] = abs(p[V_0] / p[V_0B] * p[H])
+
+        p[BB] = p[B]
+        p[B] = math.sqrt(m / (p[RHO] * math.pi * p[H]))
+
+        p[V_THETAB] = p[V_THETA]
+        p[V_THETA] = math.atan2(v, u)
+        p[V_PHIB] = p[V_PHI]
+        p[V_PHI] = math.asin(w / p[V_0])
+
+        Fd2 = p[V_0]**2 / (2 * p[G1] * p[B])
+
+        Qs = _shear_entrain(p)
+        Qf = _forced_entrain(p)
+        Qe = _total_entrain(p, Qs, Qf)
+
+        state_b = state_n
+        xb, yb, zb = x, y, z
+
+        if p[G1] <= 0. and t_nb < 0:
+            t_nb = t
+            z_nb = z
+
+        if p[ALPHA] < -5. or w < 0.001:
+            t_mh = t
+            z_mh = z
+            break
+
+        time = (t + 1) * dt / 60
+        par[n, 0], par[n, 1], par[n, 2], par[n, 3], par[n, 4], par[n, 5] = time, p[ALPHA], _proj_vel(p), p[V_0], p[RHOA], Qs
+        par[n, 6], par[n, 7], par[n, 8], par[n, 9], par[n, 10] = Qf, Qe, p[V_PHI], p[G1], Fd2
+        out[n, 0], out[n, 1], out[n, 2], out[n, 3], out[n, 4], out[n, 5] = time, m, u, w, c, p[RHO]
+        out[n, 6], out[n, 7], out[n, 8], out[n, 9], out[n, 10], out[n, 11] = p[RHOA], p[H], p[B], x, y, z
+        n += 1
+
+    return out[:n], par[:n], z, t_nb, z_nb, t_mh, z_mh, p, state_b
+
+
+# # # Python entry point # # #
+
+def integrate_jit(p, plume_state_b, cyl, tmax, dt, profile, density_table,
+                  rho_oil_0, T_oil_0, outdata, paramdata, window=None, checkpoint=None, resume=None):
+    '''
+    Same interface as plume.integrate_python, running the compiled kernel.
+    density_table (a DensityTable) is required; p is updated in place with the final parameters.
+    With window, the kernel runs `window` steps at a time and the rows are handed to the
+    recorders after every window, so the kernel buffers don't grow with tmax.
+    With checkpoint, the windows also end at the checkpoint steps; with a time-varying profile
+    they last at most its refresh time.
+    '''
+    S_first, dS, T_first, dT, rho_table, cubic = density_table.grid
+    state = np.asarray(plume_state_b, dtype=np.float64)
+    pvec = params_to_vector(p)
+    cyl, tmax = int(cyl), int(tmax)
+    window = int(window) if window else max(tmax - cyl, 1)
+    if profile.time_varying:
+        # the kernel reads the profile table of the window start
+        window = min(window, max(1, int(round(profile.refresh*60/dt))))
+    if checkpoint is not None:
+        window = math.gcd(window, checkpoint.every)
+
+    t_nb, z_nb = -1, np.nan
+    if resume is not None and resume['t_nb'] >= 0:
+        t_nb, z_nb = resume['t_nb'], resume['neu_buoy']
+    t0 = cyl
+    while t0 < tmax:
+        if checkpoint is not None and t0 > cyl and checkpoint.due(t0):
+            vector_to_params(pvec, p)
+            checkpoint(t0, {'state': state, 'p': p, 'Flag1': t_nb < 0, 'Flag2': True,
+                            'neu_buoy': None if t_nb < 0 else z_nb, 't_nb': t_nb})
+        # windows aligned on the multiples of window
+        t1 = min((t0 // window + 1) * window, tmax)
+        profile.set_time(t0*dt/60)
+        out, par, z, t_nb, z_nb_w, t_mh, z_mh, pvec, state = integrate_kernel(
+            state, pvec, t0, t1, float(dt), profile.depth, profile.table, S_first, dS, T_first, dT, rho_table, cubic,
+            float(rho_oil_0), float(T_oil_0), t_nb)
+        if t_nb >= 0 and np.isnan(z_nb):
+            z_nb = z_nb_w
+        outdata.extend(out)
+        paramdata.extend(par)
+        if len(out) < t1 - t0:
+            break
+        t0 = t1
+
+    vector_to_params(pvec, p)
+
+    neu_buoy, max_height = None, None
+    if t_nb >= 0:
+        neu_buoy = z_nb
+        print('Neutral buoyancy at depth {} m and time {} mins.'.format(z_nb, (t_nb+1)*dt/60))
+    if t_mh >= 0:
+        max_height = z_mh
+        print('Maximum height at depth {} m and time {} mins.'.format(z_mh, (t_mh+1)*dt/60))
+
+    return z, neu_buoy, max_height
+
+
+def check_parity(exp_dir, ambient_namelist, numerical_namelist, release_namelist, constants, rtol=1e-3):
+    '''
+    Run the plume on the ambient profiles of exp_dir with both backends
+    and compare the outputs. Returns the maximum difference per output file, relative to the
+    magnitude of each column (Fd2 diverges near neutral buoyancy, hence the loose rtol).
+    '''
+    import os
+    import tempfile
+    import pandas as pd
+    from src.plume import plume
+    from src.preproc.ambientProfile import copy_profiles
+
+    diffs = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs = {}
+        for backend in ['python', 'numba']:
+            run_dir = os.path.join(tmp, backend)
+            os.makedirs(run_dir)
+            copy_profiles(exp_dir, run_dir)
+            namelist = numerical_namelist.copy()
+            namelist.backend = backend
+            plume(run_dir + '/', backend, ambient_namelist, namelist, release_namelist, constants)
+            outputs[backend] = {fname: pd.read_csv(os.path.join(run_dir, fname), sep='\t').values
+                                for fname in ['plumeState.csv', 'parameters.csv']}
+
+    for fname, ref in outputs['python'].items():
+        res = outputs['numba'][fname]
+        if ref.shape != res.shape:
+            diffs[fname] = np.inf
+        else:
+            # difference relative to the magnitude of each column (some columns cross zero)
+            scale = np.maximum(np.abs(ref).max(axis=0), 1e-8)
+            diffs[fname] = float(np.max(np.abs(res - ref).max(axis=0) / scale))
+        status = 'OK' if diffs[fname] <= rtol else 'FAILED'
+        print_ntime(f'{fname}: python {ref.shape} / numba {res.shape}, max relative difference {diffs[fname]:.2e} [{status}]')
+
+    return diffs
+
+
+if __name__ == '__main__':
+    from src.utils.readNamelist import read_simulation_namelists
+
+    ambient_namelist, numerical_namelist, release_namelist, \
+    render_namelist, constants, static_paths = read_simulation_namelists(UWORM1_ROOT='.')
+    check_parity('examples/MEDSEA/run000000', ambient_namelist, numerical_namelist, release_namelist, constants)
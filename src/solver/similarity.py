@@ -0,0 +1,273 @@
+"""
+Similarity-theory screening of the plume (Morton, Taylor & Turner, 1956)
+
+Instant estimates of the trap height, rise time and dilution of many release
+sites, from the release fluxes and the ambient profiles. All the sites are
+computed at once: their profiles are stacked in (nsites, nlevels) arrays,
+padded with nan. The ambient currents are neglected.
+
+The plume entrains the ambient water it crosses with the volume flux of a
+forced plume above the release,
+    Q(s) = Q0 + c_entrain (k_q B0^(1/3) s^(5/3) + k_j M0^(1/2) s),
+and its temperature, salinity and oil fraction are the mass-weighted mixture
+of the release and of the entrained water. Its density follows from them as in
+plume() (gsw for the water, oil with thermal expansion), and the plume traps
+(neutral buoyancy) where the ambient density rhoa falls to it. The mixture is
+integrated on sub-levels of the profile layers; the rhoa of a strong
+pycnocline drops much faster than the density of the plume, which stops there
+as in the full model. The rise time follows the point-source plume velocity
+and the dilution is the volume flux at the trap,
+    w(s) = k_w B0^(1/3) s^(-1/3),  dilution = Q(h) / Q0.
+The entrainment and rise time factors are fit against the neutral buoyancy of
+full-model runs (calibrate), within the physical range of the entrainment,
+and the calibrated screening is checked against them (a few metres).
+"""
+import numpy as np
+import pandas as pd
+import gsw
+from scipy.optimize import minimize_scalar
+
+from src.solver.ensemble import plume_ensemble
+from src.utils.utils import print_ntime
+
+
+# Entrainment coefficient of the top-hat plume
+ALPHA_PLUME = 0.1
+
+# Volume flux coefficients of the point-source plume and of the jet (top-hat profiles)
+K_Q = 6 * ALPHA_PLUME / 5 * (9 * ALPHA_PLUME / 10)**(1/3) * np.pi**(2/3)
+K_J = 2 * np.sqrt(np.pi) * ALPHA_PLUME
+
+# Minimum buoyancy frequency squared [s^-2] (unstratified or unstable layers)
+N2_MIN = 1e-10
+
+# Sub-levels of every profile layer on which the mixture of the plume is integrated
+SUBLEVELS = 4
+
+# Range of the entrainment factor fit by calibrate (factor of the MTT volume flux)
+ENTRAIN_RANGE = (0.1, 10.)
+
+# Largest difference [m] of the model/screening trap depths of the calibration sites before calibrate warns
+CALIBRATION_TOLERANCE = 5.
+
+SCREENING_COLUMNS = ('trap_depth', 'trap_height', 'rise_time', 'dilution', 'N', 'B0', 'M0', 'surfacing')
+
+
+def stack_profiles(profiles, columns=('rhoa',)):
+    """
+    Depth and the columns of a list of AmbientProfile as (nsites, nlevels) arrays, sorted by depth and nan-padded.
+    """
+    nlev = max(len(profile) for profile in profiles)
+    stacked = [np.full((len(profiles), nlev), np.nan) for _ in range(len(columns) + 1)]
+    for k, profile in enumerate(profiles):
+        stacked[0][k, :len(profile)] = profile.depth
+        for values, column in zip(stacked[1:], columns):
+            values[k, :len(profile)] = profile.column(column)
+    return tuple(stacked)
+
+
+def interp_sites(z, depth, values):
+    """
+    Linear interpolation of the (nsites, nlevels) values at one depth z per site (clipped to the profile range).
+    """
+    nlev = np.sum(~np.isnan(depth), axis=1)
+    z = np.clip(z, depth[:, 0], depth[np.arange(len(z)), nlev - 1])
+    k = np.clip(np.sum(depth < z[:, None], axis=1) - 1, 0, nlev - 2)
+    sites = np.arange(len(z))
+    z_lo, z_hi = depth[sites, k], depth[sites, k + 1]
+    frac = np.where(z_hi > z_lo, (z - z_lo) / (z_hi - z_lo), 0.)
+    return values[sites, k] + frac * (values[sites, k + 1] - values[sites, k])
+
+
+def buoyancy_frequency(depth, rhoa, g=9.81):
+    """
+    Squared buoyancy frequency N^2 = -g/rho drho/dz [s^-2] on the mid-levels of the (nsites, nlevels) profiles.
+    Returns (mid-level depths, N^2).
+    """
+    z_mid = (depth[:, 1:] + depth[:, :-1]) / 2
+    rho_mid = (rhoa[:, 1:] + rhoa[:, :-1]) / 2
+    return z_mid, -g / rho_mid * np.diff(rhoa, axis=1) / np.diff(depth, axis=1)
+
+
+def plume_density(c, T, S, rho_oil_0, T_oil_0, c_T=0.0007):
+    """
+    Density of the plume of oil mass fraction c, temperature T and salinity S, as in plume().
+    """
+    rho_oil = rho_oil_0 * (1 - c_T * (T - T_oil_0))
+    rho_w = gsw.density.rho(S, T, 1)
+    return rho_oil * rho_w / (rho_w * c + rho_oil * (1 - c))
+
+
+def release_fluxes(rhoa0, b0, w0, c0, T0, S0, rho_oil_0, T_oil_0, g=9.81, c_T=0.0007):
+    """
+    Volume, momentum and buoyancy fluxes of the release (Q0 [m3/s], M0 [m4/s2], B0 [m4/s3]),
+    with the initial plume density of plume().
+    """
+    rho = plume_density(c0, T0, S0, rho_oil_0, T_oil_0, c_T=c_T)
+    Q0 = np.pi * b0**2 * w0
+    return Q0, Q0 * w0, g * (rhoa0 - rho) / rhoa0 * Q0
+
+
+def _sublevels(depth, columns, n_sub):
+    # depths and values on n_sub sub-levels of every layer, the top level extended to the surface; the nan
+    # padding takes the surface values
+    sites = np.arange(depth.shape[0])
+    nlev = np.sum(~np.isnan(depth), axis=1)
+    top = depth.copy()
+    top[sites, nlev - 1] = 0.
+    frac = np.arange(n_sub) / n_sub
+    lerp = lambda values: np.concatenate([
+        (values[:, :-1, None] + frac * (values[:, 1:, None] - values[:, :-1, None])).reshape(len(sites), -1),
+        values[sites, nlev - 1][:, None]], axis=1)
+    z, values = lerp(top), [lerp(column) for column in columns]
+    pad = np.isnan(z)
+    z[pad] = 0.
+    for value, column in zip(values, columns):
+        value[pad] = np.broadcast_to(column[sites, nlev - 1][:, None], value.shape)[pad]
+    return z, values
+
+
+def screen(depth, thetao, so, rhoa, release, g=9.81, c_T=0.0007, c_entrain=1., c_time=1., alpha=ALPHA_PLUME,
+           n_sub=SUBLEVELS):
+    """
+    Trap height, rise time and dilution of every site.
+
+    Parameters:
+        depth, thetao, so, rhoa: (nsites, nlevels) stacked profiles (stack_profiles)
+        release:      dict of the release parameters of every site (arrays of length nsites):
+                      z0 (< 0), b0, w0, c0, T0, S0, rho_oil_0, T_oil_0
+        c_entrain, c_time: calibration factors of the entrained volume flux and of the rise time
+
+    Returns:
+        dict of arrays of length nsites:
+            trap_depth [m], trap_height above the release [m], rise_time [min], dilution [-],
+            N [s^-1] averaged over the rise, B0, M0, surfacing (the plume is lighter than the ambient
+            up to the surface)
+    """
+    z0 = release['z0']
+    sites = np.arange(len(z0))
+    rhoa0 = interp_sites(z0, depth, rhoa)
+    T_a0, S_a0 = interp_sites(z0, depth, thetao), interp_sites(z0, depth, so)
+    Q0, M0, B0 = release_fluxes(rhoa0, release['b0'], release['w0'], release['c0'], release['T0'], release['S0'],
+                                release['rho_oil_0'], release['T_oil_0'], g=g, c_T=c_T)
+    rho0 = plume_density(release['c0'], release['T0'], release['S0'], release['rho_oil_0'], release['T_oil_0'],
+                         c_T=c_T)
+    B0 = np.maximum(B0, 1e-12)
+
+    # ambient on the sub-levels above the release (the ones below it take the release depth, nothing entrained)
+    z, (Ta, Sa, Ra) = _sublevels(depth, (thetao, so, rhoa), n_sub)
+    below = z < z0[:, None]
+    z = np.where(below, z0[:, None], z)
+    Ta, Sa, Ra = (np.where(below, at_z0[:, None], values) for values, at_z0 in ((Ta, T_a0), (Sa, S_a0), (Ra, rhoa0)))
+    s = z - z0[:, None]
+
+    # mass-weighted mixture of the release and of the water entrained between the sub-levels (trapezoids)
+    Q = Q0[:, None] + c_entrain * (K_Q * B0[:, None]**(1/3) * s**(5/3) + K_J * np.sqrt(M0)[:, None] * s)
+    dM = np.diff(Q, axis=1) * (Ra[:, 1:] + Ra[:, :-1]) / 2
+    cumulate = lambda values: np.concatenate([np.zeros((len(sites), 1)),
+                                              np.cumsum(dM * (values[:, 1:] + values[:, :-1]) / 2, axis=1)], axis=1)
+    M_rel = (rho0 * Q0)[:, None]
+    mass = M_rel + cumulate(np.ones_like(Ra))
+    c = np.broadcast_to(release['c0'][:, None], mass.shape) * M_rel / mass
+    T = (M_rel * release['T0'][:, None] + cumulate(Ta)) / mass
+    S = (M_rel * release['S0'][:, None] + cumulate(Sa)) / mass
+    excess = Ra - plume_density(c, T, S, release['rho_oil_0'][:, None], release['T_oil_0'][:, None], c_T=c_T)
+
+    # neutral buoyancy: first sub-level where the plume is no lighter than the ambient (linear in between)
+    crossing = (excess[:, 1:] <= 0) & (excess[:, :-1] > 0)
+    surfacing = ~np.any(crossing, axis=1) & (excess[:, 0] > 0)
+    k = np.argmax(crossing, axis=1)
+    frac = excess[sites, k] / (excess[sites, k] - excess[sites, k + 1])
+    h = np.where(surfacing, -z0, s[sites, k] + frac * (s[sites, k + 1] - s[sites, k]))
+    h = np.where(excess[:, 0] > 0, h, 0.)
+
+    # N^2 averaged over the rise
+    z_mid, N2 = buoyancy_frequency(depth, rhoa, g=g)
+    N2 = np.where(np.isnan(N2), 0., np.maximum(N2, N2_MIN))
+    thick = np.clip(np.minimum(np.nan_to_num(depth[:, 1:]), (z0 + h)[:, None])
+                    - np.maximum(np.nan_to_num(depth[:, :-1]), z0[:, None]), 0., None)
+    N = np.sqrt(np.sum(N2 * thick, axis=1) / np.maximum(np.sum(thick, axis=1), 1e-12))
+
+    k_w = 5 / (6 * alpha) * (9 * alpha / 10)**(1/3) * np.pi**(-1/3)
+    rise_time = c_time * 3 / 4 * h**(4/3) / (k_w * B0**(1/3)) / 60
+    dilution = np.maximum((Q0 + c_entrain * (K_Q * B0**(1/3) * h**(5/3) + K_J * np.sqrt(M0) * h)) / Q0, 1.)
+
+    return {'trap_depth': z0 + h, 'trap_height': h, 'rise_time': rise_time, 'dilution': dilution,
+            'N': N, 'B0': B0, 'M0': M0, 'surfacing': surfacing}
+
+
+def screening(profiles, release_namelist, constants, sites=None, calibration=None):
+    """
+    Screening of the release sites, one AmbientProfile per site.
+    sites: optional dict {release parameter: array of length nsites} overriding the Release namelist
+    (z0, b0, w0, c0, T0, S0, rho_oil_0, T_oil_0); calibration: optional dict {'c_entrain', 'c_time'}.
+    Returns a dataframe with one row per site (SCREENING_COLUMNS).
+    """
+    n = len(profiles)
+    release = {key: np.broadcast_to(np.asarray((sites or {}).get(key, release_namelist[key]), dtype=np.float64),
+                                    (n,)) for key in ('z0', 'b0', 'w0', 'c0', 'T0', 'S0', 'rho_oil_0', 'T_oil_0')}
+    depth, thetao, so, rhoa = stack_profiles(profiles, columns=('thetao', 'so', 'rhoa'))
+    result = screen(depth, thetao, so, rhoa, release, g=constants.g, c_T=constants.c_T, **(calibration or {}))
+    return pd.DataFrame({column: result[column] for column in SCREENING_COLUMNS})
+
+
+def model_trap(profiles, numerical_namelist, release_namelist, constants, sites=None):
+    """
+    Neutral buoyancy depth [m] and time [min] of the full model at every site
+    (vectorized ensemble solver, one run per site profile; nan if not reached).
+    """
+    n = len(profiles)
+    depth, time = np.full(n, np.nan), np.full(n, np.nan)
+    for k, profile in enumerate(profiles):
+        members = {key: np.atleast_1d(np.asarray(val, dtype=np.float64))[[k if np.size(val) > 1 else 0]]
+                   for key, val in (sites or {}).items()}
+        result = plume_ensemble(profile, numerical_namelist, release_namelist, constants, members=members or None)
+        depth[k], time[k] = result.neu_buoy[0], result.t_neu_buoy[0]
+    return depth, time
+
+
+def calibrate(profiles, numerical_namelist, release_namelist, constants, sites=None):
+    """
+    Fit the calibration factors of the entrainment and of the rise time against full-model runs,
+    over the sites that reach neutral buoyancy: c_entrain (in ENTRAIN_RANGE) minimizes the squared
+    differences of the model/screening trap depths, c_time is the geometric mean of the rise time ratios.
+    The calibrated screening is checked on the sites, with a warning when it misses a trap depth by more
+    than CALIBRATION_TOLERANCE.
+    Returns the calibration dict {'c_entrain', 'c_time'} for screening().
+    """
+    z_nb, t_nb = model_trap(profiles, numerical_namelist, release_namelist, constants, sites=sites)
+    ok = ~np.isnan(z_nb)
+    if not np.any(ok):
+        raise ValueError('No site reaches neutral buoyancy in the full model: nothing to calibrate against.')
+    sites_ok = {key: np.broadcast_to(np.asarray(val, dtype=np.float64), (len(profiles),))[ok]
+                for key, val in (sites or {}).items()}
+    profiles_ok = [profile for profile, valid in zip(profiles, ok) if valid]
+
+    def misfit(log_c):
+        raw = screening(profiles_ok, release_namelist, constants, sites=sites_ok,
+                        calibration={'c_entrain': float(np.exp(log_c))})
+        return np.sum((raw['trap_depth'].to_numpy() - z_nb[ok])**2)
+
+    # coarse scan of the misfit, refined by a bounded minimization around the best value
+    grid = np.linspace(np.log(ENTRAIN_RANGE[0]), np.log(ENTRAIN_RANGE[1]), 21)
+    best = grid[np.argmin([misfit(log_c) for log_c in grid])]
+    step = grid[1] - grid[0]
+    fit = minimize_scalar(misfit, bounds=(max(best - step, grid[0]), min(best + step, grid[-1])), method='bounded')
+    c_entrain = float(np.exp(fit.x))
+
+    raw = screening(profiles_ok, release_namelist, constants, sites=sites_ok, calibration={'c_entrain': c_entrain})
+    error = raw['trap_depth'].to_numpy() - z_nb[ok]
+    log_time = np.log(t_nb[ok] / raw['rise_time'].to_numpy())
+    c_time = float(np.exp(np.mean(log_time)))
+    print_ntime(f'Screening calibrated on {np.sum(ok)} site(s): c_entrain = {c_entrain:.3f} '
+                f'(trap depth within {np.max(np.abs(error)):.1f} m), c_time = {c_time:.3f} '
+                f'(x/ {np.exp(np.std(log_time)):.2f})')
+
+    # check of the calibrated screening on its own calibration sites
+    if np.max(np.abs(error)) > CALIBRATION_TOLERANCE:
+        worst = int(np.argmax(np.abs(error)))
+        print_ntime(f'[WARNING] the calibrated screening does not reproduce its calibration sites: '
+                    f'trap depth {raw["trap_depth"].to_numpy()[worst]:.1f} m against {z_nb[ok][worst]:.1f} m '
+                    f'in the model (tolerance {CALIBRATION_TOLERANCE} m), '
+                    f'{int(raw["surfacing"].sum())} site(s) surfacing.')
+    return {'c_entrain': c_entrain, 'c_time': c_time}
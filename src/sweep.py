@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parameter sweep (sensitivity study) over any namelist key
+
+The members of the sweep are built from namelist/Sweep.yaml as a grid, a list
+or a Latin hypercube design, and the plume simulations run in a pool of
+worker processes. The ambient profile is interpolated once for every distinct
+value of the keys it depends on (Ambient namelist, spill location) and shared
+by the members, with one batched extraction of all the spill locations and
+release dates of the same Ambient namelist (time-varying profiles are not
+swept), and with PROFILE_CACHE only the profiles missing from the profile
+cache are interpolated; every member writes its own runXXXXXX folder in
+the product path, so the results are collected by merge_product_summary.
+"""
+import os
+import copy
+import itertools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import yaml
+from scipy.stats import qmc
+
+from src.preproc.interpolateOceanData import interpolate_sites, profile_dataframe, write_profile, release_time, \
+    locate_files, cache_options
+from src.preproc.ambientProfile import PROFILES_FILE, copy_profiles
+from src.preproc.profileCache import ProfileCache, profile_key as cache_key
+from src.plume import plume
+from src.utils.output_db import create_exp_dir_and_log_namelist, merge_product_summary
+from src.utils.readNamelist import read_namelist, get_path, _eval
+from src.utils.utils import print_ntime
+
+
+DESIGNS = ('grid', 'list', 'lhs')
+
+# Namelists that can be swept, with the name of their file in the LOG folder
+NAMELISTS = {'ambient': 'Ambient', 'numerical': 'NumericalSimulation', 'release': 'Release',
+             'constants': 'NaturalConstants'}
+
+# Release keys that change the interpolated ambient profile (besides the whole Ambient namelist)
+PROFILE_KEYS = ('release.spill_lat', 'release.spill_lon', 'release.release_datetime')
+
+
+def read_sweep_namelist(UWORM1_ROOT='.'):
+    """
+    Read namelist/Sweep.yaml. The swept parameters are free keys, so `params` is read
+    as it is and its values evaluated one by one.
+    """
+    sweep_namelist = read_namelist('Sweep', template='Sweep', UWORM1_ROOT=UWORM1_ROOT)
+
+    namelistDir = get_path(UWORM1_ROOT=UWORM1_ROOT, dirname='namelist')
+    with open(f'{namelistDir}/Sweep.yaml') as fin:
+        custom = yaml.load(fin.read(), Loader=yaml.BaseLoader) or {}
+
+    params = {}
+    for key, values in (custom.get('params') or {}).items():
+        values = [_eval(val) for val in values] if isinstance(values, list) else _eval(values)
+        params[key] = list(values) if isinstance(values, (list, tuple)) else [values]
+    sweep_namelist.params = params
+    return sweep_namelist
+
+
+def sweep_design(sweep_namelist):
+    """
+    List of the sweep members, each one a dict {'<namelist>.<key>': value}.
+        grid: all the combinations of the values
+        list: the i-th value of every parameter (same number of values for all)
+        lhs:  n_samples Latin hypercube samples between the [min, max] of every parameter
+    """
+    design = sweep_namelist.design
+    params = sweep_namelist.params
+    keys = list(params.keys())
+    if design not in DESIGNS:
+        raise ValueError(f'Unrecognized sweep design: {design}')
+    if not keys:
+        raise ValueError('No parameters to sweep in the Sweep namelist.')
+
+    if design == 'grid':
+        return [dict(zip(keys, values)) for values in itertools.product(*params.values())]
+
+    if design == 'list':
+        sizes = {len(values) for values in params.values()}
+        if len(sizes) > 1:
+            raise ValueError('The list design needs the same number of values for all the parameters.')
+        return [dict(zip(keys, values)) for values in zip(*params.values())]
+
+    for key, values in params.items():
+        if len(values) != 2:
+            raise ValueError(f'The lhs design needs min, max for every parameter ({key}: {values}).')
+    bounds = np.array([params[key] for key in keys], dtype=np.float64)
+    sample = qmc.LatinHypercube(d=len(keys), seed=sweep_namelist.seed).random(n=sweep_namelist.n_samples)
+    sample = qmc.scale(sample, bounds[:, 0], bounds[:, 1])
+    return [dict(zip(keys, values)) for values in sample.tolist()]
+
+
+def set_namelist_value(namelists, key, value):
+    """
+    Set '<namelist>.<key>[.<subkey>]' in the dict of namelists {'ambient': ..., 'release': ..., ...}.
+    """
+    name, *path = key.split('.')
+    if name not in NAMELISTS or not path:
+        raise ValueError(f'Unrecognized sweep parameter: {key}')
+    target = namelists[name]
+    for subkey in path[:-1]:
+        target = target[subkey]
+    if path[-1] not in target:
+        raise ValueError(f'Unrecognized sweep parameter: {key}')
+    target[path[-1]] = value.item() if isinstance(value, np.generic) else value
+
+
+def member_namelists(namelists, member):
+    namelists = copy.deepcopy(namelists)
+    for key, value in member.items():
+        set_namelist_value(namelists, key, value)
+    return namelists
+
+
+def profile_key(member):
+    # values of the member that change the interpolated ambient profile
+    return tuple(sorted((key, value) for key, value in member.items()
+                        if key.startswith('ambient.') or key in PROFILE_KEYS))
+
+
+def _interpolate_profiles(profiles_dir, groups, static_paths):
+    # profiles of the groups {profile key: [member namelists]}, batched over the spill locations
+    # of the same Ambient namelist (the ones missing from the profile cache with PROFILE_CACHE);
+    # returns {profile key: folder with the profiles}
+    by_ambient = {}
+    for k, (key, group) in enumerate(groups.items()):
+        ambient_key = tuple(item for item in key if item[0].startswith('ambient.'))
+        by_ambient.setdefault(ambient_key, []).append((k, key, group[0]))
+
+    profiles = {}
+    for sites in by_ambient.values():
+        namelists = sites[0][2]
+        lats = [site[2]['release'].spill_lat for site in sites]
+        lons = [site[2]['release'].spill_lon for site in sites]
+        times = [np.datetime64(release_time(site[2]['ambient'], site[2]['release']), 'ns') for site in sites]
+        files = locate_files(namelists['ambient'], static_paths, lats, lons, times)
+
+        cache, keys, todo = None, [None] * len(sites), list(range(len(sites)))
+        if namelists['ambient'].get('PROFILE_CACHE', False):
+            cache = ProfileCache.from_namelist(static_paths)
+            keys = [cache_key(namelists['ambient']['PRODUCT_ID'], files, time, lat, lon,
+                              **cache_options(namelists['ambient'])) for time, lat, lon in zip(times, lats, lons)]
+            todo = [n for n, (key, _) in enumerate(keys) if key not in cache]
+            print_ntime(f'{len(sites) - len(todo)}/{len(sites)} ambient profile(s) found in the profile cache')
+
+        values = {}
+        if todo:
+            depth, batch = interpolate_sites(namelists['ambient'], static_paths, [lats[n] for n in todo],
+                                             [lons[n] for n in todo], times=[times[n] for n in todo], clip=True,
+                                             files=files)
+            values = {n: profile_dataframe(depth, profile) for n, profile in zip(todo, batch)}
+
+        for n, (k, key, _) in enumerate(sites):
+            profile_dir = os.path.join(profiles_dir, f'profile{k}')
+            os.makedirs(profile_dir, exist_ok=True)
+            if cache is None:
+                write_profile(profile_dir, values[n])
+            else:
+                if n in values:
+                    cache.put(keys[n][0], {os.path.splitext(PROFILES_FILE)[0]: values[n]}, keys[n][1])
+                cache.link(keys[n][0], profile_dir, keys[n][1])
+            profiles[key] = profile_dir
+    return profiles
+
+
+def _run_member(prod_path, namelists, profile_dir):
+    # worker: new run folder with the member namelists, shared profile, plume simulation
+    exp_dir, runId = create_exp_dir_and_log_namelist(
+        prod_path, namelists={NAMELISTS[name]: namelist for name, namelist in namelists.items()})
+    copy_profiles(profile_dir, exp_dir)
+    plume(exp_dir, runId, namelists['ambient'], namelists['numerical'], namelists['release'], namelists['constants'])
+    return runId
+
+
+def run_sweep(sweep_namelist, ambient_namelist, numerical_namelist, release_namelist, constants, static_paths):
+    """
+    Run all the members of the sweep in a process pool and merge their summaries.
+    Returns the merged summary dataframe of the product path.
+    """
+    prod_path = static_paths['EXP_PROD']
+    members = sweep_design(sweep_namelist)
+    workers = sweep_namelist.workers or os.cpu_count()
+
+    base = {'ambient': ambient_namelist, 'numerical': numerical_namelist,
+            'release': release_namelist, 'constants': constants}
+    groups = {}
+    for member in members:
+        groups.setdefault(profile_key(member), []).append(member_namelists(base, member))
+
+    print_ntime(f'Sweep of {len(members)} members ({sweep_namelist.design}), '
+                f'{len(groups)} ambient profile(s), {workers} workers')
+
+    with tempfile.TemporaryDirectory() as profiles_dir, ProcessPoolExecutor(max_workers=workers) as pool:
+        # # Ambient profiles, one per distinct value of the profile keys
+        profiles = _interpolate_profiles(profiles_dir, groups, static_paths)
+
+        # # Plume simulations
+        futures = [pool.submit(_run_member, prod_path, namelists, profiles[key])
+                   for key, group in groups.items() for namelists in group]
+        failed = 0
+        for future in as_completed(futures):
+            try:
+                print_ntime(f'Sweep member run{future.result()} done.')
+            except Exception as e:
+                failed += 1
+                print_ntime(f'[ERROR] sweep member failed:\n{str(e)}')
+
+    print_ntime(f'Sweep done: {len(members) - failed}/{len(members)} members.')
+    return merge_product_summary(prod_path, save_df=True)
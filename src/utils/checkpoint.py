@@ -0,0 +1,89 @@
+"""
+Checkpoints of the plume integration
+
+Every checkpoint_every time-steps the solver state (plume state, parameters,
+event flags, next time-step), the offsets of the output tables written so far and
+the namelists of the run are saved in exp_dir/checkpoint.pkl. The file is written
+aside and renamed, so a run killed while checkpointing leaves the previous
+checkpoint intact. plume(..., restart=True) (or restart_plume) continues from it
+with the same results as an uninterrupted run.
+"""
+import os
+import pickle
+import tempfile
+
+
+CHECKPOINT_FILE = 'checkpoint.pkl'
+
+
+def checkpoint_path(exp_dir):
+    return os.path.join(exp_dir, CHECKPOINT_FILE)
+
+
+def write_checkpoint(exp_dir, checkpoint):
+    """
+    Atomically replace the checkpoint of exp_dir with the dict checkpoint.
+    """
+    fd, tmp = tempfile.mkstemp(dir=exp_dir, prefix='.checkpoint', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            pickle.dump(checkpoint, fout, protocol=pickle.HIGHEST_PROTOCOL)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp, checkpoint_path(exp_dir))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def read_checkpoint(exp_dir):
+    """
+    The checkpoint dict of exp_dir, None if there is none.
+    """
+    try:
+        with open(checkpoint_path(exp_dir), 'rb') as fin:
+            return pickle.load(fin)
+    except FileNotFoundError:
+        return None
+
+
+def remove_checkpoint(exp_dir):
+    if os.path.exists(checkpoint_path(exp_dir)):
+        os.remove(checkpoint_path(exp_dir))
+
+
+class Checkpointer:
+    """
+    Called by the solvers at the start of the time-steps where checkpointer.due(step):
+    checkpointer(step, solver) saves the solver state dict (state before `step`, to be
+    passed back to the solver as resume) after flushing the output.
+
+    Parameters:
+        exp_dir:   run folder
+        every:     time-steps between checkpoints
+        namelists: dict of the namelists of the run, stored for the restart
+        writers:   the ChunkedTableWriter of the output tables (their offsets are stored)
+        output:    optional DecimatedOutput between the solver and the writers
+    """
+    def __init__(self, exp_dir, every, namelists, writers, output=None):
+        self.exp_dir = exp_dir
+        self.every = int(every)
+        self.namelists = namelists
+        self.writers = writers
+        self.output = output
+
+    def due(self, step):
+        return step % self.every == 0
+
+    def __call__(self, step, solver):
+        solver['step'] = int(step)
+        if self.output is not None:
+            self.output.flush()
+        write_checkpoint(self.exp_dir, {
+            'next_step': int(step),
+            'solver': solver,
+            'offsets': [writer.checkpoint() for writer in self.writers],
+            'output': self.output.get_state() if self.output is not None else None,
+            'namelists': self.namelists,
+        })
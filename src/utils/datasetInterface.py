@@ -20,4 +20,16 @@ def get_data_interface(product_id='MEDSEA_MULTIYEAR_PHY_006_004'):
         print(f'ERROR in get_data_interface. Unrecognized product id: {product_id}')
         return
     
-    return dict_
\ No newline at end of file
+    return dict_
+
+
+def get_grid_resolution(product_id='MEDSEA_MULTIYEAR_PHY_006_004'):
+    # (longitude, latitude) grid spacing of the product datasets [degrees]
+
+    if product_id == 'MEDSEA_MULTIYEAR_PHY_006_004':
+        return 1/24, 1/24
+    elif product_id == 'NWSHELF_MULTIYEAR_PHY_004_009':
+        return 1/9, 1/15
+    else:
+        print(f'ERROR in get_grid_resolution. Unrecognized product id: {product_id}')
+        return
@@ -0,0 +1,160 @@
+"""
+Tabulated seawater density
+
+gsw.density.rho has a large fixed cost per scalar call. DensityTable samples it once
+on a regular (S,T) grid covering the envelope of a run (ambient profiles plus release
+T0/S0) and interpolates it (bilinear or bicubic), reporting the maximum absolute error
+against gsw when the table is built. Values outside of the envelope fall back to gsw.
+"""
+import numpy as np
+import gsw
+
+from src.utils.utils import print_ntime
+
+
+def _cubic_weights(t):
+    # Catmull-Rom cubic convolution weights of the 4 nodes around t in [0,1]
+    t2 = t * t
+    t3 = t2 * t
+    return ((-t3 + 2 * t2 - t) / 2, (3 * t3 - 5 * t2 + 2) / 2, (-3 * t3 + 4 * t2 + t) / 2, (t3 - t2) / 2)
+
+
+class DensityTable:
+    """
+    Seawater density rho(S, T) at fixed pressure, tabulated on [S_min, S_max] x [T_min, T_max].
+
+    Parameters:
+        S_min, S_max: salinity range [psu]
+        T_min, T_max: temperature range [degC]
+        n:            number of nodes along each axis
+        method:       'bilinear' or 'bicubic' (Catmull-Rom)
+        pressure:     sea pressure [dbar]
+        verbose:      print the maximum absolute error against gsw
+
+    The table is padded by one node on each side, so bicubic stencils never leave it.
+    """
+    METHODS = ('bilinear', 'bicubic')
+
+    def __init__(self, S_min, S_max, T_min, T_max, n=401, method='bilinear', pressure=1, verbose=True):
+        if method not in self.METHODS:
+            raise ValueError(f'Unrecognized density table method: {method}')
+        self.method = method
+        self.pressure = pressure
+        self.S_min, self.S_max = float(S_min), float(S_max)
+        self.T_min, self.T_max = float(T_min), float(T_max)
+        self.n = int(n)
+
+        self.dS = (self.S_max - self.S_min) / (self.n - 1) if self.S_max > self.S_min else 1. / (self.n - 1)
+        self.dT = (self.T_max - self.T_min) / (self.n - 1) if self.T_max > self.T_min else 1. / (self.n - 1)
+        S_axis = self.S_min + self.dS * np.arange(-1, self.n + 1)
+        T_axis = self.T_min + self.dT * np.arange(-1, self.n + 1)
+        self.S_first, self.T_first = float(S_axis[0]), float(T_axis[0])
+        self.table = np.ascontiguousarray(gsw.density.rho(S_axis[:, None], T_axis[None, :], pressure))
+        # nested lists and cached scalars are faster than numpy for the scalar lookups of the time loop
+        self._rows = self.table.tolist()
+        self._inv_dS, self._inv_dT = 1. / self.dS, 1. / self.dT
+        self._bilinear = self.method == 'bilinear'
+
+        self.max_error = self.max_abs_error()
+        if verbose:
+            print_ntime(f'Density table {self.n}x{self.n} ({self.method}) on S [{self.S_min:.3f}, {self.S_max:.3f}], '
+                        f'T [{self.T_min:.3f}, {self.T_max:.3f}]: max abs error {self.max_error:.2e} kg m-3')
+
+    @classmethod
+    def for_run(cls, profile, S0, T0, **kwargs):
+        """
+        Table covering the ambient profile and the release salinity/temperature:
+        the plume water is a mixture of the two, so it stays inside this envelope.
+        """
+        table = profile.envelope_table()
+        S = np.append(table[:, profile.VARIABLES.index('so')], S0)
+        T = np.append(table[:, profile.VARIABLES.index('thetao')], T0)
+        return cls(np.nanmin(S), np.nanmax(S), np.nanmin(T), np.nanmax(T), **kwargs)
+
+    @property
+    def grid(self):
+        """
+        Tuple (S_first, dS, T_first, dT, table, cubic) passed to the compiled kernel.
+        """
+        return self.S_first, self.dS, self.T_first, self.dT, self.table, self.method == 'bicubic'
+
+    def covers(self, S, T):
+        return (self.S_min <= S <= self.S_max) and (self.T_min <= T <= self.T_max)
+
+    def rho(self, S, T):
+        """
+        Scalar density lookup.
+        """
+        fs = (S - self.S_first) * self._inv_dS
+        ft = (T - self.T_first) * self._inv_dT
+        # the envelope [S_min, S_max] x [T_min, T_max] maps to fs, ft in [1, n]
+        if not (1. <= fs <= self.n and 1. <= ft <= self.n):
+            return float(gsw.density.rho(S, T, self.pressure))
+        rows = self._rows
+
+        if self._bilinear:
+            i = int(fs)
+            j = int(ft)
+            if i == self.n:
+                i -= 1
+            if j == self.n:
+                j -= 1
+            ws = fs - i
+            wt = ft - j
+            r0 = rows[i]
+            r1 = rows[i + 1]
+            return ((1 - ws) * ((1 - wt) * r0[j] + wt * r0[j + 1]) +
+                    ws * ((1 - wt) * r1[j] + wt * r1[j + 1]))
+
+        i = min(int(fs), self.n - 1)
+        j = min(int(ft), self.n - 1)
+        ws = _cubic_weights(fs - i)
+        w0, w1, w2, w3 = _cubic_weights(ft - j)
+        rho = 0.
+        for a in range(4):
+            row = rows[i - 1 + a]
+            rho += ws[a] * (w0 * row[j - 1] + w1 * row[j] + w2 * row[j + 1] + w3 * row[j + 2])
+        return rho
+
+    def __call__(self, S, T):
+        """
+        Vectorized density lookup on arrays of S, T.
+        """
+        S, T = np.broadcast_arrays(np.asarray(S, dtype=np.float64), np.asarray(T, dtype=np.float64))
+        inside = (S >= self.S_min) & (S <= self.S_max) & (T >= self.T_min) & (T <= self.T_max)
+        rho = np.empty(S.shape)
+        rho[inside] = self._interp(S[inside], T[inside])
+        rho[~inside] = gsw.density.rho(S[~inside], T[~inside], self.pressure)
+        return rho
+
+    def _interp(self, S, T):
+        fs = (S - self.S_first) / self.dS
+        ft = (T - self.T_first) / self.dT
+        tab = self.table
+
+        if self.method == 'bilinear':
+            i = np.clip(np.floor(fs).astype(int), 0, self.n)
+            j = np.clip(np.floor(ft).astype(int), 0, self.n)
+            ws, wt = fs - i, ft - j
+            return ((1 - ws) * ((1 - wt) * tab[i, j] + wt * tab[i, j + 1]) +
+                    ws * ((1 - wt) * tab[i + 1, j] + wt * tab[i + 1, j + 1]))
+
+        i = np.clip(np.floor(fs).astype(int), 1, self.n - 1)
+        j = np.clip(np.floor(ft).astype(int), 1, self.n - 1)
+        ws = _cubic_weights(fs - i)
+        wt = _cubic_weights(ft - j)
+        rho = np.zeros(np.shape(S))
+        for a in range(4):
+            for b in range(4):
+                rho += ws[a] * wt[b] * tab[i - 1 + a, j - 1 + b]
+        return rho
+
+    def max_abs_error(self):
+        """
+        Maximum absolute difference with gsw at the quarter, half and three-quarter points of every cell.
+        """
+        offsets = np.array([0.25, 0.5, 0.75])
+        S_chk = (self.S_min + self.dS * (np.arange(self.n - 1)[:, None] + offsets)).ravel()
+        T_chk = (self.T_min + self.dT * (np.arange(self.n - 1)[:, None] + offsets)).ravel()
+        S_chk, T_chk = np.meshgrid(S_chk, T_chk, indexing='ij')
+        return float(np.max(np.abs(self._interp(S_chk, T_chk) - gsw.density.rho(S_chk, T_chk, self.pressure))))
@@ -1,4 +1,6 @@
 import shutil
+import yaml
+import munch
 
 def copy_namelists(exp_dir, UWORM1_ROOT='.'):
     # UWORM1_ROOT = '.'
@@ -11,5 +13,14 @@ def copy_namelists(exp_dir, UWORM1_ROOT='.'):
         shutil.copyfile(src, dst)
 
 
+def write_namelists(exp_dir, namelists):
+    # namelists modified in memory: {name: namelist}, e.g. {'Release': release_namelist}
+    for namelist, values in namelists.items():
+        dst = exp_dir + '/LOG/'+str(namelist)+'.yaml'
+
+        with open(dst, 'w') as fout:
+            yaml.safe_dump(munch.unmunchify(values), fout, sort_keys=False)
+
+
 if __name__ == '__main__':
     copy_namelists()
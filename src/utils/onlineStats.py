@@ -0,0 +1,132 @@
+"""
+Online statistics on a fixed set of nodes (e.g. the levels of a common depth or time axis)
+
+RunningMoments accumulates mean and variance with Welford's update, merged batch by
+batch (Chan et al.). HistogramSketch estimates quantiles from a per-node histogram
+whose range doubles when a value of the node falls outside of it, so the memory is
+fixed and the quantile error is bounded by the bin width. Missing values (NaN) are
+skipped node by node.
+"""
+import warnings
+
+import numpy as np
+
+
+class RunningMoments:
+    """
+    Count, mean and variance of a stream of (nsamples, nnodes) batches
+    (mean and variance are NaN on the nodes without values).
+    """
+    def __init__(self, nnodes):
+        self.count = np.zeros(nnodes)
+        self._mean = np.zeros(nnodes)
+        self.M2 = np.zeros(nnodes)
+
+    def update(self, values):
+        values = np.atleast_2d(values)
+        valid = ~np.isnan(values)
+        n_b = valid.sum(axis=0)
+        if not np.any(n_b):
+            return
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_b = np.where(n_b > 0, np.nansum(values, axis=0) / n_b, 0.)
+            M2_b = np.nansum((values - mean_b)**2, axis=0)
+            n = self.count + n_b
+            delta = mean_b - self._mean
+            self._mean = np.where(n > 0, self._mean + delta * n_b / np.maximum(n, 1), 0.)
+            self.M2 = self.M2 + M2_b + delta**2 * self.count * n_b / np.maximum(n, 1)
+        self.count = n
+
+    @property
+    def mean(self):
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    @property
+    def variance(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.M2 / (self.count - 1), np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class HistogramSketch:
+    """
+    Streaming quantiles of (nsamples, nnodes) batches, with nbins histogram bins per node.
+    The range of every node is set by its first values and doubled (merging pairs of bins)
+    whenever a value falls outside of it.
+    """
+    def __init__(self, nnodes, nbins=512):
+        if nbins % 2:
+            raise ValueError('The number of bins of the histogram sketch must be even.')
+        self.nnodes = nnodes
+        self.nbins = nbins
+        self.counts = np.zeros((nnodes, nbins))
+        self.lo = np.full(nnodes, np.nan)
+        self.width = np.full(nnodes, np.nan)
+
+    @property
+    def hi(self):
+        return self.lo + self.nbins * self.width
+
+    def _init_range(self, vmin, vmax):
+        new = np.isnan(self.lo) & ~np.isnan(vmin)
+        span = vmax[new] - vmin[new]
+        margin = np.where(span > 0, span / 2, np.maximum(np.abs(vmin[new]), 1.) * 1e-3)
+        self.lo[new] = vmin[new] - margin
+        self.width[new] = (span + 2 * margin) / self.nbins
+
+    def _expand(self, vmin, vmax):
+        # double the range of the nodes until [vmin, vmax] is covered, growing towards the out-of-range side
+        half = self.nbins // 2
+        while True:
+            below = vmin < self.lo
+            above = ~below & (vmax >= self.hi)
+            grow = below | above
+            if not np.any(grow):
+                return
+            merged = self.counts[grow].reshape(-1, half, 2).sum(axis=2)
+            counts = np.zeros((merged.shape[0], self.nbins))
+            low_side = below[grow]
+            counts[low_side, half:] = merged[low_side]
+            counts[~low_side, :half] = merged[~low_side]
+            self.counts[grow] = counts
+            self.lo[below] -= self.nbins * self.width[below]
+            self.width[grow] *= 2
+
+    def update(self, values):
+        values = np.atleast_2d(values)
+        valid = ~np.isnan(values)
+        if not np.any(valid):
+            return
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            vmin, vmax = np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+            self._init_range(vmin, vmax)
+            self._expand(vmin, vmax)
+
+        node = np.broadcast_to(np.arange(self.nnodes), values.shape)[valid]
+        k = np.clip(((values[valid] - self.lo[node]) / self.width[node]).astype(int), 0, self.nbins - 1)
+        self.counts += np.bincount(node * self.nbins + k, minlength=self.nnodes * self.nbins).reshape(self.counts.shape)
+
+    def quantile(self, q):
+        """
+        Quantiles q (in [0,1]) for every node, as a (len(q), nnodes) array (nan where there are no samples).
+        Values are linearly interpolated inside the bins.
+        """
+        q = np.atleast_1d(q)
+        out = np.full((len(q), self.nnodes), np.nan)
+        cum = np.cumsum(self.counts, axis=1)
+        total = cum[:, -1]
+        nodes = np.arange(self.nnodes)
+        for i, qi in enumerate(q):
+            target = qi * total
+            # first bin whose cumulative count reaches the target
+            k = np.minimum((cum < target[:, None]).sum(axis=1), self.nbins - 1)
+            below = np.where(k > 0, cum[nodes, k - 1], 0.)
+            inbin = self.counts[nodes, k]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frac = np.clip(np.where(inbin > 0, (target - below) / inbin, 0.5), 0., 1.)
+            out[i] = np.where(total > 0, self.lo + (k + frac) * self.width, np.nan)
+        return out
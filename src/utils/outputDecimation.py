@@ -0,0 +1,270 @@
+"""
+Decimation of the plume output (plumeState and parameters tables)
+
+The integrators record one row per time-step; DecimatedOutput sits between them
+and the recorders (or chunked writers) and only passes on the rows selected by
+the output mode of NumericalSimulation.yaml:
+    steps:    every output_every-th time-step (every time-step with output_every = 1)
+    interval: every output_interval minutes
+    depths:   at the depths output_depths
+The interval and depths rows are linearly interpolated inside the time-step that
+crosses them. The event rows are always kept: the release, neutral buoyancy
+(first row with g1 <= 0) and the last row of every cylinder (surface, maximum
+height or end of the run).
+"""
+import numpy as np
+
+
+OUTPUT_MODES = ('steps', 'interval', 'depths')
+
+
+def check_output_mode(numerical_namelist):
+    """
+    Fail before the run on a wrong output mode. Returns True if the output is decimated.
+    """
+    mode = numerical_namelist.output_mode
+    if mode not in OUTPUT_MODES:
+        raise ValueError(f'Unrecognized output mode: {mode}')
+    if mode == 'steps' and int(numerical_namelist.output_every) < 1:
+        raise ValueError('output_every must be a positive number of time-steps.')
+    if mode == 'interval' and float(numerical_namelist.output_interval) <= 0:
+        raise ValueError('output_interval must be a positive time [min].')
+    if mode == 'depths' and isinstance(numerical_namelist.output_depths, str):
+        raise ValueError('The depths output mode needs the list of output_depths.')
+    return not (mode == 'steps' and int(numerical_namelist.output_every) == 1)
+
+
+class _Sink:
+    # recorder interface of one of the two tables, rows are passed to the DecimatedOutput
+    def __init__(self, parent, k, columns):
+        self.parent = parent
+        self.k = k
+        self.columns = list(columns)
+
+    def __len__(self):
+        return self.parent.nrows[self.k]
+
+    def append(self, row):
+        self.parent._add(self.k, np.asarray(row, dtype=np.float64)[None, :])
+
+    def extend(self, rows):
+        self.parent._add(self.k, np.asarray(rows, dtype=np.float64).reshape(-1, len(self.columns)))
+
+    def trim(self):
+        pass
+
+
+class DecimatedOutput:
+    """
+    Selects the rows of the outdata, paramdata recorders.
+    The integrators write to self.outdata and self.paramdata (same interface as the recorders);
+    the two tables have one row per step, time in the first column, and with member=True the
+    cylinder index in the last column (long format of the ensemble solver).
+    close() passes on the last rows and must be called before the recorders are written.
+
+    Usage example:
+
+        >>> output = DecimatedOutput.from_namelist(numerical_namelist, outdata, paramdata)
+        >>> integrate_python(..., output.outdata, output.paramdata)
+        >>> output.close()
+    """
+    def __init__(self, outdata, paramdata, mode='steps', every=1, interval=None, depths=None, member=False,
+                 batch=512):
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f'Unrecognized output mode: {mode}')
+        self.sinks = (outdata, paramdata)
+        self.mode = mode
+        self.every = int(every)
+        self.interval = float(interval) if interval is not None else None
+        self.depths = np.sort(np.atleast_1d(depths).astype(np.float64)) if depths is not None else None
+        self.member = member
+        self.batch = batch
+        self.outdata = _Sink(self, 0, outdata.columns)
+        self.paramdata = _Sink(self, 1, paramdata.columns)
+        self.z_col = list(outdata.columns).index('z')
+        self.g1_col = list(paramdata.columns).index('g1')
+
+        self.nrows = [0, 0]
+        self._pending = ([], [])
+        self._npending = [0, 0]
+        # per cylinder: previous rows, number of steps, flags
+        self._prev = (np.empty((0, len(outdata.columns))), np.empty((0, len(paramdata.columns))))
+        self._count = np.zeros(0, dtype=np.int64)
+        self._seen = np.zeros(0, dtype=bool)
+        self._nb_found = np.zeros(0, dtype=bool)
+        self._last_kept = np.zeros(0, dtype=bool)
+
+    @classmethod
+    def from_namelist(cls, numerical_namelist, outdata, paramdata, member=False):
+        depths = numerical_namelist.output_depths
+        return cls(outdata, paramdata, mode=numerical_namelist.output_mode,
+                   every=numerical_namelist.output_every, interval=numerical_namelist.output_interval,
+                   depths=None if isinstance(depths, str) else depths, member=member)
+
+    def _add(self, k, rows):
+        self._pending[k].append(rows)
+        self._npending[k] += rows.shape[0]
+        self.nrows[k] += rows.shape[0]
+        if min(self._npending) >= self.batch:
+            self._process()
+
+    def _take(self, k, n):
+        rows = np.concatenate(self._pending[k]) if len(self._pending[k]) > 1 else self._pending[k][0]
+        rest = rows[n:]
+        self._pending[k].clear()
+        if rest.shape[0]:
+            self._pending[k].append(rest)
+        self._npending[k] = rest.shape[0]
+        return rows[:n]
+
+    def _grow(self, nmembers):
+        if nmembers <= self._count.shape[0]:
+            return
+        extra = nmembers - self._count.shape[0]
+        self._prev = tuple(np.concatenate([prev, np.full((extra, prev.shape[1]), np.nan)]) for prev in self._prev)
+        self._count = np.concatenate([self._count, np.zeros(extra, dtype=np.int64)])
+        self._seen = np.concatenate([self._seen, np.zeros(extra, dtype=bool)])
+        self._nb_found = np.concatenate([self._nb_found, np.zeros(extra, dtype=bool)])
+        self._last_kept = np.concatenate([self._last_kept, np.zeros(extra, dtype=bool)])
+
+    def _crossings(self, a_prev, a, nodes_of, valid):
+        # rows i and fractions of the nodes crossed in the steps (a_prev, a], nodes_of yields (rows, node values)
+        rows, fracs = [], []
+        for i_node, node in nodes_of(a_prev, a, valid):
+            frac = (node - a_prev[i_node]) / (a[i_node] - a_prev[i_node])
+            rows.append(i_node)
+            fracs.append(frac)
+        if not rows:
+            return np.empty(0, dtype=int), np.empty(0)
+        return np.concatenate(rows), np.concatenate(fracs)
+
+    def _interval_nodes(self, a_prev, a, valid):
+        k_first = np.floor(a_prev / self.interval).astype(np.int64) + 1
+        k_last = np.floor(a / self.interval).astype(np.int64)
+        nmax = int(np.max(np.where(valid, k_last - k_first + 1, 0), initial=0))
+        for j in range(nmax):
+            k = k_first + j
+            i_node = np.flatnonzero(valid & (k <= k_last))
+            yield i_node, k[i_node] * self.interval
+
+    def _depth_nodes(self, a_prev, a, valid):
+        lo, hi = np.minimum(a_prev, a), np.maximum(a_prev, a)
+        for depth in self.depths:
+            i_node = np.flatnonzero(valid & (lo < depth) & (depth <= hi))
+            yield i_node, np.full(i_node.size, depth)
+
+    def flush(self):
+        """
+        Pass on the selected rows of the complete time-steps received so far.
+        """
+        self._process()
+
+    def get_state(self):
+        # selection state of the cylinders, for the checkpoints (no pending rows after flush)
+        return {'nrows': list(self.nrows), 'prev': self._prev, 'count': self._count, 'seen': self._seen,
+                'nb_found': self._nb_found, 'last_kept': self._last_kept}
+
+    def set_state(self, state):
+        self.nrows = list(state['nrows'])
+        self._prev = tuple(prev.copy() for prev in state['prev'])
+        self._count = state['count'].copy()
+        self._seen = state['seen'].copy()
+        self._nb_found = state['nb_found'].copy()
+        self._last_kept = state['last_kept'].copy()
+
+    def _process(self):
+        n = min(self._npending)
+        if n == 0:
+            return
+        rows = (self._take(0, n), self._take(1, n))
+        out, par = rows
+
+        m = out[:, -1].astype(np.int64) if self.member else np.zeros(n, dtype=np.int64)
+        self._grow(int(m.max()) + 1)
+
+        # previous row of the same cylinder: inside the block, or the one of the last block
+        order = np.argsort(m, kind='stable')
+        ms = m[order]
+        first_in_block = np.ones(n, dtype=bool)
+        first_in_block[1:] = ms[1:] != ms[:-1]
+        prev_sorted = np.empty(n, dtype=np.int64)
+        prev_sorted[0] = order[0]
+        prev_sorted[1:] = order[:-1]
+        prev_pos = np.empty(n, dtype=np.int64)
+        prev_pos[order] = prev_sorted
+        first = np.empty(n, dtype=bool)
+        first[order] = first_in_block
+
+        prev = []
+        for k in range(2):
+            p = rows[k][prev_pos].copy()
+            p[first] = self._prev[k][m[first]]
+            prev.append(p)
+        released = first & ~self._seen[m]
+
+        # step number of every row since the release of its cylinder
+        rank_sorted = np.arange(n) - np.maximum.accumulate(np.where(first_in_block, np.arange(n), 0))
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = rank_sorted
+        step = self._count[m] + rank
+
+        keep = released.copy()
+        if self.mode == 'steps':
+            keep |= step % self.every == 0
+
+        # neutral buoyancy: first row with g1 <= 0 of every cylinder
+        nb = (par[:, self.g1_col] <= 0.) & ~self._nb_found[m]
+        if np.any(nb):
+            idx_sorted = np.flatnonzero(nb[order])
+            _, first_nb = np.unique(ms[idx_sorted], return_index=True)
+            nb_rows = order[idx_sorted[first_nb]]
+            keep[nb_rows] = True
+            self._nb_found[m[nb_rows]] = True
+
+        # rows interpolated inside the step
+        i_node, frac = np.empty(0, dtype=int), np.empty(0)
+        if self.mode in ('interval', 'depths'):
+            valid = ~released
+            if self.mode == 'interval':
+                a_prev, a, nodes = prev[0][:, 0], out[:, 0], self._interval_nodes
+            else:
+                a_prev, a, nodes = prev[0][:, self.z_col], out[:, self.z_col], self._depth_nodes
+            with np.errstate(invalid='ignore', divide='ignore'):
+                i_node, frac = self._crossings(a_prev, a, nodes, valid)
+            exact = frac >= 1.
+            keep[i_node[exact]] = True
+            i_node, frac = i_node[~exact], frac[~exact]
+
+        # rows in time order: the interpolated ones just before the row of their step
+        i_keep = np.flatnonzero(keep)
+        position = np.concatenate([i_keep.astype(np.float64), i_node - 1. + frac])
+        sort = np.argsort(position, kind='stable')
+        for k in range(2):
+            interp = prev[k][i_node] + frac[:, None] * (rows[k][i_node] - prev[k][i_node])
+            if self.member:
+                interp[:, -1] = rows[k][i_node, -1]
+            block = np.concatenate([rows[k][i_keep], interp])[sort]
+            if block.shape[0]:
+                self.sinks[k].extend(block)
+
+        # state of the cylinders for the next block
+        last_sorted = np.empty(n, dtype=bool)
+        last_sorted[:-1] = ms[1:] != ms[:-1]
+        last_sorted[-1] = True
+        last = order[last_sorted]
+        for k in range(2):
+            self._prev[k][m[last]] = rows[k][last]
+        self._count[m[last]] = step[last] + 1
+        self._seen[m[last]] = True
+        self._last_kept[m[last]] = keep[last]
+
+    def close(self):
+        """
+        Pass on the pending rows and the last row of every cylinder.
+        """
+        self._process()
+        missing = np.flatnonzero(self._seen & ~self._last_kept)
+        for k in range(2):
+            if missing.size:
+                self.sinks[k].extend(self._prev[k][missing])
+        self._last_kept[missing] = True
@@ -10,46 +10,57 @@ import json
 import numpy as np
 import pandas as pd
 
-from src.utils.logging import copy_namelists
+from src.utils.logging import copy_namelists, write_namelists
 from src.utils.utils import dict_to_lists, get_ntime, print_ntime
+from src.utils.plumeOutput import read_table
 
 
-def create_exp_dir_and_log_namelist(prod_path):
+def create_exp_dir_and_log_namelist(prod_path, namelists=None):
     """
     Function that:
         1. looks for the next experiment name available in `prod_path`directory, in increasing order.
             The format is: <prod_path>/runXXXX/
+            The folder is claimed with an atomic mkdir, so concurrent processes never share a run.
 
         2. creates the all the output folders
 
         3. logs all the input namelists
+            (copies of the namelist files, or the given `namelists` dict {name: namelist} when
+            they were modified in memory, e.g. by a parameter sweep)
 
         4. returns the newly created experiment output directory and runId (runXXXX)
     """
     os.makedirs(prod_path, exist_ok=True)
 
-    runId = str(len([filen for filen in os.listdir(prod_path) if 'run' in filen])).zfill(6)
+    runNum = len([filen for filen in os.listdir(prod_path) if 'run' in filen])
 
-    exp_dir = f'{prod_path}/run{runId}/'
-
-    if os.path.exists(exp_dir):
-        err_msg = f'[ERROR] folder {exp_dir} already exists. Exit to prevent overwrite.'
-        print_ntime(err_msg)
-        raise Exception(err_msg)
+    while True:
+        runId = str(runNum).zfill(6)
+        exp_dir = f'{prod_path}/run{runId}/'
+        try:
+            os.makedirs(exp_dir)
+        except FileExistsError:
+            # taken by a previous or a concurrent run: try the next one
+            runNum += 1
+            continue
+        break
 
-    os.makedirs(exp_dir, exist_ok=True)
     os.makedirs(os.path.join(exp_dir, 'LOG'))
     os.makedirs(os.path.join(exp_dir, 'PICS'))
 
     # Copy the namelists in the experiment folder
-    copy_namelists(exp_dir)
+    if namelists is None:
+        copy_namelists(exp_dir)
+    else:
+        write_namelists(exp_dir, namelists)
 
     return exp_dir, runId
 
 
-def compute_metrics(exp_dir, numerical_namelist, release_namelist):
+def compute_metrics(exp_dir, numerical_namelist, release_namelist, result=None):
     """
-    Compute metrics from input namelists and output csvs,
+    Compute metrics from input namelists and output tables (the in-memory tables of the
+    PlumeResult `result` if given, the files of exp_dir otherwise),
     and returns:
         - metrics:        list containing the metrics values
         - metrics_name:   list containing the metrics names
@@ -66,21 +77,33 @@ def compute_metrics(exp_dir, numerical_namelist, release_namelist):
     oil_volume = round(oil_volume0*tmax)
 
     # compute metrics here
-    # final_depth = ...
+    # the cylinders rise monotonically: the final depth is the highest one
+    # (plumeState/parameters tables in csv, parquet or netcdf, only the needed columns are read)
+    if result is not None and 'plumeState' in result:
+        final_depth = float(result.column('plumeState', 'z').max())
+    else:
+        psdf = read_table(exp_dir, 'plumeState', columns=['z'])
+        final_depth = float(psdf['z'].max())
 
     # read csv
     # fname = 'oceanProfilesInput.csv'
     # opdf = pd.read_csv(exp_dir+fname, sep=',')
-    # fname = 'parameters.csv'
-    # pmdf = pd.read_csv(exp_dir+fname, sep='\t')
-    # fname = 'plumeState.csv'
-    # psdf = pd.read_csv(exp_dir+fname, sep='\t')
 
     # add metrics to output lists
     # metrics      += [metric1, ...]
     # metrics_name += ['metric1', ...]
-    metrics      += [oil_volume0, tmax, oil_volume]
-    metrics_name += ['oil_volume0', 'tmax', 'oil_volume']
+    metrics      += [oil_volume0, tmax, oil_volume, final_depth]
+    metrics_name += ['oil_volume0', 'tmax', 'oil_volume', 'final_depth']
+
+    # Monte Carlo statistics of the events (neutral buoyancy, maximum height), if any
+    try:
+        mcdf = read_table(exp_dir, 'monteCarloEvents').set_index('event') if exp_dir is not None else pd.DataFrame()
+    except FileNotFoundError:
+        mcdf = pd.DataFrame()
+    if len(mcdf):
+        for event, row in mcdf.iterrows():
+            metrics      += [float(val) for val in row.values]
+            metrics_name += [f'mc_{event}_{stat}' for stat in row.index]
 
 
 
@@ -89,9 +112,9 @@ def compute_metrics(exp_dir, numerical_namelist, release_namelist):
     return metrics, metrics_name
 
 
-def compute_and_save_product_summary(exp_dir, runId, numerical_namelist, release_namelist, ambient_namelist):
+def product_summary(exp_dir, runId, numerical_namelist, release_namelist, ambient_namelist, result=None):
     """
-    Function that computes and writes on disk the summary json file
+    Function that computes the summary dict {column: value} of a run (namelist values and metrics)
     """
     runDate = get_ntime()
     # read parameters from namelists
@@ -104,16 +127,26 @@ def compute_and_save_product_summary(exp_dir, runId, numerical_namelist, release
         namelist_vals += tmpv
 
     # compute metrics
-    metrics_vals, metrics_cols = compute_metrics(exp_dir, numerical_namelist, release_namelist)
+    metrics_vals, metrics_cols = compute_metrics(exp_dir, numerical_namelist, release_namelist, result=result)
 
     out_cols = namelist_cols+metrics_cols
     out_vals = namelist_vals+metrics_vals
+    return dict(zip(out_cols, out_vals))
+
+
+def compute_and_save_product_summary(exp_dir, runId, numerical_namelist, release_namelist, ambient_namelist,
+                                     result=None):
+    """
+    Function that computes and writes on disk the summary json file, returns the summary dict
+    """
+    summary = product_summary(exp_dir, runId, numerical_namelist, release_namelist, ambient_namelist, result=result)
 
     # write summary as json
     opath = exp_dir+'/summary.json'
     with open(opath, 'w') as fout:
-        json.dump(dict(zip(out_cols, out_vals)), fout)
+        json.dump(summary, fout)
         print_ntime(f'Summary file saved in {opath}')
+    return summary
 
 
 def merge_product_summary(prod_path, save_df=False):
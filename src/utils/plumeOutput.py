@@ -0,0 +1,291 @@
+"""
+Output tables of the plume runs (plumeState, parameters, Monte Carlo statistics)
+
+A table is written in one of the OUTPUT_FORMATS:
+    csv:     tab-separated text with 8 decimals (the original format)
+    parquet: compressed columnar file, full float64 precision (needs pyarrow)
+    netcdf:  one variable per column along the 'record' dimension, with CF-style
+             attributes (long_name, units), full float64 precision
+read_table finds the table in whatever format it was written and reads only the
+requested columns (parquet and netcdf load them lazily).
+
+ChunkedTableWriter streams a table to disk during the run, a fixed number of rows
+at a time, so that the memory doesn't grow with the length of the run and the
+rows written so far can be read with read_table while the run goes on.
+"""
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+OUTPUT_FORMATS = ('csv', 'parquet', 'netcdf')
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'netcdf': '.nc'}
+
+# NetCDF variable name, long_name and units of the known columns
+CF_ATTRIBUTES = {
+    'Time [min]': ('time', 'time since the start of the release', 'min'),
+    'Mass': ('mass', 'cylinder mass', 'kg'),
+    'U': ('u', 'cylinder velocity x-component', 'm s-1'),
+    'W': ('w', 'cylinder velocity z-component', 'm s-1'),
+    'C': ('c', 'oil concentration', 'kg kg-1'),
+    'Density': ('rho', 'plume density', 'kg m-3'),
+    'A_Density': ('rhoa', 'ambient sea water density', 'kg m-3'),
+    'Tkness': ('h', 'cylinder thickness', 'm'),
+    'Radius': ('b', 'cylinder radius', 'm'),
+    'x': ('x', 'zonal position', 'm'),
+    'y': ('y', 'meridional position', 'm'),
+    'z': ('z', 'vertical position (positive up)', 'm'),
+    'alpha': ('alpha', 'shear entrainment coefficient', '1'),
+    'va proj': ('va_proj', 'ambient current projected on the cylinder velocity', 'm s-1'),
+    'v_0': ('v_0', 'cylinder velocity magnitude', 'm s-1'),
+    'rhoa': ('rhoa', 'ambient sea water density', 'kg m-3'),
+    'Qs': ('Qs', 'shear entrainment volume flux', 'm3 s-1'),
+    'Qf': ('Qf', 'forced entrainment volume flux', 'm3 s-1'),
+    'Qe': ('Qe', 'total entrainment volume flux', 'm3 s-1'),
+    'v_phi': ('v_phi', 'cylinder elevation angle', 'rad'),
+    'g1': ('g1', 'reduced gravity', 'm s-2'),
+    'Fd2': ('Fd2', 'squared densimetric Froude number', '1'),
+    'Cylinder': ('cylinder', 'cylinder index', '1'),
+}
+
+# Columns written as integers
+INTEGER_COLUMNS = ('Cylinder',)
+
+
+def check_output_format(fmt):
+    """
+    Fail before the run, not when writing its results.
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f'Unrecognized output format: {fmt}')
+    if fmt == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('The parquet output format needs pyarrow.')
+
+
+def table_path(exp_dir, name, fmt):
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f'Unrecognized output format: {fmt}')
+    return os.path.join(exp_dir, name + EXTENSIONS[fmt])
+
+
+def find_table(exp_dir, name):
+    """
+    Returns (path, format) of the table `name` in exp_dir (binary formats first).
+    """
+    for fmt in ('parquet', 'netcdf', 'csv'):
+        path = table_path(exp_dir, name, fmt)
+        if os.path.exists(path):
+            return path, fmt
+    raise FileNotFoundError(f'No {name} table in {exp_dir}')
+
+
+def _nc_name(column):
+    if column in CF_ATTRIBUTES:
+        return CF_ATTRIBUTES[column][0]
+    return re.sub(r'\W+', '_', column).strip('_')
+
+
+def to_dataset(df, attrs=None):
+    """
+    xarray Dataset of the table, with CF-style attributes. The original column name
+    is kept in the 'column' attribute of every variable.
+    """
+    data_vars = {}
+    for column in df.columns:
+        _, long_name, units = CF_ATTRIBUTES.get(column, (None, column, ''))
+        var_attrs = {'long_name': long_name, 'column': column}
+        if units:
+            var_attrs['units'] = units
+        data_vars[_nc_name(column)] = ('record', df[column].to_numpy(), var_attrs)
+    ds = xr.Dataset(data_vars)
+    ds.attrs['Conventions'] = 'CF-1.8'
+    ds.attrs.update(attrs or {})
+    return ds
+
+
+def write_table(df, exp_dir, name, fmt='csv', attrs=None):
+    """
+    Write the dataframe df as exp_dir/name.<ext> in the format fmt. Returns the path.
+    """
+    path = table_path(exp_dir, name, fmt)
+    if os.path.isdir(path):
+        # parts of a chunked parquet table
+        shutil.rmtree(path)
+    if fmt == 'csv':
+        df.to_csv(path, index=False, header=True, float_format='%.8f', sep='\t', mode='w')
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=False, compression='zstd')
+    else:
+        ds = to_dataset(df, attrs)
+        ds.to_netcdf(path, mode='w', encoding={var: {'zlib': True, 'complevel': 4} for var in ds.data_vars})
+    return path
+
+
+def table_columns(exp_dir, name):
+    path, fmt = find_table(exp_dir, name)
+    if fmt == 'csv':
+        return list(pd.read_csv(path, sep='\t', nrows=0).columns)
+    if fmt == 'parquet':
+        import pyarrow.dataset as pds
+        return list(pds.dataset(path).schema.names)
+    with xr.open_dataset(path) as ds:
+        return [ds[var].attrs.get('column', var) for var in ds.data_vars]
+
+
+def read_table(exp_dir, name, columns=None):
+    """
+    Read the table `name` of exp_dir as a dataframe, only the given columns if any.
+    """
+    path, fmt = find_table(exp_dir, name)
+    if fmt == 'csv':
+        return pd.read_csv(path, sep='\t', usecols=columns)
+    if fmt == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+
+    with xr.open_dataset(path) as ds:
+        names = {ds[var].attrs.get('column', var): var for var in ds.data_vars}
+        columns = list(names) if columns is None else columns
+        return pd.DataFrame({column: np.asarray(ds[names[column]].values) for column in columns})
+
+
+class ChunkedTableWriter:
+    """
+    Write a table to exp_dir/name.<ext> chunk by chunk during the run.
+    Same append/extend/trim interface as TrajectoryRecorder: the rows are buffered
+    and flushed every chunk_size rows, so at most chunk_size rows are kept in memory.
+        csv:     rows appended to the text file (header with the first chunk)
+        parquet: one file per chunk in the name.parquet/ folder, read as a single table
+        netcdf:  records appended along the unlimited 'record' dimension
+    Every flush leaves a complete table on disk, readable with read_table.
+    close() flushes the last rows (and writes the header of an empty table).
+    With resume (the offsets returned by checkpoint()), the table written so far is
+    cut back to the checkpoint and the new rows are appended to it.
+    """
+    def __init__(self, exp_dir, name, columns, fmt='csv', chunk_size=10000, attrs=None, resume=None):
+        check_output_format(fmt)
+        self.path = table_path(exp_dir, name, fmt)
+        self.fmt = fmt
+        self.columns = list(columns)
+        self.attrs = attrs or {}
+        self._buffer = np.empty((max(int(chunk_size), 1), len(self.columns)), dtype=np.float64)
+        self._nrows = 0
+        self._nwritten = 0
+        self._nchunks = 0
+
+        if resume is not None:
+            self._resume(resume)
+        # start from a new table
+        elif os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __len__(self):
+        return self._nwritten + self._nrows
+
+    @property
+    def chunk_size(self):
+        return self._buffer.shape[0]
+
+    def append(self, row):
+        self._buffer[self._nrows] = row
+        self._nrows += 1
+        if self._nrows == self.chunk_size:
+            self.flush()
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(self.columns))
+        while len(rows):
+            n = min(self.chunk_size - self._nrows, len(rows))
+            self._buffer[self._nrows:self._nrows + n] = rows[:n]
+            self._nrows += n
+            rows = rows[n:]
+            if self._nrows == self.chunk_size:
+                self.flush()
+
+    def trim(self):
+        self.flush()
+
+    def checkpoint(self):
+        """
+        Flush the buffered rows and return the offsets of the table on disk.
+        """
+        self.flush()
+        offsets = {'rows': self._nwritten, 'chunks': self._nchunks}
+        if self.fmt == 'csv' and self._nchunks:
+            offsets['bytes'] = os.path.getsize(self.path)
+        return offsets
+
+    def _resume(self, offsets):
+        self._nwritten, self._nchunks = offsets['rows'], offsets['chunks']
+        if self.fmt == 'csv' and self._nchunks:
+            os.truncate(self.path, offsets['bytes'])
+        elif self.fmt == 'parquet' and os.path.isdir(self.path):
+            for part in os.listdir(self.path):
+                if not part.endswith('.parquet') or int(part[4:10]) >= self._nchunks:
+                    os.remove(os.path.join(self.path, part))
+        # netcdf: the records after the checkpoint are overwritten by the new ones
+
+    def _chunk_dataframe(self):
+        df = pd.DataFrame(data=self._buffer[:self._nrows], columns=self.columns)
+        for column in set(INTEGER_COLUMNS) & set(self.columns):
+            df[column] = df[column].astype(int)
+        return df
+
+    def flush(self):
+        """
+        Write the buffered rows to disk.
+        """
+        if self._nrows == 0 and self._nchunks > 0:
+            return
+        df = self._chunk_dataframe()
+        if self.fmt == 'csv':
+            df.to_csv(self.path, index=False, header=self._nchunks == 0, float_format='%.8f', sep='\t',
+                      mode='w' if self._nchunks == 0 else 'a')
+        elif self.fmt == 'parquet':
+            os.makedirs(self.path, exist_ok=True)
+            part = os.path.join(self.path, f'part{self._nchunks:06d}.parquet')
+            # written aside and renamed, so that a reader never sees a partial file
+            df.to_parquet(part + '.tmp', index=False, compression='zstd')
+            os.replace(part + '.tmp', part)
+        else:
+            self._append_netcdf(df)
+        self._nwritten += self._nrows
+        self._nrows = 0
+        self._nchunks += 1
+
+    def _append_netcdf(self, df):
+        import netCDF4
+
+        if self._nchunks == 0:
+            with netCDF4.Dataset(self.path, 'w') as nc:
+                nc.createDimension('record', None)
+                for column in self.columns:
+                    var = nc.createVariable(_nc_name(column), 'i8' if column in INTEGER_COLUMNS else 'f8',
+                                            ('record',), zlib=True, complevel=4, chunksizes=(self.chunk_size,))
+                    _, long_name, units = CF_ATTRIBUTES.get(column, (None, column, ''))
+                    var.long_name = long_name
+                    var.column = column
+                    if units:
+                        var.units = units
+                nc.Conventions = 'CF-1.8'
+                for key, value in self.attrs.items():
+                    nc.setncattr(key, value)
+
+        if not len(df):
+            return
+        with netCDF4.Dataset(self.path, 'a') as nc:
+            first = self._nwritten
+            for column in self.columns:
+                nc.variables[_nc_name(column)][first:first + len(df)] = df[column].to_numpy()
+
+    def close(self):
+        self.flush()
+        return self.path
@@ -0,0 +1,133 @@
+"""
+Set of classes to record the plume time-evolution in memory
+
+The recorder keeps a preallocated columnar buffer that grows by doubling
+when full, so appending one row per time-step costs amortized O(1)
+instead of copying the whole history as `np.vstack` does.
+PlumeResult hands the tables of a run over to the render and metrics stages
+without writing and parsing them again.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Columns of the plume state output (plumeState.csv)
+PLUME_STATE_COLUMNS = ['Time [min]', 'Mass', 'U', 'W', 'C', 'Density', 'A_Density', 'Tkness', 'Radius', 'x', 'y', 'z']
+
+# Columns of the diagnostic parameters output (parameters.csv)
+PARAMETERS_COLUMNS = ['Time [min]', 'alpha', 'va proj', 'v_0', 'rhoa', 'Qs', 'Qf', 'Qe', 'v_phi', 'g1', 'Fd2']
+
+
+class TrajectoryRecorder:
+    """
+    Growable (nrows, ncols) float64 buffer with named columns.
+
+    Parameters:
+        columns:  list of column names
+        capacity: number of rows initially allocated (the buffer doubles when full)
+
+    Usage example:
+
+        >>> rec = TrajectoryRecorder(['t', 'z'], capacity=2)
+        >>> rec.append([0., -810.])
+        >>> rec.append([0.25, -809.7])
+        >>> rec.append([0.5, -809.5])
+        >>> rec.data.shape
+        >>> (3, 2)
+    """
+
+    def __init__(self, columns, capacity=1024):
+        self.columns = list(columns)
+        self._buffer = np.empty((max(int(capacity), 1), len(self.columns)), dtype=np.float64)
+        self._nrows = 0
+
+    def __len__(self):
+        return self._nrows
+
+    @property
+    def capacity(self):
+        return self._buffer.shape[0]
+
+    def _grow(self, min_capacity):
+        new_capacity = self.capacity
+        while new_capacity < min_capacity:
+            new_capacity *= 2
+        new_buffer = np.empty((new_capacity, len(self.columns)), dtype=np.float64)
+        new_buffer[:self._nrows] = self._buffer[:self._nrows]
+        self._buffer = new_buffer
+
+    def append(self, row):
+        """
+        Append a single row (any sequence of len(columns) numbers).
+        """
+        if self._nrows == self.capacity:
+            self._grow(self._nrows + 1)
+        self._buffer[self._nrows] = row
+        self._nrows += 1
+
+    def extend(self, rows):
+        """
+        Append a 2D block of rows with shape (n, len(columns)).
+        """
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(self.columns))
+        nnew = rows.shape[0]
+        if self._nrows + nnew > self.capacity:
+            self._grow(self._nrows + nnew)
+        self._buffer[self._nrows:self._nrows + nnew] = rows
+        self._nrows += nnew
+
+    def trim(self):
+        """
+        Release the unused preallocated rows.
+        """
+        if self._nrows < self.capacity:
+            self._buffer = self._buffer[:max(self._nrows, 1)].copy()
+
+    @property
+    def data(self):
+        """
+        View of the recorded rows, shape (nrows, ncols).
+        """
+        return self._buffer[:self._nrows]
+
+    def column(self, name):
+        return self.data[:, self.columns.index(name)]
+
+    def to_dataframe(self):
+        return pd.DataFrame(data=self.data, columns=self.columns)
+
+
+class PlumeResult:
+    """
+    In-memory result of a plume() run.
+
+    Attributes:
+        tables:      dict {'plumeState', 'parameters': dataframe} of the run, as written in the output tables
+                     (empty when the tables were streamed to disk during the run, output_chunk > 0)
+        final_z:     last depth reached [m]
+        neu_buoy:    neutral buoyancy depth [m] (None if not reached, nan per cylinder of a continuous release)
+        max_height:  maximum height [m] (None if not reached, nan per cylinder of a continuous release)
+        summary:     dict of the namelist values and metrics of the run (summary.json)
+
+    Usage example:
+
+        >>> result = plume(exp_dir, runId, ambient_namelist, numerical_namelist, release_namelist, constants,
+        >>>                profile=profile, write=False)
+        >>> result.column('plumeState', 'z')
+    """
+    def __init__(self, tables=None, final_z=None, neu_buoy=None, max_height=None):
+        self.tables = dict(tables or {})
+        self.final_z = final_z
+        self.neu_buoy = neu_buoy
+        self.max_height = max_height
+        self.summary = None
+
+    def __contains__(self, name):
+        return name in self.tables
+
+    def table(self, name):
+        return self.tables[name]
+
+    def column(self, name, column):
+        return self.tables[name][column].to_numpy()